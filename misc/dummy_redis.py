@@ -7,15 +7,20 @@ putting into the live API.
 Author: Axel.Tidemann@telenor.com
 '''
 
-import redis
+import os
+import sys
 import time
-import cPickle as pickle
+
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web_demo'))
+import protocol
 
 red = redis.StrictRedis()
 
 while True:
     if red.llen('classify') < 100:
-        task = {'group': 'dummy', 'path': 'http://img.ekhanei.com/images/54/5467523091.jpg'}
-        red.rpush('classify', pickle.dumps(task))
+        task = {'group': 'dummy', 'path': 'http://img.ekhanei.com/images/54/5467523091.jpg', 'queued_at': time.time()}
+        red.rpush('classify', protocol.dumps('task', task))
     else:
         time.sleep(1)
@@ -0,0 +1,375 @@
+'''
+End-to-end load test of the web demo and its workers, without internet access. Serves
+a synthetic corpus of JPEG images from a local HTTP server, with configurable size and
+latency distributions, and sends classification requests for them to the web demo at
+a controlled (Poisson) arrival rate. Completions are seen on the archive:done channel
+the workers publish on, which gives the end-to-end latency of every image. Results
+written with OK False count as failed.
+
+The senders block when --concurrency requests are in flight, so a slow web demo slows
+the arrivals down. The reports give the achieved arrival rate next to --rate.
+
+Every --report_interval seconds it prints the throughput, latency percentiles and the
+length of the work queue, and in classify mode the latencies of each priority class
+given by --mix, e.g. --mix interactive=1 bulk=9. To run it on one machine with CPU workers:
+
+    redis-server &
+    python web_demo/app.py --queue classify &
+    CUDA_VISIBLE_DEVICES= python web_demo/tf_worker.py --redis_server localhost &
+    python misc/load_generator.py --mode classify_url --rate 5 --duration 120
+'''
+
+from __future__ import division
+import argparse
+import BaseHTTPServer
+import SocketServer
+import cStringIO as StringIO
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import Queue
+
+import numpy as np
+import redis
+import requests
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web_demo'))
+from notify import CHANNEL
+from scheduling import WEIGHTS, backlog
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--mode',
+    help='classify_url sends one GET per image, classify posts a list of --list_size URLs to /images/classify/<queue>',
+    choices=['classify_url', 'classify'],
+    default='classify_url')
+parser.add_argument(
+    '--app',
+    help='Address of the web demo',
+    default='http://localhost:8080')
+parser.add_argument(
+    '--user',
+    help='User name for the web demo',
+    default='telenor')
+parser.add_argument(
+    '--password',
+    help='Password for the web demo',
+    default='research')
+parser.add_argument(
+    '--queue',
+    help='Work queue the web demo posts to, for the queue length',
+    default='classify')
+parser.add_argument(
+    '--rate',
+    help='Requests per second',
+    type=float,
+    default=5)
+parser.add_argument(
+    '--duration',
+    help='Seconds to send requests for',
+    type=float,
+    default=60)
+parser.add_argument(
+    '--drain',
+    help='Seconds to wait for outstanding results after the last request',
+    type=float,
+    default=30)
+parser.add_argument(
+    '--list_size',
+    help='Number of URLs per request in classify mode',
+    type=int,
+    default=10)
+parser.add_argument(
+    '--mix',
+    help='Share of the requests of each priority class in classify mode, as class=share',
+    nargs='*',
+    default=['default=1'])
+parser.add_argument(
+    '--deadline',
+    help='Seconds the workers have to classify the images of a request in classify mode, 0 for no deadline',
+    type=float,
+    default=0)
+parser.add_argument(
+    '--concurrency',
+    help='Number of requests in flight at most',
+    type=int,
+    default=64)
+parser.add_argument(
+    '--host',
+    help='Address the workers reach the image server at',
+    default='127.0.0.1')
+parser.add_argument(
+    '--port',
+    help='Port of the image server',
+    type=int,
+    default=8099)
+parser.add_argument(
+    '--corpus',
+    help='Number of distinct synthetic images',
+    type=int,
+    default=100)
+parser.add_argument(
+    '--size_kb',
+    help='Median image size',
+    type=float,
+    default=60)
+parser.add_argument(
+    '--size_sigma',
+    help='Spread of the log-normal image size distribution',
+    type=float,
+    default=.5)
+parser.add_argument(
+    '--latency_ms',
+    help='Median latency of the image server',
+    type=float,
+    default=50)
+parser.add_argument(
+    '--latency_sigma',
+    help='Spread of the log-normal latency distribution',
+    type=float,
+    default=.7)
+parser.add_argument(
+    '--error_rate',
+    help='Share of image requests answered with 404',
+    type=float,
+    default=0)
+parser.add_argument(
+    '--report_interval',
+    type=float,
+    default=5)
+parser.add_argument(
+    '--redis_server',
+    default='localhost')
+parser.add_argument(
+    '--redis_port',
+    type=int,
+    default=6379)
+
+def synthetic_jpeg(size, seed):
+    '''A noise JPEG of about size bytes, noise compresses to roughly the same number
+    of bytes per pixel at any resolution.'''
+    rng = np.random.RandomState(seed)
+    probe = Image.fromarray(rng.randint(0, 256, (128, 128, 3)).astype(np.uint8))
+    buf = StringIO.StringIO()
+    probe.save(buf, 'JPEG', quality=75)
+    side = max(16, int(np.sqrt(size/(len(buf.getvalue())/128**2))))
+
+    image = Image.fromarray(rng.randint(0, 256, (side, side, 3)).astype(np.uint8))
+    buf = StringIO.StringIO()
+    image.save(buf, 'JPEG', quality=75)
+    return buf.getvalue()
+
+def unique(jpeg):
+    '''Adds a random comment segment, so a content cache never sees the same image twice.'''
+    comment = os.urandom(16)
+    return jpeg[:2] + '\xff\xfe' + struct.pack('>H', len(comment) + 2) + comment + jpeg[2:]
+
+class ImageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class ImageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves /images/<n>.jpg?<anything>, image n modulo the corpus size.'''
+
+    def do_GET(self):
+        time.sleep(random.lognormvariate(np.log(args.latency_ms/1000), args.latency_sigma))
+        try:
+            n = int(self.path.split('/')[-1].split('.')[0])
+        except ValueError:
+            n = None
+        if n is None or random.random() < args.error_rate:
+            self.send_error(404)
+            return
+
+        data = unique(corpus[n % len(corpus)])
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class Tracker(object):
+    '''Send times of the result keys, and the latencies of the completed ones.'''
+
+    def __init__(self, r_server):
+        self.red = r_server
+        self.sent = {}
+        self.latencies = []
+        self.classes = {}
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self._listen)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def expect(self, key, priority):
+        with self._lock:
+            self.sent[key] = (time.time(), priority)
+
+    def fail(self, keys):
+        with self._lock:
+            for key in keys:
+                if self.sent.pop(key, None) is not None:
+                    self.failed += 1
+
+    def _listen(self):
+        pubsub = self.red.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(CHANNEL)
+        for message in pubsub.listen():
+            now = time.time()
+            with self._lock:
+                sent = self.sent.pop(message['data'], None)
+            if sent is None:
+                continue
+            # The workers publish failures on the same channel.
+            if self.red.hget(message['data'], 'OK') == 'False':
+                with self._lock:
+                    self.failed += 1
+                continue
+            sent, priority = sent
+            with self._lock:
+                self.latencies.append(now - sent)
+                self.classes.setdefault(priority, []).append(now - sent)
+
+    def snapshot(self):
+        with self._lock:
+            return len(self.sent), list(self.latencies), self.failed
+
+    def by_class(self):
+        with self._lock:
+            return dict((priority, list(latencies)) for priority, latencies in self.classes.iteritems())
+
+def parse_mix(mix):
+    '''The priority classes and their cumulative shares.'''
+    classes = []
+    shares = []
+    for item in mix:
+        priority, _, share = item.partition('=')
+        if priority not in dict(WEIGHTS):
+            raise ValueError('Unknown priority class {}'.format(priority))
+        classes.append(priority)
+        shares.append(float(share or 1))
+    return classes, np.cumsum(shares)/sum(shares)
+
+def send(session, urls, keys, priority):
+    try:
+        if args.mode == 'classify_url':
+            response = session.get('{}/images/classify_url'.format(args.app),
+                                   params={'imageurl': urls[0], 'ad_id': 'loadtest'}, timeout=60)
+        else:
+            response = session.post('{}/images/classify/{}'.format(args.app, args.queue),
+                                    data={'group': 'loadtest', 'res_q': '', 'priority': priority,
+                                          'deadline': args.deadline},
+                                    files={'file': ('urls.txt', '\n'.join(urls))}, timeout=60)
+        response.raise_for_status()
+    except Exception as e:
+        print 'Request failed: {}'.format(e)
+        tracker.fail(keys)
+
+def sender(requests_queue):
+    session = requests.Session()
+    session.auth = (args.user, args.password)
+    while True:
+        urls, keys, priority = requests_queue.get()
+        send(session, urls, keys, priority)
+        requests_queue.task_done()
+
+def percentiles(latencies):
+    if not latencies:
+        return '-'
+    return ' '.join([ 'p{}={:.0f}ms'.format(q, 1000*np.percentile(latencies, q)) for q in (50, 90, 99) ])
+
+def report(started, last, sent, stopped=None):
+    '''sent requests were sent from started until stopped, or until now.'''
+    outstanding, latencies, failed = tracker.snapshot()
+    now = time.time()
+    print '{:6.0f}s arrivals {:6.2f}/s of {:.2f}/s completed {:6} ({:6.2f}/s) outstanding {:5} failed {:4} queue {:6} {}'.format(
+        now - started, sent/max((stopped or now) - started, 1e-9), args.rate, len(latencies),
+        (len(latencies) - last)/args.report_interval, outstanding, failed, queue_length(),
+        percentiles(latencies[last:]))
+    return len(latencies)
+
+def queue_length():
+    return backlog(r_server, args.queue)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    try:
+        classes, shares = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(e)
+
+    sizes = np.random.lognormal(np.log(1024*args.size_kb), args.size_sigma, args.corpus)
+    corpus = [ synthetic_jpeg(size, seed) for seed, size in enumerate(sizes) ]
+    print 'Synthetic corpus: {} images, median {:.0f} KB'.format(
+        len(corpus), np.median([ len(jpeg) for jpeg in corpus ])/1024)
+
+    server = ImageServer(('', args.port), ImageHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    r_server = redis.StrictRedis(args.redis_server, args.redis_port)
+    tracker = Tracker(r_server).start()
+    requests_queue = Queue.Queue(maxsize=args.concurrency)
+    for _ in range(args.concurrency):
+        thread = threading.Thread(target=sender, args=(requests_queue,))
+        thread.daemon = True
+        thread.start()
+
+    group = 'web' if args.mode == 'classify_url' else 'loadtest'
+    per_request = 1 if args.mode == 'classify_url' else args.list_size
+    started = next_report = time.time()
+    next_report += args.report_interval
+    last = 0
+    image = 0
+    sent_requests = 0
+    next_arrival = started
+    while time.time() < started + args.duration:
+        now = time.time()
+        if now >= next_report:
+            last = report(started, last, sent_requests)
+            next_report += args.report_interval
+        if now < next_arrival:
+            time.sleep(min(next_arrival - now, next_report - now))
+            continue
+
+        urls = [ 'http://{}:{}/images/{}.jpg?{}'.format(args.host, args.port, (image + i) % args.corpus, image + i)
+                 for i in range(per_request) ]
+        image += per_request
+        keys = [ 'archive:{}:{}'.format(group, url) for url in urls ]
+        # The web demo sends single images as interactive.
+        priority = 'interactive' if args.mode == 'classify_url' else \
+            classes[min(np.searchsorted(shares, random.random(), side='right'), len(classes) - 1)]
+        for key in keys:
+            tracker.expect(key, priority)
+        # Blocks when --concurrency requests are in flight, which shows as lost arrival rate.
+        requests_queue.put((urls, keys, priority))
+        sent_requests += 1
+        next_arrival += random.expovariate(args.rate)
+
+    sent = image
+    stopped = time.time()
+    elapsed = stopped - started
+    print 'Sent {} images in {:.0f}s ({:.2f} images/s), {:.2f} requests/s of the {:.2f}/s target'.format(
+        sent, elapsed, sent/elapsed, sent_requests/elapsed, args.rate)
+    drain_until = time.time() + args.drain
+    while time.time() < drain_until and tracker.snapshot()[0]:
+        time.sleep(args.report_interval)
+        last = report(started, last, sent_requests, stopped)
+
+    outstanding, latencies, failed = tracker.snapshot()
+    print 'Done: {} of {} images classified, {} failed, {} outstanding. Latency {}'.format(
+        len(latencies), sent, failed, outstanding, percentiles(latencies))
+    for priority, class_latencies in sorted(tracker.by_class().items()):
+        print '    {:12} {:6} classified, latency {}'.format(priority, len(class_latencies), percentiles(class_latencies))
+    server.shutdown()
@@ -0,0 +1,234 @@
+# The software includes elements of example code. Copyright 2015 Google, Inc. Licensed under Apache License, Version 2.0.
+# https://www.tensorflow.org/versions/r0.7/tutorials/image_recognition/index.html
+
+'''
+Runs any number of transfer learned classifiers on top of a single Inception model.
+The input of each classifier is wired to the next-to-last layer when the graphs are
+loaded, so one forward pass computes the features once and all the classifiers on them.
+The predictions of every classifier are stored in one result, as a JSON object in its
+'heads' field, and those of the first classifier in its 'predictions' field as well.
+'''
+
+import os
+import sys
+import logging
+import time
+import json
+from collections import namedtuple
+import argparse
+import signal
+
+import tensorflow.python.platform
+import numpy as np
+import tensorflow as tf
+import redis
+
+from utils import load_graph, maybe_download_and_extract
+
+# The queue handling is shared with the web demo workers.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web_demo'))
+from prefetch import Prefetcher, record_timings
+from scheduling import FairScheduler, check_deadline
+from batching import count_processed
+from metrics import Metrics
+from jpegutil import to_jpeg
+from notify import notify_done
+import inflight
+from prediction_cache import PredictionCache
+import protocol
+import vectors
+
+parser = argparse.ArgumentParser(description='''Listens to a redis list, downloads
+the image and feeds it to the Inception model. The next-to-last layer output is the input
+to all the given classifiers.''', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument(
+    '--head',
+    help='A transfer learned model, given as its name, model path and mapping path. Repeat for each model.',
+    nargs=3,
+    metavar=('NAME', 'CLASSIFIER', 'MAPPING'),
+    action='append',
+    required=True)
+parser.add_argument(
+    '--model_dir',
+    help='Path to Inception model, will be downloaded if not present.',
+    default='/tmp/imagenet')
+parser.add_argument(
+    '--num_top_predictions',
+    help='Display this many predictions per model.',
+    type=int,
+    default=5)
+parser.add_argument(
+    '--redis_server',
+    default='localhost')
+parser.add_argument(
+    '--redis_port',
+    type=int,
+    default=6379)
+parser.add_argument(
+    '--redis_queue',
+    help='Redis queue to read images from',
+    default='classify')
+parser.add_argument(
+    '--mem_ratio',
+    help='Ratio of memory to reserve on the GPU instance',
+    type=float,
+    default=.95)
+parser.add_argument(
+    '--fetch_concurrency',
+    help='Number of images to download in parallel',
+    type=int,
+    default=16)
+parser.add_argument(
+    '--fetch_per_host',
+    help='Maximum number of parallel downloads from the same host',
+    type=int,
+    default=4)
+parser.add_argument(
+    '--fetch_timeout',
+    help='Timeout in seconds for downloading an image',
+    type=float,
+    default=10)
+parser.add_argument(
+    '--prefetch_queue_size',
+    help='Maximum number of downloaded images waiting for inference',
+    type=int,
+    default=64)
+parser.add_argument(
+    '--cache_size',
+    help='Number of predictions to cache in process, 0 disables the cache',
+    type=int,
+    default=10000)
+parser.add_argument(
+    '--cache_ttl',
+    help='Seconds to keep predictions in the in-process cache',
+    type=int,
+    default=3600)
+parser.add_argument(
+    '--cache_redis_ttl',
+    help='Seconds to keep predictions in the shared redis cache, 0 disables it',
+    type=int,
+    default=86400)
+
+Specs = namedtuple('Specs', 'group path ad_id res_q queued_at deadline priority')
+Result = namedtuple('Result', 'OK predictions computation_time path')
+Head = namedtuple('Head', 'name output mapping')
+
+def load_heads(sess, heads):
+    '''Loads Inception and the heads, given as (name, classifier, mapping) triples. Each
+    head is imported under its own name, with its input replaced by the Inception features.'''
+    load_graph(os.path.join(args.model_dir, 'classify_image_graph_def.pb'))
+    inception_next_last_layer = sess.graph.get_tensor_by_name('pool_3:0')
+    features = tf.reshape(inception_next_last_layer, [-1, 2048])
+
+    loaded = []
+    for name, classifier, mapping_path in heads:
+        load_graph(classifier, name=name, input_map={'input:0': features})
+        with open(mapping_path) as f:
+            mapping = json.load(f)
+        loaded.append(Head(name, sess.graph.get_tensor_by_name('{}/output:0'.format(name)), mapping))
+
+    return inception_next_last_layer, loaded
+
+def top_predictions(head, predictions):
+    predictions = np.squeeze(predictions)
+    top_k = predictions.argsort()[-args.num_top_predictions:][::-1]
+    return [ (head.mapping[str(node_id)], float(predictions[node_id])) for node_id in top_k ]
+
+def classify_images():
+    gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=args.mem_ratio)
+    with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
+        inception_next_last_layer, heads = load_heads(sess, args.head)
+        fetches = [ inception_next_last_layer ] + [ head.output for head in heads ]
+        logging.info('Loaded {} classifiers: {}'.format(len(heads), ', '.join([ head.name for head in heads ])))
+
+        r_server = redis.StrictRedis(args.redis_server, args.redis_port)
+
+        namespace = 'heads:' + ','.join(sorted([ head.name for head in heads ]))
+        cache = PredictionCache(r_server, namespace, args.cache_size,
+                                args.cache_ttl, args.cache_redis_ttl) if args.cache_size else None
+        prefetcher = Prefetcher(r_server, args.redis_queue,
+                                lambda value: [ Specs(**task) for task in protocol.loads(value, 'task') ],
+                                concurrency=args.fetch_concurrency, per_host=args.fetch_per_host,
+                                timeout=args.fetch_timeout, max_queued=args.prefetch_queue_size,
+                                cache=cache, scheduler=FairScheduler(r_server, args.redis_queue)).start()
+        timings = Metrics(r_server, 'multi_head_classifier')
+
+        # The supervisor asks for a drain with SIGUSR1, the prefetched tasks go back to redis.
+        signal.signal(signal.SIGUSR1, lambda *_: prefetcher.stop())
+
+        while not prefetcher.draining:
+            batch = prefetcher.get_batch()
+            if not batch:
+                continue
+            fetched, = batch
+            # Every task taken off the queue counts, whatever comes of it.
+            count_processed(r_server, args.redis_queue, len(batch))
+            specs = fetched.specs
+            if specs is None:
+                logging.error('Could not parse task {}: {}'.format(fetched.task, fetched.error))
+                continue
+            logging.info(specs)
+            record_timings(timings, fetched, time.time())
+            result_key = 'archive:{}:{}'.format(specs.group, specs.path)
+            try:
+                if fetched.error is not None:
+                    raise fetched.error
+                # The image may have waited for inference past the deadline.
+                check_deadline(specs)
+                if fetched.cached is not None:
+                    result = Result(True, fetched.cached.predictions, 0., specs.path)
+                    hidden_layer = fetched.cached.hidden
+                else:
+                    starttime = time.time()
+                    # One run: the features are computed once and fed to every head.
+                    outputs = sess.run(fetches, {'DecodeJpeg/contents:0': to_jpeg(fetched.content)})
+                    hidden_layer = outputs[0]
+                    predictions = dict((head.name, top_predictions(head, output))
+                                       for head, output in zip(heads, outputs[1:]))
+
+                    result = Result(True, predictions, time.time() - starttime, specs.path)
+                    timings.record('inference', result.computation_time)
+
+                    if cache is not None:
+                        cache.store(specs.path, fetched.digest, result.predictions, hidden_layer)
+
+                # The web demo reads the predictions as the list of the other workers.
+                value = result._asdict()
+                value['predictions'] = result.predictions[heads[0].name]
+                value['heads'] = json.dumps(result.predictions, ensure_ascii=False)
+                with timings.time('write'):
+                    r_server.hmset(result_key, value)
+                    notify_done(r_server, result_key)
+
+                # The requests for the same image that came while it was in flight get it too.
+                res_qs = inflight.release(r_server, args.redis_queue, specs).res_qs
+                if res_qs:
+                    json_blob = {
+                        'predictions': result.predictions,
+                        'path': specs.path,
+                        'hidden_states': vectors.encode(hidden_layer, 'blosc')
+                    }
+                    blob = json.dumps(json_blob, ensure_ascii=False, encoding="utf-8")
+                    for res_q in res_qs:
+                        r_server.rpush(res_q, blob)
+
+                logging.info(result)
+            except Exception as e:
+                logging.error('Something went wrong when classifying the image: {}'.format(e))
+                r_server.hmset(result_key, {'OK': False})
+                notify_done(r_server, result_key)
+                inflight.release(r_server, args.redis_queue, specs)
+
+        prefetcher.drain(lambda batch: protocol.dumps_batch('task', [ specs._asdict() for specs in batch ]))
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO)
+
+    names = [ name for name, _, _ in args.head ]
+    if len(set(names)) < len(names):
+        parser.error('The classifier names must be unique')
+
+    maybe_download_and_extract(args.model_dir)
+    classify_images()
@@ -0,0 +1,259 @@
+'''
+Starts and stops worker processes to follow the length of a redis work queue. The
+workers count the tasks they finish in the workers:<queue>:processed hash, which gives
+the throughput of each worker. The number of workers is set so the backlog is worked
+off within --drain_time seconds, within [--min_workers, --max_workers]. Workers that
+exit on their own are restarted. Workers are stopped with SIGUSR1, on which they push
+the tasks they hold back on the queue and exit, and only terminated if they have not
+exited after --grace seconds. The backlog counts the tasks of all the priority
+classes of the queue, see web_demo/scheduling.py.
+
+The decisions are written to the supervisor:<queue> hash, and the latest ones to the
+supervisor:<queue>:decisions list.
+
+Run a worker command after --, e.g. on the CPU:
+
+    python supervisor.py --queue classify --max_workers 4 -- python ../web_demo/tf_worker.py
+'''
+
+from __future__ import division
+import argparse
+import json
+import logging
+import math
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web_demo'))
+from batching import PROCESSED
+from scheduling import backlog
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    'worker',
+    help='Command that starts a worker',
+    nargs=argparse.REMAINDER)
+parser.add_argument(
+    '--queue',
+    help='Redis queue the workers read from',
+    default='classify')
+parser.add_argument(
+    '--redis_server',
+    default='localhost')
+parser.add_argument(
+    '--redis_port',
+    type=int,
+    default=6379)
+parser.add_argument(
+    '--min_workers',
+    type=int,
+    default=1)
+parser.add_argument(
+    '--max_workers',
+    type=int,
+    default=12)
+parser.add_argument(
+    '--interval',
+    help='Seconds between decisions',
+    type=float,
+    default=10)
+parser.add_argument(
+    '--drain_time',
+    help='Seconds the workers should need to empty the queue',
+    type=float,
+    default=60)
+parser.add_argument(
+    '--warmup',
+    help='Seconds a new worker gets to load its model before its throughput counts',
+    type=float,
+    default=60)
+parser.add_argument(
+    '--cooldown',
+    help='Seconds after starting a worker before any worker is retired',
+    type=float,
+    default=300)
+parser.add_argument(
+    '--grace',
+    help='Seconds a worker gets to push its tasks back and exit before it is terminated',
+    type=float,
+    default=60)
+parser.add_argument(
+    '--gpus',
+    help='GPUs to spread the workers over, the workers inherit CUDA_VISIBLE_DEVICES if not given',
+    nargs='*',
+    default=[])
+parser.add_argument(
+    '--memory_flag',
+    help='Flag of the worker that sets its share of GPU memory, e.g. --gpu_memory_fraction. '
+    'The share is set from the most workers a GPU can get.')
+
+class Worker(object):
+
+    def __init__(self, command, gpu=None):
+        env = dict(os.environ)
+        if gpu is not None:
+            env['CUDA_VISIBLE_DEVICES'] = str(gpu)
+        self.process = subprocess.Popen(command, env=env)
+        self.gpu = gpu
+        self.started = time.time()
+        self.id = '{}:{}'.format(socket.gethostname(), self.process.pid)
+
+class Supervisor(object):
+
+    def __init__(self, r_server, queue, command, min_workers=1, max_workers=12, drain_time=60,
+                 warmup=60, cooldown=300, gpus=(), memory_flag=None, grace=60):
+        self.red = r_server
+        self.queue = queue
+        self.command = list(command)
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.drain_time = drain_time
+        self.warmup = warmup
+        self.cooldown = cooldown
+        self.grace = grace
+        self.gpus = list(gpus)
+        self.workers = []
+        self.counts = {}
+        self.last_check = time.time()
+        self.last_spawn = 0
+        self.spawned = self.retired = self.restarts = 0
+        self.metrics = 'supervisor:{}'.format(queue)
+
+        if memory_flag and self.gpus:
+            per_gpu = int(math.ceil(max_workers/len(self.gpus)))
+            self.command += [ memory_flag, str(round(.95/per_gpu, 3)) ]
+
+    def spawn(self, gpu=None):
+        if gpu is None and self.gpus:
+            gpu = min(self.gpus, key=lambda g: len([ w for w in self.workers if w.gpu == g ]))
+        worker = Worker(self.command, gpu)
+        self.workers.append(worker)
+        self.spawned += 1
+        self.last_spawn = time.time()
+        logging.info('Started worker {} on GPU {}'.format(worker.id, gpu))
+
+    def retire(self):
+        # The newest worker has done the least warming up.
+        self.stop([ self.workers.pop() ])
+
+    def stop(self, workers):
+        '''Asks the workers to drain, and terminates those still running after the grace period.'''
+        for worker in workers:
+            if worker.process.poll() is None:
+                worker.process.send_signal(signal.SIGUSR1)
+        deadline = time.time() + self.grace
+        while time.time() < deadline and any([ worker.process.poll() is None for worker in workers ]):
+            time.sleep(.1)
+        for worker in workers:
+            if worker.process.poll() is None:
+                logging.warning('Worker {} did not drain within {}s, terminating it'.format(worker.id, self.grace))
+                worker.process.terminate()
+            worker.process.wait()
+            self.retired += 1
+            logging.info('Retired worker {}'.format(worker.id))
+
+    def restart_crashed(self):
+        for worker in list(self.workers):
+            if worker.process.poll() is not None:
+                logging.warning('Worker {} exited with {}, restarting it'.format(worker.id, worker.process.returncode))
+                self.workers.remove(worker)
+                self.red.hdel(PROCESSED.format(self.queue), worker.id)
+                self.restarts += 1
+                self.spawn(worker.gpu)
+
+    def throughput(self):
+        '''Mean tasks per second of the warmed up workers since the last check, None
+        if there are none.'''
+        now = time.time()
+        elapsed = max(now - self.last_check, 1e-9)
+        processed = self.red.hgetall(PROCESSED.format(self.queue))
+        rates = []
+        for worker in self.workers:
+            count = int(processed.get(worker.id, 0))
+            if now - worker.started > self.warmup and worker.id in self.counts:
+                rates.append((count - self.counts[worker.id])/elapsed)
+            self.counts[worker.id] = count
+        self.last_check = now
+        return sum(rates)/len(rates) if rates else None
+
+    def desired(self, depth, rate):
+        current = len(self.workers)
+        if depth == 0:
+            wanted = self.min_workers
+        elif rate:
+            wanted = int(math.ceil(depth/(rate*self.drain_time)))
+        elif all([ time.time() - w.started > self.warmup for w in self.workers ]):
+            # A backlog and no progress: the workers are stuck or there are none.
+            wanted = current + 1
+        else:
+            wanted = current
+        return max(self.min_workers, min(self.max_workers, wanted))
+
+    def depth(self):
+        '''Tasks waiting in all the priority classes of the queue.'''
+        return backlog(self.red, self.queue)
+
+    def step(self):
+        self.restart_crashed()
+        depth = self.depth()
+        rate = self.throughput()
+        wanted = self.desired(depth, rate)
+
+        action = 'hold'
+        if wanted > len(self.workers):
+            action = 'spawn {}'.format(wanted - len(self.workers))
+            while len(self.workers) < wanted:
+                self.spawn()
+        elif wanted < len(self.workers) and time.time() - self.last_spawn > self.cooldown:
+            # Scale down slowly, the backlog often comes back.
+            action = 'retire 1'
+            self.retire()
+
+        decision = { 'time': time.time(), 'depth': depth, 'rate_per_worker': rate,
+                     'desired': wanted, 'workers': len(self.workers), 'action': action }
+        logging.info('Supervisor: {}'.format(decision))
+
+        pipe = self.red.pipeline()
+        pipe.hmset(self.metrics, dict(decision, rate_per_worker=rate or 0, spawned=self.spawned,
+                                      retired=self.retired, restarts=self.restarts))
+        pipe.lpush('{}:decisions'.format(self.metrics), json.dumps(decision))
+        pipe.ltrim('{}:decisions'.format(self.metrics), 0, 999)
+        pipe.execute()
+        return decision
+
+    def run(self, interval):
+        while len(self.workers) < self.min_workers:
+            self.spawn()
+        try:
+            while True:
+                time.sleep(interval)
+                self.step()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        workers, self.workers = self.workers, []
+        self.stop(workers)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(format='%(asctime)s %(message)s')
+
+    command = args.worker[1:] if args.worker[:1] == ['--'] else args.worker
+    if not command:
+        parser.error('Give the command that starts a worker after --')
+
+    # Lets the workers be stopped with the supervisor.
+    signal.signal(signal.SIGTERM, lambda *_: exit(0))
+
+    supervisor = Supervisor(redis.StrictRedis(args.redis_server, args.redis_port), args.queue, command,
+                            args.min_workers, args.max_workers, args.drain_time, args.warmup,
+                            args.cooldown, args.gpus, args.memory_flag, args.grace)
+    supervisor.run(args.interval)
@@ -8,23 +8,20 @@ import sys
 import tarfile
 import cStringIO as StringIO
 import logging
-import cPickle as pickle
 import os
 import time
 import glob
 import json
 from collections import namedtuple
-import tempfile
-from contextlib import contextmanager
 import time
 import math
+import argparse
+import signal
 
 import tensorflow.python.platform
 import numpy as np
 import tensorflow as tf
 import redis
-import requests
-from wand.image import Image
 from ast import literal_eval as make_tuple
 from tensorflow.python.platform import gfile
 import blosc
@@ -32,6 +29,19 @@ import blosc
 from aqbc_utils import hash_bottlenecks
 from utils import load_graph, maybe_download_and_extract
 
+# The queue handling is shared with the web demo workers.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web_demo'))
+from prefetch import Prefetcher, record_timings
+from scheduling import FairScheduler, check_deadline
+from batching import count_processed
+from metrics import Metrics
+from jpegutil import to_jpeg
+from notify import notify_done
+import inflight
+from prediction_cache import PredictionCache
+import protocol
+import vectors
+
 parser = argparse.ArgumentParser(description='''Listens to a redis list, downloads
 the image and feeds it to the Inception model. Uses the next-to-last layer output as input
 to a classifier.''', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -67,28 +77,57 @@ parser.add_argument(
     help='Ratio of memory to reserve on the GPU instance',
     type=float,
     default=.95)
+parser.add_argument(
+    '--hashing',
+    help='Store AQBC hash codes of the hidden layer, requires a rotation matrix at <hashing:R>',
+    action='store_true')
+parser.add_argument(
+    '--fetch_concurrency',
+    help='Number of images to download in parallel',
+    type=int,
+    default=16)
+parser.add_argument(
+    '--fetch_per_host',
+    help='Maximum number of parallel downloads from the same host',
+    type=int,
+    default=4)
+parser.add_argument(
+    '--fetch_timeout',
+    help='Timeout in seconds for downloading an image',
+    type=float,
+    default=10)
+parser.add_argument(
+    '--prefetch_queue_size',
+    help='Maximum number of downloaded images waiting for inference',
+    type=int,
+    default=64)
+parser.add_argument(
+    '--cache_size',
+    help='Number of predictions to cache in process, 0 disables the cache',
+    type=int,
+    default=10000)
+parser.add_argument(
+    '--cache_ttl',
+    help='Seconds to keep predictions in the in-process cache',
+    type=int,
+    default=3600)
+parser.add_argument(
+    '--cache_redis_ttl',
+    help='Seconds to keep predictions in the shared redis cache, 0 disables it',
+    type=int,
+    default=86400)
+parser.add_argument(
+    '--vector_format',
+    help='Encoding of the pool_3 vectors in the archive, see web_demo/vectors.py. The result queue always gets blosc.',
+    choices=vectors.FORMATS,
+    default='float16')
 args = parser.parse_args()
 
-Task = namedtuple('Task', 'queue value')
-Specs = namedtuple('Specs', 'group path res_q')
+Specs = namedtuple('Specs', 'group path ad_id res_q queued_at deadline priority')
 Result = namedtuple('Result', 'OK predictions computation_time path')
 
 logging.getLogger().setLevel(logging.INFO)
 
-@contextmanager
-def convert_to_jpg(data):
-    tmp = tempfile.NamedTemporaryFile(delete=False)
-
-    with Image(file=StringIO.StringIO(data)) as img:
-        if img.format != 'JPEG':
-            logging.info('Converting {} to JPEG.'.format(img.format))
-            img.format = 'JPEG'
-            img.save(tmp)
-
-    tmp.close()
-    yield tmp.name
-    os.remove(tmp.name)
-
         
 def classify_images(mapping):
     gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=args.mem_ratio)
@@ -113,69 +152,117 @@ def classify_images(mapping):
                 R = R.reshape(2048, bits)
                 R = np.transpose(R)
 
-        while True:
-            task = Task(*r_server.brpop(args.redis_queue))
-            specs = Specs(**pickle.loads(task.value))
+        cache = PredictionCache(r_server, os.path.basename(args.classifier), args.cache_size,
+                                args.cache_ttl, args.cache_redis_ttl) if args.cache_size else None
+        prefetcher = Prefetcher(r_server, args.redis_queue,
+                                lambda value: [ Specs(**task) for task in protocol.loads(value, 'task') ],
+                                concurrency=args.fetch_concurrency, per_host=args.fetch_per_host,
+                                timeout=args.fetch_timeout, max_queued=args.prefetch_queue_size,
+                                cache=cache, scheduler=FairScheduler(r_server, args.redis_queue)).start()
+        timings = Metrics(r_server, 'transfer_classifier')
+
+        # The supervisor asks for a drain with SIGUSR1, the prefetched tasks go back to redis.
+        signal.signal(signal.SIGUSR1, lambda *_: prefetcher.stop())
+
+        while not prefetcher.draining:
+            batch = prefetcher.get_batch()
+            if not batch:
+                continue
+            fetched, = batch
+            # Every task taken off the queue counts, whatever comes of it.
+            count_processed(r_server, args.redis_queue, len(batch))
+            specs = fetched.specs
+            if specs is None:
+                logging.error('Could not parse task {}: {}'.format(fetched.task, fetched.error))
+                continue
             logging.info(specs)
+            record_timings(timings, fetched, time.time())
             result_key = 'archive:{}:{}'.format(specs.group, specs.path)
             try:
-                response = requests.get(specs.path, timeout=10)
-                with convert_to_jpg(response.content) as jpg:
-                    image_data = gfile.FastGFile(jpg).read()
-
-                starttime = time.time()
-                hidden_layer = sess.run(inception_next_last_layer,
-                                        {'DecodeJpeg/contents:0': image_data})
-
-                predictions = sess.run(transfer_predictor, {'input:0': np.atleast_2d(np.squeeze(hidden_layer)) })
-                predictions = np.squeeze(predictions)
-                top_k = predictions.argsort()[-args.num_top_predictions:][::-1]
-
-                endtime = time.time()
-
-                result = Result(True,
-                                [ (mapping[str(node_id)], predictions[node_id]) for node_id in top_k ],
-                                endtime - starttime,
-                                specs.path)
+                if fetched.error is not None:
+                    raise fetched.error
+                # The image may have waited for inference past the deadline.
+                check_deadline(specs)
+                if fetched.cached is not None:
+                    result = Result(True, fetched.cached.predictions, 0., specs.path)
+                    hidden_layer = fetched.cached.hidden
+                else:
+                    with timings.time('decode'):
+                        image_data = to_jpeg(fetched.content)
+
+                    starttime = time.time()
+                    hidden_layer = sess.run(inception_next_last_layer,
+                                            {'DecodeJpeg/contents:0': image_data})
+
+                    predictions = sess.run(transfer_predictor, {'input:0': np.atleast_2d(np.squeeze(hidden_layer)) })
+                    predictions = np.squeeze(predictions)
+                    top_k = predictions.argsort()[-args.num_top_predictions:][::-1]
+
+                    endtime = time.time()
+                    timings.record('inference', endtime - starttime)
+
+                    result = Result(True,
+                                    [ (mapping[str(node_id)], predictions[node_id]) for node_id in top_k ],
+                                    endtime - starttime,
+                                    specs.path)
+
+                    if cache is not None:
+                        cache.store(specs.path, fetched.digest, result.predictions, hidden_layer)
 
                 value = result._asdict()
 
+                write_started = time.time()
                 hidden_layer = hidden_layer.reshape(2048,1)
-                h_s_packed = blosc.compress(hidden_layer.tostring(), typesize=8, cname='zlib')
+                h_s_stored = vectors.encode(hidden_layer, args.vector_format)
                 
                 if args.hashing:
                     _, c = hash_bottlenecks(R, hidden_layer)
-                    r_server.hmset("hashing:codes:" + c[0].bin, {result_key: h_s_packed} )
+                    r_server.hmset("hashing:codes:" + c[0].bin, {result_key: h_s_stored} )
                     value['hash'] = c[0].bin
 
                 r_server.hmset(result_key, value)
+                notify_done(r_server, result_key)
 
                 # for demo
                 last_key = 'archive:{}:{}'.format(specs.group, 'lastprediction')
                 r_server.hmset(last_key, result._asdict())
+                notify_done(r_server, last_key)
 
                 r_server.hset('archive:{}:category:{}'.format(specs.group, result.predictions[0][0]),
-                              specs.path, h_s_packed)
+                              specs.path, h_s_stored)
+                publish_started = time.time()
+                timings.record('write', publish_started - write_started)
+                # Keeps the similarity index of the web demo up to date.
+                r_server.publish('latest', protocol.dumps('latest', {'path': specs.path, 'group': specs.group,
+                                                                     'category': result.predictions[0][0],
+                                                                     'value': float(result.predictions[0][1])}))
 
                 # push result on result queue
                 preds = {}
-                for node_id in top_k:
-                    preds[str(mapping[str(node_id)])] = str(predictions[node_id])
+                for label, probability in result.predictions:
+                    preds[str(label)] = str(probability)
 
                 json_blob = {
                     'predictions':preds,
                     'path':specs.path,
-                    'hidden_states':h_s_packed
+                    'hidden_states':vectors.encode(hidden_layer, 'blosc')
                 }
 
-                if specs.res_q != "":
-                    r_server.rpush(specs.res_q, json.dumps(json_blob, ensure_ascii=False, encoding="utf-8"))
+                # The requests for the same image that came while it was in flight get it too.
+                blob = json.dumps(json_blob, ensure_ascii=False, encoding="utf-8")
+                for res_q in inflight.release(r_server, args.redis_queue, specs).res_qs:
+                    r_server.rpush(res_q, blob)
+                timings.record('publish', time.time() - publish_started)
 
                 logging.info(result)
             except Exception as e:
                 print "exception*****************", e
                 logging.error('Something went wrong when classifying the image: {}'.format(e))
-                  r_server.hmset(result_key, {'OK': False})
+                r_server.hmset(result_key, {'OK': False})
+                notify_done(r_server, result_key)
+                inflight.release(r_server, args.redis_queue, specs)
+
+        prefetcher.drain(lambda batch: protocol.dumps_batch('task', [ specs._asdict() for specs in batch ]))
 
 def send_kaidee_data(r_server, specs, result):
 
@@ -188,9 +275,9 @@ def send_kaidee_data(r_server, specs, result):
     r_server.hmset(kaidee_result_key, result._asdict())
 
     # Publish predictions result to classify channel via Redis PubSub
-    predictions_dict = dict((x, y) for x, y in result.predictions)
-    r_server.publish('classify', pickle.dumps({'path': specs.path, 'group': specs.group,
-                                             'predictions': predictions_dict}))
+    predictions_dict = dict((x, float(y)) for x, y in result.predictions)
+    protocol.publish_classify(r_server, {'path': specs.path, 'group': specs.group,
+                                         'predictions': predictions_dict})
 
 
 if __name__ == '__main__':
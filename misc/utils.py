@@ -50,16 +50,17 @@ def pretty_float(f):
     return '{0:.2f}'.format(f)
 
 
-def load_graph(path):
+def load_graph(path, name='', input_map=None):
     from tensorflow.python.platform import gfile
     import tensorflow as tf
     
-    """"Creates a graph from saved GraphDef file and returns a saver."""
+    """"Creates a graph from saved GraphDef file and returns a saver. The nodes are
+    prefixed with name, and input_map replaces inputs of the graph with existing tensors."""
     # Creates graph from saved graph_def.pb.
     with gfile.FastGFile(path, 'r') as f:
         graph_def = tf.GraphDef()
         graph_def.ParseFromString(f.read())
-        _ = tf.import_graph_def(graph_def, name='')
+        _ = tf.import_graph_def(graph_def, input_map=input_map, name=name)
 
 
 def maybe_download_and_extract(model_dir):
@@ -3,16 +3,28 @@
 import argparse
 import cStringIO as StringIO
 import json
-import base64
+import threading
+import time
+import uuid
+import logging
+from collections import deque
+from datetime import timedelta
 
-import flask
 import redis
-import requests
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+import tornado.web
 from wand.image import Image
 
-parser = argparse.ArgumentParser(description='''RESTful API service for image recognition. Note: this is a
-minimal light-weight server that must not be used in production.''',
+from queues import connect, BACKENDS
+from transport import make_transport, STORES
+
+parser = argparse.ArgumentParser(description='''RESTful API service for image recognition. Requests are
+served asynchronously: resizing runs in a pool of threads, and a single thread waits for the results
+of all the pending requests.''',
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument(
     '--port',
@@ -28,50 +40,229 @@ parser.add_argument(
     default='6379')
 parser.add_argument(
     '--redis_prefix',
-    help='Prefix name of redis list to write results in, the message UUID will be appended to this string',
+    help='Prefix name of the redis list the results of this process are pushed on',
     default='imgrec_')
 parser.add_argument(
     '--queue',
     help='SQS queue to post image classification tasks to',
     default='classify')
+parser.add_argument(
+    '--queue_backend',
+    help='Where to queue the tasks. Use redis to run without AWS',
+    choices=BACKENDS,
+    default='sqs')
+parser.add_argument(
+    '--blob_store',
+    help='Where to put images of at least --inline_threshold bytes instead of in the message',
+    choices=STORES,
+    default='none')
+parser.add_argument(
+    '--blob_dir',
+    help='Shared directory of the directory blob store',
+    default='/tmp/imgblobs')
+parser.add_argument(
+    '--blob_ttl',
+    help='Seconds to keep images in the blob store',
+    type=int,
+    default=600)
+parser.add_argument(
+    '--inline_threshold',
+    help='Images smaller than this many bytes are sent in the message',
+    type=int,
+    default=32768)
 parser.add_argument(
     '--timeout',
     help='How long to wait before failing to download in image',
     type=int,
     default=10)
-args = parser.parse_args()
-
-app = flask.Flask(__name__)
+parser.add_argument(
+    '--result_timeout',
+    help='How many seconds to wait for a classification',
+    type=int,
+    default=60)
+parser.add_argument(
+    '--workers',
+    help='Number of threads resizing images and sending tasks',
+    type=int,
+    default=8)
+parser.add_argument(
+    '--max_downloads',
+    help='Maximum number of simultaneous image downloads',
+    type=int,
+    default=1000)
 
 def resize_encode(data):
     with Image(file=StringIO.StringIO(data)) as img:
         img.resize(299,299) # Tensorflow defaults. Speed gains here.
-        encoded = base64.b64encode(img.make_blob())
+        blob = img.make_blob()
+
+    return transport.encode(blob, dispatcher.replies)
+
+class ResultDispatcher(object):
+    '''The classifiers push the results of the requests of this process on one reply
+    list, named in the task messages, as JSON [message id, result] pairs. A single thread
+    waits on it with BLPOP, and resolves the future of a request on the IOLoop by its
+    message id. A result may arrive before its request waits for it, it is kept for ttl
+    seconds. Results that arrive after their request timed out are dropped.'''
+
+    def __init__(self, r_server, io_loop, poll=1, ttl=60):
+        self.red = r_server
+        self.io_loop = io_loop
+        self.poll = poll
+        self.ttl = ttl
+        self.pending = {}
+        self.early = {}
+        self.replies = '{}replies:{}'.format(args.redis_prefix, uuid.uuid4())
+        self._lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def wait(self, message_id):
+        future = Future()
+        with self._lock:
+            early = self.early.pop(message_id, None)
+            if early is None:
+                self.pending[message_id] = future
+        if early is not None:
+            future.set_result(early[1])
+        return future
 
-    return encoded
+    def cancel(self, message_id):
+        with self._lock:
+            self.pending.pop(message_id, None)
+
+    def _run(self):
+        while True:
+            try:
+                popped = self.red.blpop(self.replies, timeout=self.poll)
+                self._expire()
+                if popped is None:
+                    continue
+                message_id, result = json.loads(popped[1])
+                value = json.dumps(result)
+                with self._lock:
+                    future = self.pending.pop(message_id, None)
+                    if future is None:
+                        self.early[message_id] = (time.time(), value)
+                if future is not None:
+                    self.io_loop.add_callback(future.set_result, value)
+            except Exception as e:
+                logging.error('Result dispatcher: {}'.format(e))
+                time.sleep(self.poll)
+
+    def _expire(self):
+        now = time.time()
+        with self._lock:
+            for message_id, (received, _) in self.early.items():
+                if now - received > self.ttl:
+                    del self.early[message_id]
+
+class LatencyStats(object):
+    '''Latencies of the last size requests.'''
+
+    def __init__(self, size=10000):
+        self.latencies = deque(maxlen=size)
+        self.in_flight = 0
+        self.completed = 0
+        self.errors = 0
+
+    def add(self, latency, error=False):
+        self.latencies.append(latency)
+        self.completed += 1
+        self.errors += error
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(q/100.*len(latencies)))]
+
+    def summary(self):
+        return { 'in_flight': self.in_flight,
+                 'completed': self.completed,
+                 'errors': self.errors,
+                 'p50_ms': self._ms(self.percentile(50)),
+                 'p99_ms': self._ms(self.percentile(99)) }
+
+    @staticmethod
+    def _ms(seconds):
+        return None if seconds is None else int(1000*seconds)
+
+@gen.coroutine
+def classify(data):
+    body = yield executor.submit(resize_encode, data)
+    message_id = yield executor.submit(queue.send, body)
 
-@app.route('/classify/<path:url>')
-def classify(url):
     try:
-        response = requests.get(url, timeout=args.timeout)
-        jpeg_base64 = resize_encode(response.content)
-        dispatch = queue.send_message(MessageBody=json.dumps({'image': {'data_uri': 'data:image/jpg;base64,{}'.format(jpeg_base64)}}))
-
-        listname = '{}{}'.format(args.redis_prefix, dispatch['MessageId'])
-        _, result = redis.blpop(listname)
-        redis.delete(listname)
-    except Exception as e:
-        result = { 'status': 'error',
-                   'message': str(e) }
-    return result
-
-redis = redis.StrictRedis(args.redis_server, args.redis_port)
-sqs = boto3.resource('sqs')
-
-try:
-    queue = sqs.get_queue_by_name(QueueName=args.queue)
-except:
-    print 'The queue "{}" does not exist. It will be created.'.format(args.queue)
-    queue = sqs.create_queue(QueueName=args.queue)
-
-app.run(debug=True, host='0.0.0.0', port=args.port)
+        result = yield gen.with_timeout(timedelta(seconds=args.result_timeout), dispatcher.wait(message_id))
+    except gen.TimeoutError:
+        dispatcher.cancel(message_id)
+        raise Exception('No result after {} seconds'.format(args.result_timeout))
+    raise gen.Return(result)
+
+class ClassifyHandler(tornado.web.RequestHandler):
+    '''GET /classify/<url> downloads the image, POST /classify takes an upload, either
+    as the file field of a form or as the request body.'''
+
+    @gen.coroutine
+    def get(self, url):
+        if self.request.query:
+            url = '{}?{}'.format(url, self.request.query)
+        yield self.respond(self.download(url))
+
+    @gen.coroutine
+    def post(self):
+        files = self.request.files.get('file')
+        yield self.respond(gen.maybe_future(files[0]['body'] if files else self.request.body))
+
+    @gen.coroutine
+    def download(self, url):
+        response = yield AsyncHTTPClient().fetch(url, request_timeout=args.timeout)
+        raise gen.Return(response.body)
+
+    @gen.coroutine
+    def respond(self, data):
+        t0 = time.time()
+        stats.in_flight += 1
+        error = False
+        try:
+            result = yield classify((yield data))
+        except Exception as e:
+            error = True
+            result = json.dumps({ 'status': 'error',
+                                  'message': str(e) })
+        finally:
+            stats.in_flight -= 1
+        stats.add(time.time() - t0, error)
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(result)
+
+class StatsHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        self.write(stats.summary())
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO)
+
+    redis = redis.StrictRedis(args.redis_server, args.redis_port)
+    queue = connect(args.queue_backend, args.queue, redis, create=True)
+    transport = make_transport(args.blob_store, redis, args.blob_dir, args.blob_ttl, args.inline_threshold)
+    executor = ThreadPoolExecutor(args.workers)
+    AsyncHTTPClient.configure(None, max_clients=args.max_downloads)
+    stats = LatencyStats()
+    dispatcher = ResultDispatcher(redis, IOLoop.current(), ttl=args.result_timeout).start()
+
+    app = tornado.web.Application([
+        (r'/classify/(.+)', ClassifyHandler),
+        (r'/classify', ClassifyHandler),
+        (r'/stats', StatsHandler),
+    ])
+    app.listen(args.port)
+    IOLoop.current().start()
@@ -0,0 +1,84 @@
+'''
+Offline benchmark of the classifier side of a queue: receiving and deleting one
+message at a time against batched receives and deletes. The local backend adds a fixed
+delay per request to stand in for the SQS round-trip, the redis backend uses a running
+redis server. Inference is simulated with a fixed time per image.
+'''
+
+from __future__ import division
+import argparse
+import json
+import time
+
+import redis
+
+from queues import LocalQueue, RedisQueue
+
+def consume(queue, total, batch_size, inference_time):
+    '''Returns the images per second and the queue requests per image.'''
+    done, requests = 0, 0
+    t0 = time.time()
+    while done < total:
+        messages = queue.receive(batch_size, 0)
+        requests += 1
+        if not messages:
+            continue
+        time.sleep(inference_time*len(messages))
+        if batch_size == 1:
+            for message in messages:
+                queue.delete([ message ])
+                requests += 1
+        else:
+            queue.delete(messages)
+            requests += 1
+        done += len(messages)
+    return total/(time.time() - t0), requests/total
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--backend',
+    help='Queue to benchmark',
+    choices=['local', 'redis'],
+    default='local')
+parser.add_argument(
+    '--latency',
+    help='Milliseconds per request of the local queue',
+    type=float,
+    default=20)
+parser.add_argument(
+    '--inference',
+    help='Milliseconds of simulated inference per image',
+    type=float,
+    default=10)
+parser.add_argument(
+    '--images',
+    help='Number of messages to consume',
+    type=int,
+    default=200)
+parser.add_argument(
+    '--redis_server',
+    default='localhost')
+parser.add_argument(
+    '--redis_port',
+    type=int,
+    default=6379)
+args = parser.parse_args()
+
+body = json.dumps({'image': {'data_uri': 'data:image/jpg;base64,{}'.format('A'*40000)}})
+
+for batch_size in [ 1, 10 ]:
+    if args.backend == 'local':
+        queue = LocalQueue()
+    else:
+        queue = RedisQueue(redis.StrictRedis(args.redis_server, args.redis_port), 'benchmark_queues')
+        queue.red.delete(queue.name, queue.inflight)
+
+    for _ in xrange(args.images):
+        queue.send(body)
+    if args.backend == 'local':
+        queue.latency = args.latency/1000
+        # Lets the feeder thread of the queue catch up.
+        time.sleep(.5)
+
+    rate, requests = consume(queue, args.images, batch_size, args.inference/1000)
+    print 'batch size {:>2}: {:>8.1f} images/s, {:.2f} queue requests per image'.format(batch_size, rate, requests)
@@ -0,0 +1,78 @@
+'''
+Benchmark of sending images inline in the message against by reference to a blob
+store. For each image size it reports the message size and the time spent per image
+by the API (encode) and by the classifier (decode and release).
+'''
+
+from __future__ import division
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import redis
+
+from transport import Transport, RedisBlobStore, DirectoryBlobStore
+
+def timed(transport, data, repeats):
+    t0 = time.time()
+    bodies = [ transport.encode(data) for _ in xrange(repeats) ]
+    encode_time = (time.time() - t0)/repeats
+
+    t0 = time.time()
+    for body in bodies:
+        image, = transport.decode_batch([ body ])
+        assert image == data
+        transport.release([ body ])
+    decode_time = (time.time() - t0)/repeats
+
+    return len(bodies[0]), encode_time, decode_time
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--store',
+    help='Blob store of the by reference transport',
+    choices=['directory', 'redis'],
+    default='directory')
+parser.add_argument(
+    '--sizes',
+    help='Image sizes in KB',
+    type=int,
+    nargs='+',
+    default=[10, 40, 150, 500])
+parser.add_argument(
+    '--repeats',
+    help='Number of images of each size',
+    type=int,
+    default=200)
+parser.add_argument(
+    '--redis_server',
+    default='localhost')
+parser.add_argument(
+    '--redis_port',
+    type=int,
+    default=6379)
+args = parser.parse_args()
+
+if args.store == 'directory':
+    directory = tempfile.mkdtemp()
+    store = DirectoryBlobStore(directory)
+else:
+    store = RedisBlobStore(redis.StrictRedis(args.redis_server, args.redis_port))
+
+inline, by_reference = Transport(), Transport(store, threshold=0)
+
+print '{:>8} {:>14} {:>10} {:>10} {:>14} {:>10} {:>10}'.format(
+    'KB', 'inline bytes', 'enc ms', 'dec ms', 'ref bytes', 'enc ms', 'dec ms')
+
+for size in args.sizes:
+    # Compressed images are close to random bytes.
+    data = os.urandom(1024*size)
+    a = timed(inline, data, args.repeats)
+    b = timed(by_reference, data, args.repeats)
+    print '{:>8} {:>14} {:>10.3f} {:>10.3f} {:>14} {:>10.3f} {:>10.3f}'.format(
+        size, a[0], 1000*a[1], 1000*a[2], b[0], 1000*b[1], 1000*b[2])
+
+if args.store == 'directory':
+    shutil.rmtree(directory)
@@ -9,7 +9,6 @@ import tarfile
 import os
 import time
 import json
-from binascii import a2b_base64
 import argparse
 import multiprocessing as mp
 
@@ -18,14 +17,64 @@ import tensorflow as tf
 from tensorflow.python.platform import gfile
 import numpy as np
 import redis
-import boto3
+
+from queues import connect, BACKENDS, SQS_BATCH
+from transport import make_transport, STORES
 
 DATA_URL = 'http://download.tensorflow.org/models/image/imagenet/inception-2015-12-05.tgz'
+# Reply lists of API processes that are gone expire after this many seconds.
+REPLY_TTL = 3600
+
+def classify_batch(sess, inception_next_last_layer, transfer_predictor, transport, messages):
+    """Returns a result for each message. The transfer classifier runs once on the
+    features of all the images that could be read."""
+    results = [ None ]*len(messages)
+    hidden_layers = []
+    ok = []
+
+    images = transport.decode_batch([ message.body for message in messages ])
+
+    starttime = time.time()
+    for i, image_data in enumerate(images):
+        try:
+            if isinstance(image_data, Exception):
+                raise image_data
+            hidden_layer = sess.run(inception_next_last_layer,
+                                    {'DecodeJpeg/contents:0': image_data})
+            hidden_layers.append(np.squeeze(hidden_layer))
+            ok.append(i)
+        except Exception as e:
+            results[i] = { 'status': 'error',
+                           'message': str(e) }
+
+    if ok:
+        try:
+            predictions = sess.run(transfer_predictor, {'input:0': np.vstack(hidden_layers) })
+            predictions = predictions.reshape(len(ok), -1)
+        except Exception as e:
+            for i in ok:
+                results[i] = { 'status': 'error',
+                               'message': str(e) }
+            return results
+
+        computation_time = int(1000*(time.time()-starttime)/len(messages))
+        for i, scores, hidden_layer in zip(ok, predictions, hidden_layers):
+            top_k = scores.argsort()[-args.num_top_predictions:][::-1]
+            results[i] = { 'status': 'done',
+                           'classification':
+                           [ { 'category': mapping[str(node_id)], 'probability': float(scores[node_id]) }
+                             for node_id in top_k ],
+                           'computation_time': computation_time }
+
+            if args.return_visual_features:
+                results[i]['visual_features'] = hidden_layer.tolist()
+
+    return results
 
 def classify_images(cuda_device): 
-    sqs = boto3.resource('sqs')
-    queue = sqs.get_queue_by_name(QueueName=args.sqs_queue)
     r_server = redis.StrictRedis(args.redis_server, args.redis_port)
+    queue = connect(args.queue_backend, args.sqs_queue, r_server)
+    transport = make_transport(args.blob_store, r_server, args.blob_dir)
     os.environ['CUDA_VISIBLE_DEVICES'] = str(cuda_device)
     print('Using CUDA device {}'.format(cuda_device))
 
@@ -40,42 +89,28 @@ def classify_images(cuda_device):
         transfer_predictor = sess.graph.get_tensor_by_name('output:0')
 
         while True:
-            for message in queue.receive_messages():
-                try:
-                    blob = json.loads(message.body)
-                    _, data = blob['image']['data_uri'].split(',')
-                    image_data = a2b_base64(data)
-
-                    starttime = time.time()
-                    hidden_layer = sess.run(inception_next_last_layer,
-                                            {'DecodeJpeg/contents:0': image_data})
-
-                    hidden_layer_squeezed = np.squeeze(hidden_layer)
-                    predictions = sess.run(transfer_predictor, {'input:0': np.atleast_2d(hidden_layer_squeezed) })
-                    predictions = np.squeeze(predictions)
-                    top_k = predictions.argsort()[-args.num_top_predictions:][::-1]
-                    endtime = time.time()
-
-                    result = { 'status': 'done',
-                               'classification':
-                               [ { 'category': mapping[str(node_id)], 'probability': float(predictions[node_id]) }
-                                 for node_id in top_k ],
-                               'computation_time': int(1000*(endtime-starttime)) }
-
-                    if args.return_visual_features:
-                        result['visual_features'] = hidden_layer_squeezed.tolist()
-
-                except Exception as e:
-                    result = { 'status': 'error',
-                               'message': str(e) }
-                
-
-                result_json = json.dumps(result)
-                r_server.lpush('{}{}'.format(args.redis_prefix, message.message_id), result_json)
-                message.delete()
-                
+            messages = queue.receive(args.batch_size, args.wait_time)
+            if not messages:
+                continue
+
+            results = classify_batch(sess, inception_next_last_layer, transfer_predictor, transport, messages)
+
+            pipe = r_server.pipeline()
+            for message, result in zip(messages, results):
+                reply_to = transport.reply_to(message.body)
+                if reply_to:
+                    # The API process waiting for it reads one list for all its requests.
+                    pipe.lpush(reply_to, json.dumps([message.id, result]))
+                    pipe.expire(reply_to, REPLY_TTL)
+                else:
+                    pipe.lpush('{}{}'.format(args.redis_prefix, message.id), json.dumps(result))
+            pipe.execute()
+            queue.delete(messages)
+            transport.release([ message.body for message in messages ])
+
+            for result in results:
                 if args.return_visual_features:
-                    del result['visual_features'] # To avoid cluttering the output 
+                    result.pop('visual_features', None) # To avoid cluttering the output 
                 print(result)
 
     
@@ -141,6 +176,30 @@ if __name__ == '__main__':
         '--sqs_queue',
         help='SQS queue to read images from',
         default='classify')
+    parser.add_argument(
+        '--queue_backend',
+        help='Where the tasks are queued. Use redis to run without AWS',
+        choices=BACKENDS,
+        default='sqs')
+    parser.add_argument(
+        '--batch_size',
+        help='Most images to receive and classify at a time, SQS returns at most {}'.format(SQS_BATCH),
+        default=SQS_BATCH,
+        type=int)
+    parser.add_argument(
+        '--wait_time',
+        help='Seconds to long poll the queue for messages',
+        default=20,
+        type=int)
+    parser.add_argument(
+        '--blob_store',
+        help='Where the API puts large images, must match the API',
+        choices=STORES,
+        default='none')
+    parser.add_argument(
+        '--blob_dir',
+        help='Shared directory of the directory blob store',
+        default='/tmp/imgblobs')
     parser.add_argument(
         '--gpus',
         help='How many GPUs to use',
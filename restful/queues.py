@@ -0,0 +1,164 @@
+'''
+Task queues between the API and the classifiers. Every backend sends single messages,
+receives up to max_messages at a time and acknowledges a list of messages at once:
+
+    SQSQueue    Amazon SQS, long polling and batch deletes.
+    RedisQueue  A redis list, for running without AWS.
+    LocalQueue  In memory, for benchmarks that fork their consumers after making it.
+
+LocalQueue is not one of the BACKENDS of connect, since a queue made in each process
+would not be shared between them.
+'''
+
+import json
+import time
+import uuid
+import logging
+import multiprocessing as mp
+import Queue
+from collections import namedtuple
+
+Message = namedtuple('Message', 'id body handle')
+
+# The most messages SQS returns or deletes in one request.
+SQS_BATCH = 10
+
+class SQSQueue(object):
+
+    def __init__(self, name, create=False):
+        import boto3
+        sqs = boto3.resource('sqs')
+        try:
+            self.queue = sqs.get_queue_by_name(QueueName=name)
+        except Exception:
+            if not create:
+                raise
+            logging.info('The queue "{}" does not exist. It will be created.'.format(name))
+            self.queue = sqs.create_queue(QueueName=name)
+
+    def send(self, body):
+        return self.queue.send_message(MessageBody=body)['MessageId']
+
+    def receive(self, max_messages=SQS_BATCH, wait_seconds=20):
+        messages = self.queue.receive_messages(MaxNumberOfMessages=min(max_messages, SQS_BATCH),
+                                               WaitTimeSeconds=wait_seconds)
+        return [ Message(m.message_id, m.body, m.receipt_handle) for m in messages ]
+
+    def delete(self, messages):
+        for i in range(0, len(messages), SQS_BATCH):
+            entries = [ {'Id': str(j), 'ReceiptHandle': message.handle}
+                        for j, message in enumerate(messages[i:i+SQS_BATCH]) ]
+            response = self.queue.delete_messages(Entries=entries)
+            for failed in response.get('Failed', []):
+                logging.error('Could not delete message: {}'.format(failed))
+
+class RedisQueue(object):
+    '''Messages are JSON [id, body] pairs on a list. Received messages are kept in the
+    <name>:inflight hash until they are deleted, and the time they were received in the
+    <name>:received sorted set. Like the visibility timeout of SQS, messages that are
+    not deleted within visibility_timeout seconds, because their consumer died, are put
+    back on the list by the next receive.'''
+
+    def __init__(self, r_server, name, visibility_timeout=300):
+        self.red = r_server
+        self.name = name
+        self.inflight = '{}:inflight'.format(name)
+        self.received = '{}:received'.format(name)
+        self.visibility_timeout = visibility_timeout
+        self.checked = 0
+
+    def send(self, body):
+        message_id = str(uuid.uuid4())
+        self.red.lpush(self.name, json.dumps([message_id, body]))
+        return message_id
+
+    def receive(self, max_messages=SQS_BATCH, wait_seconds=20):
+        if time.time() - self.checked > self.visibility_timeout/10.:
+            self.redeliver()
+        if wait_seconds:
+            first = self.red.brpop(self.name, timeout=wait_seconds)
+            first = first[1] if first else None
+        else:
+            first = self.red.rpop(self.name)
+        if first is None:
+            return []
+
+        pipe = self.red.pipeline()
+        for _ in range(max_messages - 1):
+            pipe.rpop(self.name)
+        values = [ first ] + [ value for value in pipe.execute() if value is not None ]
+
+        messages = [ Message(message_id, body, message_id) for message_id, body in map(json.loads, values) ]
+        pipe.hmset(self.inflight, dict((m.id, m.body) for m in messages))
+        for message in messages:
+            pipe.zadd(self.received, time.time(), message.id)
+        pipe.execute()
+        return messages
+
+    def delete(self, messages):
+        if messages:
+            handles = [ message.handle for message in messages ]
+            pipe = self.red.pipeline()
+            pipe.hdel(self.inflight, *handles)
+            pipe.zrem(self.received, *handles)
+            pipe.execute()
+
+    def redeliver(self):
+        '''Puts the messages received more than visibility_timeout seconds ago back at
+        the head of the list. Returns how many.'''
+        self.checked = time.time()
+        stale = self.red.zrangebyscore(self.received, '-inf', self.checked - self.visibility_timeout)
+        redelivered = 0
+        for message_id in stale:
+            # Only the consumer whose ZREM removes the entry puts the message back.
+            if not self.red.zrem(self.received, message_id):
+                continue
+            body = self.red.hget(self.inflight, message_id)
+            if body is None:
+                continue
+            pipe = self.red.pipeline()
+            pipe.rpush(self.name, json.dumps([message_id, body]))
+            pipe.hdel(self.inflight, message_id)
+            pipe.execute()
+            redelivered += 1
+        if redelivered:
+            logging.warning('Redelivered {} messages of {} that were not deleted within {}s'.format(
+                redelivered, self.name, self.visibility_timeout))
+        return redelivered
+
+class LocalQueue(object):
+    '''Shared with processes forked after it is made. latency adds a delay to every
+    request, to stand in for the round-trip of a remote queue.'''
+
+    def __init__(self, latency=0):
+        self.queue = mp.Queue()
+        self.latency = latency
+
+    def send(self, body):
+        time.sleep(self.latency)
+        message_id = str(uuid.uuid4())
+        self.queue.put((message_id, body))
+        return message_id
+
+    def receive(self, max_messages=SQS_BATCH, wait_seconds=20):
+        time.sleep(self.latency)
+        messages = []
+        try:
+            messages.append(self.queue.get(timeout=wait_seconds) if wait_seconds else self.queue.get_nowait())
+            while len(messages) < max_messages:
+                messages.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return [ Message(message_id, body, message_id) for message_id, body in messages ]
+
+    def delete(self, messages):
+        time.sleep(self.latency)
+
+BACKENDS = ['sqs', 'redis']
+
+def connect(backend, name, r_server=None, create=False):
+    if backend == 'sqs':
+        return SQSQueue(name, create)
+    if backend == 'redis':
+        return RedisQueue(r_server, name)
+    raise ValueError('Unknown queue backend {}'.format(backend))
@@ -0,0 +1,163 @@
+'''
+How the images travel from the API to the classifiers. Small images are base64 encoded
+into the message, as before. Images of at least threshold bytes are put in a blob store,
+a redis key or a file in a shared directory, and the message only holds a reference to
+it. The blobs expire after a TTL, in case a message is never classified. A message
+may also name the redis list its result is to be pushed on, in reply_to.
+'''
+
+import json
+import os
+import time
+import uuid
+import logging
+from binascii import a2b_base64, b2a_base64
+
+DATA_URI = 'data:image/jpg;base64,'
+
+class RedisBlobStore(object):
+    scheme = 'redis'
+
+    def __init__(self, r_server, prefix='imgblob:', ttl=600):
+        self.red = r_server
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def put(self, data):
+        key = '{}{}'.format(self.prefix, uuid.uuid4())
+        self.red.setex(key, self.ttl, data)
+        return key
+
+    def get_many(self, keys):
+        return self.red.mget(keys) if keys else []
+
+    def delete(self, keys):
+        if keys:
+            self.red.delete(*keys)
+
+class DirectoryBlobStore(object):
+    '''The directory must be shared by the API and the classifiers, e.g. on the same
+    host or over NFS. Expired files are removed by the writers.'''
+    scheme = 'file'
+
+    def __init__(self, path, ttl=600, sweep_interval=60):
+        self.path = path
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.time()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def put(self, data):
+        name = str(uuid.uuid4())
+        tmp = os.path.join(self.path, '.{}'.format(name))
+        with open(tmp, 'wb') as _file:
+            _file.write(data)
+        # Readers never see a partly written file.
+        os.rename(tmp, os.path.join(self.path, name))
+        if time.time() - self.last_sweep > self.sweep_interval:
+            self.sweep()
+        return name
+
+    def get_many(self, names):
+        blobs = []
+        for name in names:
+            try:
+                with open(os.path.join(self.path, os.path.basename(name)), 'rb') as _file:
+                    blobs.append(_file.read())
+            except IOError:
+                blobs.append(None)
+        return blobs
+
+    def delete(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.path, os.path.basename(name)))
+            except OSError:
+                pass
+
+    def sweep(self):
+        self.last_sweep = time.time()
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if os.path.getmtime(path) < self.last_sweep - self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+class Transport(object):
+    '''Without a store every image is sent inline.'''
+
+    def __init__(self, store=None, threshold=32768):
+        self.store = store
+        self.threshold = threshold
+
+    def encode(self, data, reply_to=None):
+        if self.store is None or len(data) < self.threshold:
+            image = {'data_uri': DATA_URI + b2a_base64(data).rstrip('\n')}
+        else:
+            image = {'ref': self.store.put(data), 'store': self.store.scheme}
+        body = {'image': image}
+        if reply_to is not None:
+            body['reply_to'] = reply_to
+        return json.dumps(body)
+
+    @staticmethod
+    def reply_to(body):
+        '''The list to push the result of a message on, None for a list of its own.'''
+        try:
+            return json.loads(body).get('reply_to')
+        except Exception:
+            return None
+
+    def decode_batch(self, bodies):
+        '''Returns the image of each message body, or the exception that prevented
+        reading it. The referenced images are read with one request to the store.'''
+        images = [ None ]*len(bodies)
+        refs = []
+        for i, body in enumerate(bodies):
+            try:
+                image = json.loads(body)['image']
+                if 'ref' in image:
+                    if self.store is None or image['store'] != self.store.scheme:
+                        raise ValueError('Cannot read images from the {} store'.format(image['store']))
+                    refs.append((i, image['ref']))
+                else:
+                    _, data = image['data_uri'].split(',')
+                    images[i] = a2b_base64(data)
+            except Exception as e:
+                images[i] = e
+
+        if refs:
+            for (i, ref), data in zip(refs, self.store.get_many([ ref for _, ref in refs ])):
+                images[i] = data if data is not None else KeyError('The image {} has expired'.format(ref))
+
+        return images
+
+    def release(self, bodies):
+        '''Deletes the stored images of classified messages.'''
+        refs = []
+        for body in bodies:
+            try:
+                image = json.loads(body)['image']
+            except Exception:
+                continue
+            if 'ref' in image and self.store is not None and image['store'] == self.store.scheme:
+                refs.append(image['ref'])
+        try:
+            if refs:
+                self.store.delete(refs)
+        except Exception as e:
+            logging.error('Could not delete images: {}'.format(e))
+
+STORES = ['none', 'redis', 'directory']
+
+def make_transport(store, r_server=None, directory=None, ttl=600, threshold=32768):
+    if store == 'none':
+        return Transport()
+    if store == 'redis':
+        return Transport(RedisBlobStore(r_server, ttl=ttl), threshold)
+    if store == 'directory':
+        return Transport(DirectoryBlobStore(directory, ttl=ttl), threshold)
+    raise ValueError('Unknown blob store {}'.format(store))
@@ -7,7 +7,6 @@ Author: Axel.Tidemann@telenor.com, Cyril.Banino-Rokkones@telenor.com
 from __future__ import division
 import os
 import time
-import cPickle as pickle
 from collections import namedtuple
 import datetime
 import logging
@@ -21,6 +20,7 @@ from collections import defaultdict, Counter
 import json
 import base64
 import glob
+import heapq
 
 from flask import request, Response, redirect, url_for
 import flask
@@ -30,13 +30,24 @@ import tornado.wsgi
 import tornado.httpserver
 import tornado.web
 import tornado.websocket
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
 import blosc
 import pandas as pd
 import plotly.graph_objs as go
 from plotly.offline.offline import _plot_html
 
+from notify import ResultListener
+from similarity import SimilarityIndex
+from hamming import HammingService
+from cache import LRUCache
+from bulgaria import EdgeStore, to_npz
+from reports import ReportService
+from fanout import FanOut
+from scheduling import queue_for
+import inflight
+import metrics
+import protocol
+
 from ast import literal_eval as make_tuple
 
 # For the position of the word webs
@@ -45,10 +56,28 @@ OFFSET = 800
 # Timeout seconds for waiting on the redis key
 TIMEOUT = 5
 
+# How many levels of neighbours to show in the word webs, and how many seconds to cache them
+WORD_WEB_DEPTH = 2
+WORD_WEB_TTL = 600
+
+# The report that /classifieds shows random ads from
+CLASSIFIEDS_SITE = 'kaidee_images_and_text_top90_curated'
+
+# How many tasks of an uploaded list go in one message on the work queue
+TASK_BATCH = 100
+
+# Seconds between websocket frames of the live stream, at most how many classifications
+# a frame holds, and how many unsent frames a client may have before it is skipped
+FANOUT_INTERVAL = .25
+FANOUT_MAX_EVENTS = 50
+FANOUT_MAX_PENDING = 4
+
 # Obtain the flask app object
 app = flask.Flask(__name__)
 
-listeners = []
+fanout = FanOut(tornado.ioloop.IOLoop.instance(), FANOUT_INTERVAL, FANOUT_MAX_EVENTS, FANOUT_MAX_PENDING)
+
+word_webs = LRUCache(1000, WORD_WEB_TTL)
 
 def redis_listener(server, port):
     logging.info('redis listener started')
@@ -56,24 +85,29 @@ def redis_listener(server, port):
     _pubsub = _red.pubsub(ignore_subscribe_messages=True)
     _pubsub.subscribe('latest')
     for msg in _pubsub.listen():
-        result = pickle.loads(msg['data'])
-        # We must unfortunately format the string here, due to the async nature/JavaScript combination.
-        display = '<SPAN style="width:200px; float:left; text-align:center;">{}<BR><A HREF="{}"><IMG SRC="{}" TITLE="{}" WIDTH=200></A></SPAN>'.format(
-            result['category'], result['path'], result['path'], result['value'])
-        for socket in listeners:
-            socket.write_message(display)
+        # One bad message must not stop the live stream.
+        try:
+            for result in protocol.loads(msg['data'], 'latest'):
+                similarity.update(result['group'], result['category'], result['path'])
+                hamming.update(result['group'], result['path'])
+                # We must unfortunately format the string here, due to the async nature/JavaScript combination.
+                display = '<SPAN style="width:200px; float:left; text-align:center;">{}<BR><A HREF="{}"><IMG SRC="{}" TITLE="{}" WIDTH=200></A></SPAN>'.format(
+                    result['category'], result['path'], result['path'], result['value'])
+                fanout.publish(display)
+        except Exception as e:
+            logging.error('Could not handle the latest message {!r}: {}'.format(msg['data'], e))
 
 class WebSocket(tornado.websocket.WebSocketHandler):
     def open(self):
         logging.info("Socket opened, starting to listen to redis channel.")
-        listeners.append(self)
+        fanout.add(self)
 
     def on_message(self, message):
         logging.info("Received message: " + message)
 
     def on_close(self):
         logging.info("Socket closed.")
-        listeners.remove(self)
+        fanout.remove(self)
 
 @app.template_filter('split_path')
 def split_path(path):
@@ -134,9 +168,27 @@ def embeddings():
 def show_word(bu):
     return flask.render_template("network.html", bu=bu)
 
+def nearest(neighbors):
+    return heapq.nsmallest(7, neighbors.items(), key=lambda x: float(x[1]))
+
 def get_neighbors(word, nodes, links, pos, level, bu):
-    neighbors = red.hgetall(str("wow:"+bu+":") + word)
-    neighbors = sorted(neighbors.items(), key=lambda x: x[1])[:7]
+    # The words within level steps are fetched first, with one pipelined redis
+    # round-trip per level, then the web is built depth first from them.
+    fetched = {}
+    frontier = set([ word ])
+    for depth in range(level + 1):
+        unique = [ w for w in frontier if w not in fetched ]
+        pipe = red.pipeline(transaction=False)
+        for w in unique:
+            pipe.hgetall(str("wow:"+bu+":") + w)
+        fetched.update(zip(unique, pipe.execute()))
+        if depth < level:
+            frontier = set([ str(n[0]) for w in frontier for n in nearest(fetched[w]) ])
+
+    add_neighbors(word, nodes, links, pos, level, fetched)
+
+def add_neighbors(word, nodes, links, pos, level, fetched):
+    neighbors = nearest(fetched[word])
     for n in neighbors:
         name = n[0]
         if name not in pos and level > 0:
@@ -150,7 +202,7 @@ ce":round(float(n[1]), 2), "to":word})
         return
 
     for n in neighbors:
-        get_neighbors(str(n[0]), nodes, links, pos, level-1, bu)
+        add_neighbors(str(n[0]), nodes, links, pos, level-1, fetched)
 
 
 @app.route('/embeddings/wow/json/<path:bu>/<path:word>')
@@ -161,13 +213,18 @@ def get_json(bu, word):
     if word == "_":
         word = red.srandmember('wow:'+bu+':vocab')
 
+    cached = word_webs.get((bu, word, WORD_WEB_DEPTH))
+    if cached is not None:
+        return flask.jsonify(cached)
+
     tmp = {}
     nodes = []
     nodes.append({"name": word, "x":OFFSET*random.random() , "y":OFFSET*random.random(), "distance":0.0\
 , "to":"self"})
     tmp[word] = 0
     links = []
-    get_neighbors(word, nodes, links, tmp, 2, bu)
+    get_neighbors(word, nodes, links, tmp, WORD_WEB_DEPTH, bu)
+    word_webs.set((bu, word, WORD_WEB_DEPTH), {"nodes":nodes, "links":links})
     return flask.jsonify({"nodes":nodes, "links":links})
 
 
@@ -184,31 +241,19 @@ def get_json_bulgaria(threshold_obs, distance_min, distance_max, traj_min, traj_
     threshold_obs = int(threshold_obs.strip().encode("utf-8"))
     distance_min = float(distance_min.strip().encode("utf-8"))
     distance_max = float(distance_max.strip().encode("utf-8"))
-    traj_min = traj_min.strip().encode("utf-8")
-    traj_max = traj_max.strip().encode("utf-8")
-
-    union_key = "bulgaria_trajectories:" + traj_min + "-" + traj_max
-    if red_db_1.zcard(union_key) == 0:
-        keys = []
-        for t_l in range(int(traj_min), int(traj_max)):
-            keys.append("bulgaria_trajectories:" + str(t_l))
-        red_db_1.zunionstore(union_key, keys)
-
-    edges_union = red_db_1.zrevrangebyscore(union_key, "+inf", threshold_obs, withscores=True)
+    traj_min = int(traj_min.strip().encode("utf-8"))
+    traj_max = int(traj_max.strip().encode("utf-8"))
 
-    edges = defaultdict(lambda: 0)
-    for e in edges_union:
-        edges[e[0]] = e[1]
+    observations = bulgaria.trajectory_observations(traj_min, traj_max)
+    rows = bulgaria.edges(threshold_obs, distance_min, distance_max, observations)
 
-    edges_dist = set(red_db_1.zrangebyscore("bulgaria_network:edges_dist", distance_min, distance_max))
+    print "kept", len(rows), "edges"
 
-    for e in edges.keys():
-        if edges[e] < threshold_obs or not(e in edges_dist):
-            del edges[e]
+    if request.args.get('format') == 'binary':
+        return Response(to_npz(edges=bulgaria.names[rows].astype(str), observations=observations[rows]),
+                        mimetype='application/octet-stream')
 
-    print "kept", len(edges), "edges"
-
-    return flask.jsonify({"edges":edges})
+    return flask.jsonify({"edges":dict(zip(bulgaria.names[rows], observations[rows]))})
 
 @app.route('/telenor/research/bulgaria2/json/<path:threshold_obs>/<path:distance_min>/<path:distance_max>')
 def get_json_bulgaria2(threshold_obs, distance_min, distance_max):
@@ -216,36 +261,36 @@ def get_json_bulgaria2(threshold_obs, distance_min, distance_max):
     distance_min = float(distance_min.strip().encode("utf-8"))
     distance_max = float(distance_max.strip().encode("utf-8"))
 
-    vertices = red_db_1.zrevrangebyscore("bulgaria_network:vertices", "+inf", threshold_obs, withscores=True)
+    vertices, vertex_observations = bulgaria.vertices(threshold_obs)
     print "got", len(vertices), "vertices"
-    edges_obs = red_db_1.zrevrangebyscore("bulgaria_network:edges", "+inf", threshold_obs, withscores=True)
-    print "got", len(edges_obs), "edges_obs"
-    edges_dist = set(red_db_1.zrangebyscore("bulgaria_network:edges_dist", distance_min, distance_max))
-    print "got", len(edges_dist), "edges_dist"
+    rows = bulgaria.edges(threshold_obs, distance_min, distance_max)
+    print "kept", len(rows), "edges"
+
+    if request.args.get('format') == 'binary':
+        return Response(to_npz(vertices=vertices.astype(str), vertex_observations=vertex_observations,
+                               edges=bulgaria.names[rows].astype(str), observations=bulgaria.observations[rows]),
+                        mimetype='application/octet-stream')
 
-    kept_edges = [x for x in edges_obs if x[0] in edges_dist]
-    print "kept", len(kept_edges), "edges"
-    return flask.jsonify({"vertices":vertices, "edges":kept_edges})
+    return flask.jsonify({"vertices":zip(vertices, vertex_observations),
+                          "edges":zip(bulgaria.names[rows], bulgaria.observations[rows])})
 
 ################################### Reports of classifier performance #####################################
     
 @app.route('/report/<site>')
 @requires_auth
 def report_index(site):
-    report = global_data[site]['report']
+    report = reports.report(site)
 
-    with pd.HDFStore(report, 'r') as store:
-        keys = store.keys()
-        category_numbers = set([ category.split('/')[1] for category in keys ])
-        data = pd.concat([ store['{}/stats'.format(key)] for key in category_numbers ], axis=1)
+    category_numbers = report.categories
+    data = report.summary
 
-        test_len, train_len, accuracy, top_k_accuracy, k = data.values
+    test_len, train_len, accuracy, top_k_accuracy, k = data.values
 
-        assert len(set(k)) == 1, 'Varying k values should not be possible'
-        
-        category_names = data.columns
+    assert len(set(k)) == 1, 'Varying k values should not be possible'
 
-        sorted_categories = sorted(zip(category_numbers, category_names, accuracy, top_k_accuracy, train_len, test_len), key=lambda x: x[2], reverse=True)
+    category_names = data.columns
+
+    sorted_categories = sorted(zip(category_numbers, category_names, accuracy, top_k_accuracy, train_len, test_len), key=lambda x: x[2], reverse=True)
     
     return flask.render_template('report_index.html',
                                  categories=sorted_categories,
@@ -258,107 +303,92 @@ def report_index(site):
 
 def _ad_images(index, mapping, prefix, number):
     paths = []
-    for ad_id,n in zip(index, number):
-        filenames = [ '/white.png' if pd.isnull(fname) else '{}/{}/{}'.format(prefix, n, fname)
-                      for fname in mapping[n].query('index == @ad_id').values[0] ]
-        paths.append(filenames)
+    for n, filenames in zip(number, mapping.filenames(index, number)):
+        paths.append([ '/white.png' if pd.isnull(fname) else '{}/{}/{}'.format(prefix, n, fname)
+                       for fname in filenames ])
     return paths
 
-def _to_text(encoding, numbers):
-    text = []
-
-    for row in numbers:
-        text.append(''.join([ encoding[i] for i in row.split(',') ]))
-
-    return text
-
 @app.route('/report/<site>/<number>')
 @requires_auth
 def report_category(site, number):
 
-    report = global_data[site]['report']
-    encoding = json.load(open(global_data[site]['encoding']))
+    report = reports.report(site)
+    encoding = reports.encoding(site)
     
     try: 
         prefix = global_data[site]['prefix']
-        mapping = { number: pd.read_hdf(global_data[site]['mapping'], number) }
+        mapping = reports.mapping(site)
     except:
         pass
     
-    with pd.HDFStore(report, 'r') as store:
-        stats = store['{}/stats'.format(number)]
+    stats = report.table(number, 'stats')
 
-        correct = store['{}/correct'.format(number)]
-        wrong = store['{}/wrong/out'.format(number)]
+    correct = report.table(number, 'correct')
+    wrong = report.table(number, 'wrong/out')
 
-        test_len, train_len, accuracy, top_k_accuracy, k = stats.values
+    test_len, train_len, accuracy, top_k_accuracy, k = stats.values
 
-        category = stats.columns[0]
-        
-        plotly_data = []
+    category = stats.columns[0]
+    
+    plotly_data = []
 
-        try:
-            correct_paths = _ad_images(correct.index, mapping, prefix, [number]*len(correct))
-        except:
-            correct_paths = [ [c] for c in correct.index ]
-
-        correct_title = _to_text(encoding, correct.text)
-            
-        plotly_data.append(go.Scatter(
-            x=np.linspace(0,100, num=len(correct)),
-            y=correct.score,
-            mode='lines',
-            name='Correct',
-            hoverinfo='name+y',
-            text=[ json.dumps({ 'paths': paths, 'prediction': category, 'text': title })
-                       for paths, title in zip(correct_paths, correct_title ) ]))
-
-        category_map_names = {}
-        for c in set(wrong.category):
-            category_map_names[c] = store['{}/stats'.format(c)].columns[0]
-        
-        wrong_categories = [ category_map_names[c] for c in wrong.category ]
+    try:
+        correct_paths = _ad_images(correct.index, mapping, prefix, [number]*len(correct))
+    except:
+        correct_paths = [ [c] for c in correct.index ]
 
-        try:
-            wrong_paths = _ad_images(wrong.index, mapping, prefix, [number]*len(wrong))
-        except:
-            wrong_paths = [ [c] for c in wrong.index ]
+    correct_title = encoding.decode(correct.text)
+        
+    plotly_data.append(go.Scatter(
+        x=np.linspace(0,100, num=len(correct)),
+        y=correct.score,
+        mode='lines',
+        name='Correct',
+        hoverinfo='name+y',
+        text=[ json.dumps({ 'paths': paths, 'prediction': category, 'text': title })
+                   for paths, title in zip(correct_paths, correct_title ) ]))
+
+    category_map_names = {}
+    for c in set(wrong.category):
+        category_map_names[c] = report.name(c)
+    
+    wrong_categories = [ category_map_names[c] for c in wrong.category ]
 
-        wrong_title = _to_text(encoding, wrong.text)
-            
-        plotly_data.append(go.Scatter(
-            x=np.linspace(0,100, num=len(wrong)),
-            y=wrong.score,
-            mode='lines',
-            name='Wrong',
-            hoverinfo='name+y',
-            text=[ json.dumps({ 'paths': paths, 'prediction': prediction, 'text': title })
-                   for paths, prediction, title in zip(wrong_paths, wrong_categories, wrong_title )]))
+    try:
+        wrong_paths = _ad_images(wrong.index, mapping, prefix, [number]*len(wrong))
+    except:
+        wrong_paths = [ [c] for c in wrong.index ]
 
-        layout = go.Layout(hovermode='closest', title='Performance of correct vs wrong classified pictures', xaxis={'title': '%'}, yaxis={'title': 'score'})
+    wrong_title = encoding.decode(wrong.text)
+        
+    plotly_data.append(go.Scatter(
+        x=np.linspace(0,100, num=len(wrong)),
+        y=wrong.score,
+        mode='lines',
+        name='Wrong',
+        hoverinfo='name+y',
+        text=[ json.dumps({ 'paths': paths, 'prediction': prediction, 'text': title })
+               for paths, prediction, title in zip(wrong_paths, wrong_categories, wrong_title )]))
 
-        figure = go.Figure(data=plotly_data, layout=layout)
+    layout = go.Layout(hovermode='closest', title='Performance of correct vs wrong classified pictures', xaxis={'title': '%'}, yaxis={'title': 'score'})
 
-        performance_plot, performance_id, _,_ = _plot_html(figure, False, '', True, 700, '100%', False)
+    figure = go.Figure(data=plotly_data, layout=layout)
 
-        categories_counter = Counter(wrong_categories)
-        labels, values = zip(*categories_counter.items())
+    performance_plot, performance_id, _,_ = _plot_html(figure, False, '', True, 700, '100%', False)
 
-        pie = go.Pie(labels=labels, values=values, showlegend=False, textinfo='text', text=[None]*len(values))
-        layout= go.Layout(hovermode='closest', title='Wrongly classified pictures ({}%) labelled {}'.format(np.round(100*(1-accuracy[0]), 1), category))
-        figure = go.Figure(data=[pie], layout=layout)
+    categories_counter = Counter(wrong_categories)
+    labels, values = zip(*categories_counter.items())
 
-        pie, _, _, _ = _plot_html(figure, False, '', True, '100%', '100%', False)
+    pie = go.Pie(labels=labels, values=values, showlegend=False, textinfo='text', text=[None]*len(values))
+    layout= go.Layout(hovermode='closest', title='Wrongly classified pictures ({}%) labelled {}'.format(np.round(100*(1-accuracy[0]), 1), category))
+    figure = go.Figure(data=[pie], layout=layout)
 
-        wrong_as_this = store['{}/wrong/in'.format(number)]
+    pie, _, _, _ = _plot_html(figure, False, '', True, '100%', '100%', False)
 
-        for c in set(wrong_as_this.category):
-            category_map_names[c] = store['{}/stats'.format(c)].columns[0]
+    wrong_as_this = report.table(number, 'wrong/in')
 
-            try:
-                mapping[c] = pd.read_hdf(global_data[site]['mapping'], c)
-            except:
-                pass
+    for c in set(wrong_as_this.category):
+        category_map_names[c] = report.name(c)
 
     wrong_out = sorted(zip(wrong.index, wrong_paths, wrong_categories, wrong_title, wrong.score), key=lambda x: x[-1], reverse=True)
 
@@ -372,7 +402,7 @@ def report_category(site, number):
         
     wrong_in_categories = [ category_map_names[c] for c in wrong_as_this.category ]
 
-    wrong_as_this_title = _to_text(encoding, wrong_as_this.text)
+    wrong_as_this_title = encoding.decode(wrong_as_this.text)
     
     wrong_in = sorted(zip(wrong_as_this.index, wrong_in_paths, wrong_in_categories, wrong_as_this_title, wrong_as_this.score),
                       key=lambda x: x[-1], reverse=True)
@@ -403,31 +433,14 @@ def pass_it_on(dummy):
 @app.route('/classifieds')
 @requires_auth
 def classify_random():
-
-    site = 'kaidee_images_and_text_top90_curated'
     t0 = time.time()
-    report = global_data[site]['report']
-    with pd.HDFStore(report, 'r') as store:
-        category = random.choice(store.keys())
-        category = category.split('/')[1]
+    ad, correct, category = reports.sampler(CLASSIFIEDS_SITE).sample()
+    encoding = reports.encoding(CLASSIFIEDS_SITE)
+    print 'Loading data in {} seconds'.format(np.around(time.time()-t0, decimals=2))
 
-        stats = store['{}/stats'.format(category)]
-        
-        test_len, train_len, accuracy, top_k_accuracy, k = stats.values
+    title = encoding.decode(ad.text)
 
-        correct = np.random.random() < accuracy
-        
-        pick = 'correct' if correct else 'wrong/out'
-        pick = '{}/{}'.format(category, pick)
-
-        ad = store[pick].sample()
-        
-        encoding = json.load(open(global_data[site]['encoding']))
-        print 'Loading data in {} seconds'.format(np.around(time.time()-t0, decimals=2))
-
-        title = _to_text(encoding, ad.text)
-
-    return flask.render_template('display_ad.html', path=ad.index[0], title=title[0], correct=correct, category=stats.columns[0])
+    return flask.render_template('display_ad.html', path=ad.index[0], title=title[0], correct=correct, category=category)
 
 
 
@@ -461,33 +474,8 @@ def get_images_from_category(category, num=-1, group='web'):
     result = red.hkeys('archive:{}:category:{}'.format(group, category))
     return [ unicode(url, 'utf-8') for url in result ]
 
-def get_similar_images_from_category(image, category, num=-1, group='web'):
-    result = red.hgetall('archive:{}:category:{}'.format(group, category))
-    
-    if len(result) < 2:
-        return []
-    
-    Y = []
-    X = []
-    name_Y = []
-
-    for k in result:
-        h_s_unpacked = blosc.decompress(result[k])
-        states = np.fromstring(h_s_unpacked, dtype=np.float32).reshape(2048)
-        if k != image :
-            Y.append(states)
-            name_Y.append(k)
-        else:
-            X.append(states)
-
-    Y = np.array(Y)
-    X = np.array(X)
-
-    D = cosine_similarity(X, Y)
-    sort_indices = np.argsort(D[0])[::-1]
-
-    return [ (unicode(name_Y[x], 'utf-8'), D[0][x]) for x in sort_indices[:10]]
-    
+def get_similar_images_from_category(image, category, num=10, group='web'):
+    return [ (unicode(name, 'utf-8'), score) for name, score in similarity.similar(image, category, num, group) ]
 
 @app.route('/images/categories/<path:category>/')
 @requires_auth
@@ -496,13 +484,24 @@ def images(category):
 
 def wait_for_prediction(group, path):
     key = 'archive:{}:{}'.format(group, path)
-    t0 = time.time()
-    while True:
-        if red.exists(key):
-            return red.hgetall(key)
-        if time.time() - t0 > TIMEOUT:
-            return {'OK': 'False'}
-        time.sleep(.1)
+    with timings.time('prediction_wait'):
+        done = results.wait(key, TIMEOUT)
+    if done:
+        return red.hgetall(key)
+    return {'OK': 'False'}
+
+@app.route('/metrics')
+@requires_auth
+def get_metrics():
+    '''Latency histogram summaries of the workers and the web app.'''
+    timings.flush()
+    return Response(json.dumps(metrics.summary(red), indent=2, sort_keys=True), mimetype='application/json')
+
+@app.route('/inflight')
+@requires_auth
+def get_inflight():
+    '''Tasks queued and tasks that joined an identical task in flight, by queue.'''
+    return Response(json.dumps(inflight.stats(red), indent=2, sort_keys=True), mimetype='application/json')
 
 @app.route('/lastprediction')
 @requires_auth
@@ -559,6 +558,24 @@ def get_prediction(path):
     return flask.jsonify({'error': error})
 
 
+@app.route('/images/hashing/similar/<path:group>/<path:path>')
+@requires_auth
+def hashing_similar(group, path):
+    try:
+        radius = int(request.args.get('radius', 2))
+        num = int(request.args.get('num', 10))
+    except ValueError:
+        return Response('radius and num must be integers', 400)
+    try:
+        similar = hamming.similar('archive:{}:{}'.format(group, path), radius, num)
+    except KeyError as e:
+        return flask.jsonify({'error': {'group': group, 'path': path, 'message': str(e)}})
+
+    prefix = 'archive:{}:'.format(group)
+    return flask.jsonify({'similar': [ {'path': name[len(prefix):] if name.startswith(prefix) else name,
+                                        'similarity': score}
+                                       for name, score in similar ]})
+
 @app.route('/images/archive/<path:group>/category/<path:category>')
 @requires_auth
 def images_in_category(group, category):
@@ -568,22 +585,44 @@ def images_in_category(group, category):
 @requires_auth
 def classify(queue):
     my_file = StringIO.StringIO(request.files['file'].read())
+    # The priority class (interactive, default or bulk) decides how soon the images are
+    # classified, and images not classified within the optional deadline are dropped.
+    priority = request.form.get('priority', 'default')
+    try:
+        class_queue = queue_for(queue, priority)
+        deadline = float(request.form.get('deadline', 0))
+        if not deadline >= 0:
+            raise ValueError('The deadline must be a number of seconds, got {}'.format(request.form['deadline']))
+    except ValueError as e:
+        return Response(str(e), 400)
+
     i = 0
+    queued = 0
+    tasks = []
     for line in my_file:
         
-        task = {'group': request.form['group'], 'path': line.strip(), 'res_q': request.form['res_q']}
-        if i == 0: 
-            pipe.rpush(queue, pickle.dumps(task))
-        else: 
-            pipe.lpush(queue, pickle.dumps(task))
+        task = {'group': request.form['group'], 'path': line.strip(), 'res_q': request.form['res_q'],
+                'queued_at': time.time(), 'priority': priority,
+                'deadline': time.time() + deadline if deadline else 0.}
+        tasks.append(task)
 
         i += 1
         if i % 10000 == 0:
-            pipe.execute()
+            queued += enqueue(queue, class_queue, tasks)
+            tasks = []
             logging.info('Piping 10K items to redis.')
 
+    queued += enqueue(queue, class_queue, tasks)
+    return '{} images queued for classification, {} of them already were. Results posted on {}'.format(
+        i, i - queued, request.form['res_q'])
+
+def enqueue(queue, class_queue, tasks):
+    '''Queues the tasks that are not in flight already, returns how many.'''
+    tasks = inflight.claim(red, queue, tasks)
+    for start in range(0, len(tasks), TASK_BATCH):
+        pipe.lpush(class_queue, protocol.dumps_batch('task', tasks[start:start + TASK_BATCH]))
     pipe.execute()
-    return '{} images queued for classification. Results posted on {}'.format(i, request.form['res_q'])
+    return len(tasks)
 
 @app.route('/images/classify_url', methods=['GET', 'POST'])
 @requires_auth
@@ -598,13 +637,14 @@ def classify_url():
         if 'res_q' in json_obj:
             res_q = json_obj['res_q']
 
-        for image_url in image_list:
-            red.rpush(args.queue, pickle.dumps({
+        if image_list:
+            enqueue(args.queue, args.queue, [ {
                 'group': 'web',
                 'path': image_url,
                 'ad_id': ad_id,
-                'res_q': res_q
-            }))
+                'res_q': res_q,
+                'queued_at': time.time()
+            } for image_url in image_list ])
 
         return "OK"
 
@@ -612,7 +652,10 @@ def classify_url():
     else:
         imageurl = flask.request.args.get('imageurl', '')
         ad_id = flask.request.args.get('ad_id', '')
-        red.rpush(args.queue, pickle.dumps({'group': 'web', 'path': imageurl, 'ad_id': ad_id, 'res_q':""})) # SPECS COMMON!
+        # Someone is waiting for this one, and only for TIMEOUT seconds.
+        enqueue(args.queue, queue_for(args.queue, 'interactive'), [ {
+            'group': 'web', 'path': imageurl, 'ad_id': ad_id, 'res_q':"", 'queued_at': time.time(),
+            'priority': 'interactive', 'deadline': time.time() + TIMEOUT} ]) # SPECS COMMON!
 
         prediction = wait_for_prediction('web', imageurl)
         result = parse_result(prediction)
@@ -730,6 +773,17 @@ red = redis.StrictRedis(args.redis_server, args.redis_port)
 red_db_1 = redis.StrictRedis(args.redis_server, args.redis_port, db=1)
 pubsub = red.pubsub(ignore_subscribe_messages=True)
 pipe = red.pipeline()
+results = ResultListener(red).start()
+timings = metrics.Metrics(red, 'app')
+similarity = SimilarityIndex(red)
+hamming = HammingService(red)
+bulgaria = EdgeStore(red_db_1)
+reports = ReportService(global_data)
+try:
+    reports.sampler(CLASSIFIEDS_SITE)
+    reports.encoding(CLASSIFIEDS_SITE)
+except (IOError, OSError) as e:
+    logging.warning('Could not index the classifieds report: {}'.format(e))
 
 redis_thread = threading.Thread(target=redis_listener, args=(args.redis_server, args.redis_port))
 redis_thread.daemon = True
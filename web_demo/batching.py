@@ -0,0 +1,80 @@
+'''
+Collects classification tasks from a redis list into micro-batches, so the workers
+spend their time on inference instead of on per-call overhead.
+'''
+
+from __future__ import division
+import os
+import socket
+import time
+import logging
+from collections import namedtuple, Counter
+
+Task = namedtuple('Task', 'queue value')
+
+# Tasks done by each worker of a queue, read by misc/supervisor.py.
+PROCESSED = 'workers:{}:processed'
+
+def worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+def count_processed(r_server, queue, n):
+    '''r_server may be a pipeline.'''
+    r_server.hincrby(PROCESSED.format(queue), worker_id(), n)
+
+def collect_batch(r_server, queue, max_size, timeout_ms, poll_interval=.005, block_timeout=0):
+    '''Blocks until at least one task is available, then keeps popping tasks
+    until max_size tasks are collected or timeout_ms milliseconds have passed.
+    The additional tasks are popped in one pipelined round-trip per attempt.
+    Returns an empty batch if no task came within block_timeout seconds (0 waits
+    forever).'''
+    first = r_server.brpop(queue, timeout=block_timeout)
+    if first is None:
+        return []
+    batch = [ Task(*first) ]
+    deadline = time.time() + timeout_ms/1000
+
+    while len(batch) < max_size:
+        pipe = r_server.pipeline()
+        for _ in range(max_size - len(batch)):
+            pipe.rpop(queue)
+        batch.extend([ Task(queue, value) for value in pipe.execute() if value is not None ])
+
+        if len(batch) == max_size or time.time() >= deadline:
+            break
+        time.sleep(min(poll_interval, max(deadline - time.time(), 0)))
+
+    return batch
+
+class BatchStats(object):
+    '''Keeps track of the batch size distribution and the throughput, and logs it
+    every report_interval seconds.'''
+
+    def __init__(self, report_interval=60):
+        self.report_interval = report_interval
+        self.sizes = Counter()
+        self.images = 0
+        self.busy = 0.
+        self.t0 = time.time()
+
+    def update(self, batch_size, elapsed):
+        self.sizes[batch_size] += 1
+        self.images += batch_size
+        self.busy += elapsed
+
+        if time.time() - self.t0 > self.report_interval:
+            self.report()
+
+    def report(self):
+        wall = time.time() - self.t0
+        batches = sum(self.sizes.values())
+        logging.info('Batch sizes: {} Mean batch size: {:.2f} Images/sec: {:.2f} ({:.2f} while busy)'.format(
+            sorted(self.sizes.items()),
+            self.images/max(batches, 1),
+            self.images/max(wall, 1e-9),
+            self.images/max(self.busy, 1e-9)))
+
+        self.sizes.clear()
+        self.images = 0
+        self.busy = 0.
+        self.t0 = time.time()
@@ -0,0 +1,57 @@
+'''
+Benchmark of the Monte-Carlo classification of the Caffe model: the old loop of one
+oversampled net.predict per pass against the batched passes, for a few batch sizes.
+Dropout must be enabled at test time in the model definition for the passes to differ.
+'''
+
+from __future__ import division
+import argparse
+import time
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import caffe
+
+from bvlc import ImagenetClassifier
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    'image',
+    help='Image to classify')
+parser.add_argument(
+    '--passes',
+    help='Number of stochastic forward passes',
+    type=int,
+    default=100)
+parser.add_argument(
+    '--batch_sizes',
+    help='Batch sizes of the batched passes, in crops',
+    type=int,
+    nargs='+',
+    default=[10, 50, 100, 250])
+parser.add_argument(
+    '--gpu_id',
+    help='GPU to use, runs on the CPU if not given',
+    type=int)
+args = parser.parse_args()
+
+ImagenetClassifier.default_args.update({'gpu_mode': args.gpu_id is not None})
+if args.gpu_id is not None:
+    ImagenetClassifier.default_args.update({'gpu_device': args.gpu_id})
+model = ImagenetClassifier(**ImagenetClassifier.default_args)
+image = caffe.io.load_image(args.image)
+
+t0 = time.time()
+scores = np.array([ model.net.predict([image], oversample=True).flatten() for _ in range(args.passes) ])
+loop_time = time.time() - t0
+print '{:<16} {:>8.3f} s'.format('predict loop', loop_time)
+
+for batch_size in args.batch_sizes:
+    t0 = time.time()
+    batched = model.monte_carlo_scores(image, args.passes, batch_size)
+    elapsed = time.time() - t0
+    # The passes are random, so only the means are comparable.
+    difference = np.abs(batched.mean(axis=0) - scores.mean(axis=0)).max()
+    print '{:<16} {:>8.3f} s ({:.1f}x), largest difference of the means {:.4f}'.format(
+        'batch {}'.format(batch_size), elapsed, loop_time/elapsed, difference)
@@ -0,0 +1,111 @@
+'''
+Benchmark of the websocket fan-out with simulated listeners: writing every event to
+every client, as the redis listener did, against the coalescing FanOut. Each listener
+acknowledges a frame after a delay, and a share of them are slow. Events are published
+from a separate thread, like the redis listener.
+'''
+
+from __future__ import division
+import argparse
+import random
+import threading
+import time
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from fanout import FanOut
+
+class Listener(object):
+
+    def __init__(self, io_loop, delay):
+        self.io_loop = io_loop
+        self.delay = delay
+        self.frames = 0
+        self.lag = 0.
+
+    def write_message(self, message):
+        # Framing the message is the per-client cost of a real websocket.
+        message.encode('utf-8')
+        self.frames += 1
+        # The oldest event of a frame is the last one.
+        start = message.rindex('@') + 1
+        published = float(message[start:message.index('|', start)])
+        self.lag = max(self.lag, time.time() - published)
+        future = Future()
+        self.io_loop.call_later(self.delay, lambda: future.set_result(None))
+        return future
+
+class Direct(object):
+    '''The old way: every event is written to every client right away.'''
+
+    def __init__(self, io_loop):
+        self.io_loop = io_loop
+        self.clients = []
+
+    def add(self, client):
+        self.clients.append(client)
+
+    def publish(self, event):
+        self.io_loop.add_callback(lambda: [ client.write_message(event) for client in self.clients ])
+
+def run(make, args):
+    io_loop = IOLoop()
+    fanout = make(io_loop)
+    listeners = []
+    for i in xrange(args.listeners):
+        slow = i < args.slow*args.listeners
+        listeners.append(Listener(io_loop, args.slow_delay if slow else random.uniform(0, .01)))
+        fanout.add(listeners[-1])
+
+    def publisher():
+        for i in xrange(args.events):
+            # The publish time is part of the message so the listeners can tell the lag.
+            fanout.publish(u'<SPAN>@{}|\u0e01\u0e02 {}</SPAN>'.format(time.time(), i)*4)
+            time.sleep(1/args.rate)
+        io_loop.add_callback(lambda: io_loop.call_later(1, io_loop.stop))
+
+    thread = threading.Thread(target=publisher)
+    t0, c0 = time.time(), time.clock()
+    io_loop.add_callback(thread.start)
+    io_loop.start()
+    cpu = time.clock() - c0
+    io_loop.close()
+
+    fast = listeners[int(args.slow*args.listeners):]
+    slow = listeners[:int(args.slow*args.listeners)]
+    return (cpu, sum([ l.frames for l in listeners ]),
+            max([ l.lag for l in fast ]), sum([ l.frames for l in slow ])/max(1, len(slow)))
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--listeners',
+    help='Number of websocket clients',
+    type=int,
+    default=1000)
+parser.add_argument(
+    '--events',
+    help='Number of classifications to publish',
+    type=int,
+    default=1000)
+parser.add_argument(
+    '--rate',
+    help='Classifications per second',
+    type=float,
+    default=200)
+parser.add_argument(
+    '--slow',
+    help='Share of slow clients',
+    type=float,
+    default=.05)
+parser.add_argument(
+    '--slow_delay',
+    help='Seconds a slow client takes to receive a frame',
+    type=float,
+    default=2)
+args = parser.parse_args()
+
+print '{:<10} {:>10} {:>12} {:>18} {:>20}'.format('', 'CPU s', 'frames', 'max lag fast (s)', 'frames per slow')
+for name, make in [ ('direct', Direct), ('fan-out', FanOut) ]:
+    cpu, frames, lag, slow_frames = run(make, args)
+    print '{:<10} {:>10.2f} {:>12} {:>18.3f} {:>20.1f}'.format(name, cpu, frames, lag, slow_frames)
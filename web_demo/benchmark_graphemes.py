@@ -0,0 +1,68 @@
+'''
+Benchmark of the vectorised grapheme decoding against the per-character join, on a
+synthetic report table. Pass an encoding file to use real graphemes.
+'''
+
+from __future__ import division
+import argparse
+import json
+import time
+
+import numpy as np
+
+from graphemes import GraphemeDecoder
+
+def to_text(encoding, numbers):
+    '''The old _to_text of app.py.'''
+    text = []
+
+    for row in numbers:
+        text.append(''.join([ encoding[i] for i in row.split(',') ]))
+
+    return text
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--encoding',
+    help='Path to an index to grapheme JSON file')
+parser.add_argument(
+    '--rows',
+    help='Number of titles in the table',
+    type=int,
+    default=10000)
+parser.add_argument(
+    '--max_length',
+    help='Maximum title length',
+    type=int,
+    default=60)
+parser.add_argument(
+    '--repeats',
+    help='How many times to decode the table',
+    type=int,
+    default=10)
+args = parser.parse_args()
+
+if args.encoding:
+    encoding = json.load(open(args.encoding))
+else:
+    # Thai consonants and vowels
+    encoding = dict((str(i), unichr(0x0e01 + i)) for i in range(80))
+
+keys = np.array(sorted(encoding.keys()))
+np.random.seed(0)
+numbers = [ ','.join(np.random.choice(keys, np.random.randint(1, args.max_length + 1)))
+            for _ in xrange(args.rows) ]
+
+decoder = GraphemeDecoder(encoding)
+assert decoder.decode(numbers) == to_text(encoding, numbers)
+
+results = []
+for name, decode in [ ('per-character join', lambda: to_text(encoding, numbers)),
+                      ('vectorised gather', lambda: decoder.decode(numbers)) ]:
+    t0 = time.time()
+    for _ in xrange(args.repeats):
+        decode()
+    results.append((name, (time.time() - t0)/args.repeats))
+
+for name, elapsed in results:
+    print '{:<20} {:>8.2f} ms per {} rows ({:.1f}x)'.format(name, 1000*elapsed, args.rows, results[0][1]/elapsed)
@@ -0,0 +1,104 @@
+'''
+Recall and latency of the packed Hamming search against brute-force cosine similarity,
+on synthetic clustered non-negative vectors (pool_3 vectors are ReLU outputs) hashed
+with a random rotation, or with the rotation matrix at <hashing:R> if --redis is given.
+'''
+
+from __future__ import division
+import argparse
+import time
+
+import numpy as np
+
+from hamming import HammingIndex, binary_codes
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--n',
+    help='Number of vectors in the index',
+    type=int,
+    default=20000)
+parser.add_argument(
+    '--dim',
+    help='Dimension of the vectors',
+    type=int,
+    default=2048)
+parser.add_argument(
+    '--bits',
+    help='Number of bits in the codes',
+    type=int,
+    default=32)
+parser.add_argument(
+    '--clusters',
+    help='Number of clusters in the synthetic data',
+    type=int,
+    default=200)
+parser.add_argument(
+    '--queries',
+    help='Number of queries',
+    type=int,
+    default=200)
+parser.add_argument(
+    '--num',
+    help='Number of neighbours to retrieve',
+    type=int,
+    default=10)
+parser.add_argument(
+    '--max_radius',
+    help='Largest Hamming radius to try',
+    type=int,
+    default=3)
+parser.add_argument(
+    '--redis',
+    help='Redis server to read the rotation matrix from')
+args = parser.parse_args()
+
+np.random.seed(0)
+centers = np.maximum(np.random.randn(args.clusters, args.dim), 0)
+X = np.maximum(centers[np.random.randint(args.clusters, size=args.n)] + .5*np.random.randn(args.n, args.dim), 0).astype(np.float32)
+
+if args.redis:
+    import redis
+    from hamming import HammingService
+    service = HammingService(redis.StrictRedis(args.redis))
+    service.load()
+    R = service.R
+    args.dim = R.shape[1]
+else:
+    R = np.linalg.qr(np.random.randn(args.dim, args.bits))[0].T
+
+t0 = time.time()
+codes = binary_codes(R, X)
+print 'Hashed {} vectors to {} bits in {:.2f}s'.format(args.n, R.shape[0], time.time() - t0)
+
+index = HammingIndex(R.shape[0], args.dim)
+t0 = time.time()
+for i in xrange(args.n):
+    index.add(i, codes[i], X[i])
+print 'Built index with {} buckets in {:.2f}s'.format(len(index.buckets), time.time() - t0)
+
+queries = np.random.choice(args.n, args.queries, replace=False)
+normalised = index.vectors.vectors[:args.n]
+
+t0 = time.time()
+truth = []
+for q in queries:
+    scores = normalised.dot(normalised[q])
+    scores[q] = -np.inf
+    truth.append(set(np.argpartition(-scores, args.num)[:args.num]))
+brute_force = (time.time() - t0)/args.queries
+
+print '{:>6} {:>10} {:>12} {:>12}'.format('radius', 'recall', 'candidates', 'latency (ms)')
+for radius in range(args.max_radius + 1):
+    recall = []
+    candidates = []
+    t0 = time.time()
+    for q, relevant in zip(queries, truth):
+        found = index.query(codes[q], X[q], radius, args.num, exclude=q)
+        recall.append(len(relevant.intersection([ name for name, _ in found ]))/args.num)
+    latency = (time.time() - t0)/args.queries
+    for q in queries[:20]:
+        candidates.append(len(index.candidates(codes[q], radius)))
+    print '{:>6} {:>10.3f} {:>12.1f} {:>12.3f}'.format(radius, np.mean(recall), np.mean(candidates), 1000*latency)
+
+print '{:>6} {:>10.3f} {:>12} {:>12.3f}'.format('brute', 1., args.n, 1000*brute_force)
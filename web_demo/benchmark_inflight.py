@@ -0,0 +1,129 @@
+'''
+Work saved by single-flight classification on a bursty workload with many duplicates:
+bursts of requests arrive at Poisson times, each for a few images, and every image is
+submitted several times within a few seconds, as when an ad is posted and reposted. A
+simulated worker classifies the queue at a fixed time per image on a virtual clock.
+Each request has its own result queue, and its latency is the time until the result is
+pushed on it. The run is done with every request queued, and with the claims of
+inflight.py.
+'''
+
+from __future__ import division
+import argparse
+import random
+import time
+
+import numpy as np
+import redis
+
+import inflight
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--bursts',
+    type=int,
+    default=200)
+parser.add_argument(
+    '--burst_rate',
+    help='Bursts per second',
+    type=float,
+    default=1)
+parser.add_argument(
+    '--images_per_burst',
+    type=int,
+    default=5)
+parser.add_argument(
+    '--copies',
+    help='Mean number of times each image of a burst is submitted',
+    type=float,
+    default=6)
+parser.add_argument(
+    '--spread',
+    help='Seconds the copies of an image arrive within',
+    type=float,
+    default=3)
+parser.add_argument(
+    '--corpus',
+    help='Number of distinct images the bursts draw from',
+    type=int,
+    default=100000)
+parser.add_argument(
+    '--service_time',
+    help='Seconds to download and classify an image',
+    type=float,
+    default=.05)
+parser.add_argument(
+    '--queue',
+    default='benchmark:inflight')
+parser.add_argument(
+    '--redis_server',
+    default='localhost')
+parser.add_argument(
+    '--redis_port',
+    type=int,
+    default=6379)
+args = parser.parse_args()
+
+class Specs(object):
+    '''The worker side of a task.'''
+    def __init__(self, task):
+        self.__dict__.update(task)
+
+def arrivals():
+    '''(time, path, res_q) of the requests, in time order.'''
+    requests = []
+    t = 0.
+    for _ in range(args.bursts):
+        t += random.expovariate(args.burst_rate)
+        for _ in range(args.images_per_burst):
+            path = 'http://images.example.com/{}.jpg'.format(random.randrange(args.corpus))
+            for _ in range(max(1, np.random.geometric(1/args.copies))):
+                requests.append((t + random.uniform(0, args.spread), path, 'result:{}'.format(len(requests))))
+    return sorted(requests)
+
+def simulate(r_server, requests, single_flight):
+    '''Returns the number of images classified and the latency of every request.'''
+    for key in r_server.keys('inflight:{}:*'.format(args.queue)):
+        r_server.delete(key)
+    sent = dict((res_q, t) for t, _, res_q in requests)
+    queue = []
+    latencies = []
+    classified = 0
+    now = 0.
+    i = 0
+    while i < len(requests) or queue:
+        if not queue and requests[i][0] > now:
+            now = requests[i][0]
+        while i < len(requests) and requests[i][0] <= now:
+            t, path, res_q = requests[i]
+            task = {'group': 'web', 'path': path, 'res_q': res_q, 'priority': 'default'}
+            if not single_flight or inflight.claim(r_server, args.queue, [ task ]):
+                queue.append(task)
+            i += 1
+
+        task = queue.pop(0)
+        now += args.service_time
+        classified += 1
+        if single_flight:
+            waiters = inflight.release(r_server, args.queue, Specs(task)).res_qs
+        else:
+            waiters = [ task['res_q'] ]
+        latencies.extend([ now - sent[res_q] for res_q in waiters ])
+    return classified, latencies
+
+r_server = redis.StrictRedis(args.redis_server, args.redis_port)
+random.seed(0)
+np.random.seed(0)
+requests = arrivals()
+print '{} requests for {} distinct images, the worker classifies {:.0f} images/s'.format(
+    len(requests), len(set([ path for _, path, _ in requests ])), 1/args.service_time)
+
+for name, single_flight in [ ('Every request queued', False), ('Single flight', True) ]:
+    t0 = time.time()
+    classified, latencies = simulate(r_server, requests, single_flight)
+    print '{}: {} images classified ({:.0f}% of the requests) for {} requests, latency p50 {:.2f}s p99 {:.2f}s, {:.1f}s to run'.format(
+        name, classified, 100*classified/len(requests), len(latencies),
+        np.percentile(latencies, 50), np.percentile(latencies, 99), time.time() - t0)
+
+print 'Claim statistics: {}'.format(inflight.stats(r_server).get(args.queue))
+r_server.hdel(inflight.STATS, '{}:claimed'.format(args.queue), '{}:joined'.format(args.queue))
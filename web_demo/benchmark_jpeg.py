@@ -0,0 +1,69 @@
+'''
+Micro-benchmark of the in-memory JPEG normalisation against the old tempfile based
+convert_to_jpg. Uses the given images, or synthetic JPEG and PNG images if none are given.
+'''
+
+from __future__ import division
+import argparse
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+import cStringIO as StringIO
+
+from wand.image import Image
+
+from jpegutil import to_jpeg, sniff
+
+@contextmanager
+def convert_to_jpg(data):
+    '''The old path: decode with Wand, write to a tempfile that is read back.'''
+    tmp = tempfile.NamedTemporaryFile(delete=False)
+
+    with Image(file=StringIO.StringIO(data)) as img:
+        if img.format != 'JPEG':
+            img.format = 'JPEG'
+        img.save(tmp)
+
+    tmp.close()
+    yield tmp.name
+    os.remove(tmp.name)
+
+def tempfile_path(data):
+    with convert_to_jpg(data) as jpg:
+        with open(jpg, 'rb') as _file:
+            return _file.read()
+
+def synthetic(fmt, width=500, height=375):
+    with Image(width=width, height=height, pseudo='plasma:') as img:
+        img.format = fmt
+        return img.make_blob()
+
+def timed(function, data, repeats):
+    t0 = time.time()
+    for _ in xrange(repeats):
+        function(data)
+    return (time.time() - t0)/repeats
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    'images',
+    help='Images to benchmark with',
+    nargs='*')
+parser.add_argument(
+    '--repeats',
+    help='How many times to normalise each image',
+    type=int,
+    default=100)
+args = parser.parse_args()
+
+if args.images:
+    images = [ (os.path.basename(path), open(path, 'rb').read()) for path in args.images ]
+else:
+    images = [ ('synthetic.jpg', synthetic('JPEG')), ('synthetic.png', synthetic('PNG')) ]
+
+print '{:<30} {:>6} {:>10} {:>14} {:>14} {:>8}'.format('image', 'format', 'bytes', 'tempfile (ms)', 'in-memory (ms)', 'speedup')
+for name, data in images:
+    old = timed(tempfile_path, data, args.repeats)
+    new = timed(to_jpeg, data, args.repeats)
+    print '{:<30} {:>6} {:>10} {:>14.3f} {:>14.3f} {:>7.1f}x'.format(name[:30], sniff(data), len(data), 1000*old, 1000*new, old/new)
@@ -0,0 +1,79 @@
+'''
+Overhead of the stage metrics: a simulated worker loop with the timers against the
+same loop without them, plus the cost of a single measurement and of a flush to redis.
+'''
+
+from __future__ import division
+import argparse
+import time
+
+import redis
+
+from metrics import Metrics
+
+def work(seconds):
+    '''Busy waits, sleeping is too coarse for the short stages.'''
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+def loop(tasks, stages, timings=None):
+    t0 = time.time()
+    for _ in xrange(tasks):
+        for stage, seconds in stages:
+            if timings is None:
+                work(seconds)
+            else:
+                with timings.time(stage):
+                    work(seconds)
+    return time.time() - t0
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--tasks',
+    help='Number of simulated tasks',
+    type=int,
+    default=2000)
+parser.add_argument(
+    '--records',
+    help='Number of measurements to time record with',
+    type=int,
+    default=200000)
+parser.add_argument(
+    '--redis_server',
+    default='localhost')
+parser.add_argument(
+    '--redis_port',
+    type=int,
+    default=6379)
+args = parser.parse_args()
+
+r_server = redis.StrictRedis(args.redis_server, args.redis_port)
+
+# Typical stage times of tf_worker on a GPU, in seconds.
+stages = [ ('queue_wait', 0), ('download', 0), ('decode', .0005), ('inference', .002), ('write', .0003) ]
+
+timings = Metrics(None, 'benchmark')
+t0 = time.time()
+for i in xrange(args.records):
+    timings.record('inference', i*1e-6)
+record_time = (time.time() - t0)/args.records
+
+timings = Metrics(r_server, 'benchmark', flush_interval=1e9)
+for stage, _ in stages:
+    timings.record(stage, .001)
+t0 = time.time()
+timings.flush()
+flush_time = time.time() - t0
+
+without = loop(args.tasks, stages)
+timings = Metrics(r_server, 'benchmark', flush_interval=1)
+with_metrics = loop(args.tasks, stages, timings)
+
+print 'record: {:.2f} us, flush of {} stages: {:.2f} ms'.format(1e6*record_time, len(stages), 1000*flush_time)
+print 'worker loop without metrics {:.3f} s, with {:.3f} s, overhead {:.2f}% ({:.2f} us per task)'.format(
+    without, with_metrics, 100*(with_metrics - without)/without, 1e6*(with_metrics - without)/args.tasks)
+
+for key in r_server.keys('metrics:benchmark:*'):
+    r_server.srem('metrics:stages', key)
+    r_server.delete(key)
@@ -0,0 +1,63 @@
+'''
+Benchmark of the binary queue protocol against the pickled dicts used before, for
+single tasks and batches of tasks: encode and decode throughput, and message size.
+'''
+
+from __future__ import division
+import argparse
+import cPickle as pickle
+import time
+
+import protocol
+
+def timed(function, repeats):
+    t0 = time.time()
+    for _ in xrange(repeats):
+        function()
+    return (time.time() - t0)/repeats
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--batch_size',
+    help='Number of tasks in a batch message',
+    type=int,
+    default=100)
+parser.add_argument(
+    '--repeats',
+    help='How many times to encode and decode each payload',
+    type=int,
+    default=10000)
+args = parser.parse_args()
+
+task = {'group': 'web', 'path': 'http://img.ekhanei.com/images/54/5467523091.jpg',
+        'ad_id': '5467523091', 'res_q': 'kaidee_results'}
+batch = [ dict(task, path=task['path'].replace('5467523091', str(5467523091 + i))) for i in xrange(args.batch_size) ]
+
+formats = [
+    ('pickle protocol 0', lambda: pickle.dumps(task), lambda: [ pickle.dumps(t) for t in batch ],
+     lambda data: pickle.loads(data)),
+    ('pickle highest', lambda: pickle.dumps(task, pickle.HIGHEST_PROTOCOL),
+     lambda: [ pickle.dumps(t, pickle.HIGHEST_PROTOCOL) for t in batch ], lambda data: pickle.loads(data)),
+    ('msgpack', lambda: protocol.dumps('task', task), lambda: [ protocol.dumps_batch('task', batch) ],
+     lambda data: protocol.loads(data, 'task')),
+]
+
+print '{:<18} {:>12} {:>12} {:>8} {:>14} {:>14} {:>8}'.format(
+    'format', 'encode/s', 'decode/s', 'bytes', 'batch enc/s', 'batch dec/s', 'bytes')
+
+for name, encode, encode_batch, decode in formats:
+    single = encode()
+    messages = encode_batch()
+    # Pickled batches are one message per task, as they were pushed before.
+    decode_batch = lambda: [ decode(data) for data in messages ]
+
+    encode_time = timed(encode, args.repeats)
+    decode_time = timed(lambda: decode(single), args.repeats)
+    batch_repeats = max(1, args.repeats//args.batch_size)
+    batch_encode_time = timed(encode_batch, batch_repeats)
+    batch_decode_time = timed(decode_batch, batch_repeats)
+
+    print '{:<18} {:>12.0f} {:>12.0f} {:>8} {:>14.0f} {:>14.0f} {:>8}'.format(
+        name, 1/encode_time, 1/decode_time, len(single),
+        args.batch_size/batch_encode_time, args.batch_size/batch_decode_time,
+        sum([ len(data) for data in messages ]))
@@ -0,0 +1,150 @@
+'''
+Latency of interactive requests behind a bulk backfill, with one FIFO work queue against
+the priority classes of the FairScheduler. A simulated worker classifies batches at a
+fixed time per image, on a virtual clock so the run takes seconds, while a bulk backlog
+is queued at the start in batches of --task_batch tasks per list element, as the web
+demo queues uploads, and interactive and default requests arrive one by one at Poisson
+rates. Interactive requests have a deadline, and those that expire are dropped.
+'''
+
+from __future__ import division
+import argparse
+import random
+import time
+from collections import namedtuple
+
+import numpy as np
+import redis
+
+import protocol
+from scheduling import FairScheduler, Expired, check_deadline, queue_for, queues, WEIGHTS
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--backlog',
+    help='Number of bulk images queued at the start',
+    type=int,
+    default=20000)
+parser.add_argument(
+    '--interactive_rate',
+    help='Interactive images per second',
+    type=float,
+    default=20)
+parser.add_argument(
+    '--default_rate',
+    help='Default images per second',
+    type=float,
+    default=40)
+parser.add_argument(
+    '--service_time',
+    help='Seconds of inference per image',
+    type=float,
+    default=.01)
+parser.add_argument(
+    '--task_batch',
+    help='Bulk tasks per list element',
+    type=int,
+    default=100)
+parser.add_argument(
+    '--batch_size',
+    type=int,
+    default=16)
+parser.add_argument(
+    '--deadline',
+    help='Seconds an interactive image may wait',
+    type=float,
+    default=5)
+parser.add_argument(
+    '--duration',
+    help='Simulated seconds of arrivals',
+    type=float,
+    default=120)
+parser.add_argument(
+    '--queue',
+    default='benchmark:scheduling')
+parser.add_argument(
+    '--redis_server',
+    default='localhost')
+parser.add_argument(
+    '--redis_port',
+    type=int,
+    default=6379)
+args = parser.parse_args()
+
+Specs = namedtuple('Specs', protocol.NAMES['task'])
+
+def arrivals():
+    '''(time, priority, deadline) of the tasks, in time order.'''
+    tasks = [ (0., 'bulk', 0.) ]*args.backlog
+    for priority, rate, deadline in [ ('interactive', args.interactive_rate, args.deadline),
+                                      ('default', args.default_rate, 0.) ]:
+        t = random.expovariate(rate)
+        while t < args.duration:
+            tasks.append((t, priority, t + deadline if deadline else 0.))
+            t += random.expovariate(rate)
+    return sorted(tasks, key=lambda task: task[0])
+
+def simulate(r_server, tasks, fair):
+    '''Runs the worker on the virtual clock until all tasks are done, returns the
+    latencies by class, the number of expired tasks by class and the makespan.'''
+    for key in queues(args.queue):
+        r_server.delete(key)
+    # FIFO: every class goes on the work queue itself, read by a single class scheduler.
+    scheduler = FairScheduler(r_server, args.queue, WEIGHTS if fair else [ ('default', 1) ])
+
+    latencies = dict((priority, []) for priority, _ in WEIGHTS)
+    expired = dict((priority, 0) for priority, _ in WEIGHTS)
+    now = 0.
+    i = 0
+    done = 0
+    while done < len(tasks):
+        if i < len(tasks) and tasks[i][0] > now and done == i:
+            # Idle until the next arrival, the scheduler would block.
+            now = tasks[i][0]
+        pipe = r_server.pipeline()
+        while i < len(tasks) and tasks[i][0] <= now:
+            priority = tasks[i][1]
+            size = args.task_batch if priority == 'bulk' else 1
+            end = i + 1
+            while end < len(tasks) and end - i < size and tasks[end][1] == priority and tasks[end][0] <= now:
+                end += 1
+            batch = [ {'path': str(j), 'queued_at': tasks[j][0], 'deadline': tasks[j][2], 'priority': priority }
+                      for j in range(i, end) ]
+            pipe.lpush(queue_for(args.queue, priority if fair else 'default'), protocol.dumps_batch('task', batch))
+            i = end
+        pipe.execute()
+
+        classified = []
+        for task in scheduler.collect(args.batch_size):
+            for specs in protocol.loads(task.value, 'task'):
+                done += 1
+                try:
+                    check_deadline(Specs(**specs), now)
+                    classified.append(specs)
+                except Expired:
+                    expired[specs['priority']] += 1
+        now += args.service_time*len(classified)
+        for specs in classified:
+            latencies[specs['priority']].append(now - specs['queued_at'])
+    return latencies, expired, now
+
+r_server = redis.StrictRedis(args.redis_server, args.redis_port)
+random.seed(0)
+tasks = arrivals()
+print '{} tasks, {} bulk at the start, the worker classifies {:.0f} images/s'.format(
+    len(tasks), args.backlog, 1/args.service_time)
+
+for name, fair in [ ('FIFO', False), ('Fair', True) ]:
+    t0 = time.time()
+    latencies, expired, makespan = simulate(r_server, tasks, fair)
+    print '{}: done after {:.0f} simulated seconds, {:.1f}s to run'.format(name, makespan, time.time() - t0)
+    for priority, _ in WEIGHTS:
+        values = latencies[priority]
+        if not values and not expired[priority]:
+            continue
+        print '    {:12} {:6} classified, {:5} expired, latency p50 {:7.2f}s p99 {:7.2f}s'.format(
+            priority, len(values), expired[priority],
+            np.percentile(values, 50) if values else 0, np.percentile(values, 99) if values else 0)
+
+for key in queues(args.queue):
+    r_server.delete(key)
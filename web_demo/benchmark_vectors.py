@@ -0,0 +1,102 @@
+'''
+The vector encodings of vectors.py against the blosc vectors written before: bytes per
+vector and redis memory for a category hash, decode speed one at a time and in bulk,
+and the retrieval quality of cosine similarity, as the recall of the exact top 10
+neighbours and the error of the similarities.
+
+The vectors are synthetic, non-negative and clustered like pool_3 outputs. Give
+--vectors a .npy file of real pool_3 vectors (n, 2048) to use those instead.
+'''
+
+from __future__ import division
+import argparse
+import time
+
+import numpy as np
+import redis
+
+import vectors
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--n',
+    help='Number of vectors',
+    type=int,
+    default=10000)
+parser.add_argument(
+    '--vectors',
+    help='A .npy file of real vectors to use')
+parser.add_argument(
+    '--queries',
+    type=int,
+    default=200)
+parser.add_argument(
+    '--key',
+    default='benchmark:vectors')
+parser.add_argument(
+    '--redis_server',
+    default='localhost')
+parser.add_argument(
+    '--redis_port',
+    type=int,
+    default=6379)
+args = parser.parse_args()
+
+def synthetic(n, dim=2048, clusters=50):
+    '''Rectified, averaged activations: mostly small values, a few large ones, and
+    vectors of the same cluster share their large components.'''
+    rng = np.random.RandomState(0)
+    centers = rng.gamma(.3, 1., (clusters, dim))
+    noise = rng.gamma(.3, .5, (n, dim))
+    return (centers[rng.randint(clusters, size=n)] + noise).astype(np.float32)
+
+def normalise(X):
+    return X/np.maximum(np.linalg.norm(X, axis=1), 1e-12)[:, np.newaxis]
+
+def top10(X, queries):
+    scores = X.dot(X[queries].T)
+    scores[queries, np.arange(len(queries))] = -np.inf
+    return np.argsort(-scores, axis=0)[:10].T, scores
+
+def used_memory(r_server):
+    try:
+        return r_server.info('memory')['used_memory']
+    except Exception:
+        return None
+
+X = np.load(args.vectors).astype(np.float32)[:args.n] if args.vectors else synthetic(args.n)
+r_server = redis.StrictRedis(args.redis_server, args.redis_port)
+queries = np.random.RandomState(1).choice(len(X), args.queries, replace=False)
+exact, exact_scores = top10(normalise(X), queries)
+print '{} vectors of dimension {}, {} queries'.format(len(X), X.shape[1], len(queries))
+
+for format in vectors.FORMATS:
+    encoded = [ vectors.encode(x, format) for x in X ]
+
+    r_server.delete(args.key)
+    before = used_memory(r_server)
+    pipe = r_server.pipeline(transaction=False)
+    for i, data in enumerate(encoded):
+        pipe.hset(args.key, 'http://images.example.com/{}.jpg'.format(i), data)
+    pipe.execute()
+    after = used_memory(r_server)
+    memory = '{:.1f} MB'.format((after - before)/2**20) if before is not None and after is not None else '-'
+    r_server.delete(args.key)
+
+    t0 = time.time()
+    for data in encoded:
+        vectors.decode(data)
+    single = (time.time() - t0)/len(encoded)
+    t0 = time.time()
+    decoded = vectors.decode_many(encoded)
+    bulk = (time.time() - t0)/len(encoded)
+
+    found, scores = top10(normalise(decoded), queries)
+    recall = np.mean([ len(set(a) & set(b))/10 for a, b in zip(exact, found) ])
+    finite = np.isfinite(exact_scores)
+    error = np.abs(scores[finite] - exact_scores[finite])
+
+    print '{:8} {:6.0f} bytes/vector, redis {:>9}, decode {:6.2f}us one at a time, {:6.2f}us in bulk, ' \
+        'recall@10 {:.4f}, cosine error mean {:.1e} max {:.1e}'.format(
+            format, np.mean([ len(data) for data in encoded ]), memory, 1e6*single, 1e6*bulk,
+            recall, error.mean(), error.max())
@@ -0,0 +1,98 @@
+'''
+In-process copy of the Telenor Bulgaria network graph for the network utilization
+endpoints. The edges are loaded from redis once into NumPy arrays, ordered by distance
+and by number of observations, so the filters are range queries plus a vectorised mask.
+'''
+
+from __future__ import division
+import threading
+import cStringIO as StringIO
+
+import numpy as np
+
+def to_npz(**arrays):
+    '''Compact binary response, read it with numpy.load.'''
+    buf = StringIO.StringIO()
+    np.savez_compressed(buf, **arrays)
+    return buf.getvalue()
+
+class EdgeStore(object):
+
+    def __init__(self, r_server):
+        self.red = r_server
+        self.loaded = False
+        self._trajectories = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self.loaded:
+                return
+
+            edges_dist = self.red.zrange('bulgaria_network:edges_dist', 0, -1, withscores=True)
+            self.names = np.array([ name for name, _ in edges_dist ], dtype=object)
+            self.distance = np.array([ distance for _, distance in edges_dist ], dtype=np.float64)
+            self.rows = dict((name, i) for i, name in enumerate(self.names))
+
+            # Edges without observations never pass the threshold.
+            self.observations = np.full(len(self.names), -np.inf)
+            rows, counts = self._aligned(self.red.zrange('bulgaria_network:edges', 0, -1, withscores=True))
+            self.observations[rows] = counts
+            self.by_observations = np.argsort(self.observations, kind='mergesort')
+
+            vertices = self.red.zrange('bulgaria_network:vertices', 0, -1, withscores=True)
+            self.vertex_names = np.array([ name for name, _ in vertices ], dtype=object)
+            self.vertex_observations = np.array([ count for _, count in vertices ], dtype=np.float64)
+
+            self.loaded = True
+
+    def edges(self, threshold, distance_min, distance_max, observations=None):
+        '''Rows of the edges with at least threshold observations and a distance within
+        [distance_min, distance_max], ordered by decreasing number of observations.'''
+        self.load()
+        lo = np.searchsorted(self.distance, distance_min, side='left')
+        hi = np.searchsorted(self.distance, distance_max, side='right')
+
+        if observations is None:
+            observations = self.observations
+            first = np.searchsorted(observations[self.by_observations], threshold, side='left')
+        else:
+            first = 0
+
+        # Range query on whichever ordering leaves the fewest edges to mask.
+        if first and len(observations) - first < hi - lo:
+            rows = self.by_observations[first:]
+            rows = rows[(self.distance[rows] >= distance_min) & (self.distance[rows] <= distance_max)]
+        else:
+            rows = lo + np.where(observations[lo:hi] >= threshold)[0]
+
+        return rows[np.argsort(-observations[rows], kind='mergesort')]
+
+    def vertices(self, threshold):
+        self.load()
+        first = np.searchsorted(self.vertex_observations, threshold, side='left')
+        return self.vertex_names[first:][::-1], self.vertex_observations[first:][::-1]
+
+    def trajectory_observations(self, traj_min, traj_max):
+        '''Observations of each edge summed over the trajectory lengths in [traj_min, traj_max).'''
+        self.load()
+        total = np.zeros(len(self.names))
+        observed = np.zeros(len(self.names), dtype=bool)
+        for length in range(traj_min, traj_max):
+            if length not in self._trajectories:
+                key = 'bulgaria_trajectories:{}'.format(length)
+                self._trajectories[length] = self._aligned(self.red.zrange(key, 0, -1, withscores=True))
+            rows, counts = self._trajectories[length]
+            total[rows] += counts
+            observed[rows] = True
+        total[~observed] = -np.inf
+        return total
+
+    def _aligned(self, members):
+        '''Rows and scores of the members that are known edges.'''
+        rows, scores = [], []
+        for name, score in members:
+            if name in self.rows:
+                rows.append(self.rows[name])
+                scores.append(score)
+        return np.array(rows, dtype=np.int64), np.array(scores, dtype=np.float64)
@@ -63,11 +63,35 @@ class ImagenetClassifier(object):
         self.bet['infogain'] -= np.array(self.bet['preferences']) * 0.1
 
 
+    def monte_carlo_scores(self, image, passes=100, batch_size=100):
+        '''The scores of passes stochastic forward passes over the ten oversampled
+        crops of the image, averaged over the crops like net.predict. The crops are
+        made and preprocessed once, and the passes run in batches of about batch_size
+        crops, so only one batch of inputs is in memory at a time.'''
+        net = self.net
+        in_ = net.inputs[0]
+        crops = caffe.io.oversample([ caffe.io.resize_image(image, net.image_dims) ], net.crop_dims)
+        data = np.asarray([ net.transformer.preprocess(in_, crop) for crop in crops ])
+
+        chunk = max(1, batch_size//len(crops))
+        shape = net.blobs[in_].data.shape
+        scores = []
+        try:
+            net.blobs[in_].reshape(chunk*len(crops), *data.shape[1:])
+            for start in range(0, passes, chunk):
+                # forward_all pads the last, smaller chunk up to the blob size.
+                out = net.forward_all(**{in_: np.tile(data, (min(chunk, passes - start), 1, 1, 1))})
+                scores.append(out[net.outputs[0]].reshape(-1, len(crops), out[net.outputs[0]].shape[-1]))
+        finally:
+            # classify_image expects the input blob of the model definition.
+            net.blobs[in_].reshape(*shape)
+        return np.concatenate(scores).mean(axis=1)
+
     # This requires dropout to be enabled for classification as well, not only during training.
-    def iteratively_classify_image(self, image):
+    def iteratively_classify_image(self, image, passes=100, batch_size=100):
         try:
             starttime = time.time()
-            scores = np.array([ self.net.predict([image], oversample=True).flatten() for _ in range(100) ])
+            scores = self.monte_carlo_scores(image, passes, batch_size)
             endtime = time.time()
 
             means = scores.mean(axis=0)
@@ -77,7 +101,7 @@ class ImagenetClassifier(object):
             dist = zip(means[top_five], stds[top_five], self.labels[top_five])
             
             # Summing up
-            scores = scores.mean(axis=0)
+            scores = means
             indices = (-scores).argsort()[:5]
             predictions = self.labels[indices]
 
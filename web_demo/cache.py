@@ -0,0 +1,54 @@
+'''
+A small thread-safe in-process LRU cache with time-to-live expiry.
+'''
+
+import time
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    '''Keeps at most maxsize items, each for at most ttl seconds (None means forever).'''
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+
+            # Re-inserting marks it as the most recently used.
+            self._items[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, time.time() + ttl if ttl is not None else None)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
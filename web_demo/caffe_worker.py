@@ -8,7 +8,6 @@ import argparse
 from collections import namedtuple
 import cStringIO as StringIO
 import logging
-import cPickle as pickle
 import os
 
 import requests
@@ -18,7 +17,9 @@ import caffe
 import redis
 
 from bvlc import ImagenetClassifier
+from metrics import Metrics
 import exifutil
+import protocol
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument(
@@ -54,29 +55,40 @@ Result = namedtuple('Result', 'OK maximally_accurate maximally_specific computat
 
 r_server = redis.StrictRedis(args.server, args.port)
 r_server.config_set('notify-keyspace-events', 'Kh')
+timings = Metrics(r_server, 'caffe_worker')
 
-while True:
-    task = Task(*r_server.brpop(args.queue))
-    specs = Specs(**pickle.loads(task.value))
+def classify(specs):
     logging.info(specs)
     result_key = 'prediction:{}:{}'.format(specs.user, specs.path)
 
     try:
         URL = not os.path.isfile(specs.path)
         if URL:
-            response = requests.get(specs.path, timeout=10)
-            string_buffer = StringIO.StringIO(response.content)
-            image = caffe.io.load_image(string_buffer)
+            with timings.time('download'):
+                response = requests.get(specs.path, timeout=10)
+            with timings.time('decode'):
+                string_buffer = StringIO.StringIO(response.content)
+                image = caffe.io.load_image(string_buffer)
         else:
-            image = exifutil.open_oriented_im(specs.path)
+            with timings.time('decode'):
+                image = exifutil.open_oriented_im(specs.path)
 
-        result = Result(*model.classify_image(image))
-        r_server.hmset(result_key, result._asdict())
+        with timings.time('inference'):
+            result = Result(*model.classify_image(image))
 
-        if URL:
-            r_server.zadd('prediction:{}:category:{}'.format(specs.user, result.maximally_specific[0][0]),
-                          result.maximally_specific[0][1], specs.path)
+        with timings.time('write'):
+            r_server.hmset(result_key, result._asdict())
+
+            if URL:
+                r_server.zadd('prediction:{}:category:{}'.format(specs.user, result.maximally_specific[0][0]),
+                              result.maximally_specific[0][1], specs.path)
 
     except Exception as e:
         logging.error('Something went wrong when classifying the image: {}'.format(e))
         r_server.hmset(result_key, {'OK': 'False'})
+
+while True:
+    task = Task(*r_server.brpop(args.queue))
+    # A value may hold a batch of tasks, the user is the group of the task.
+    for message in protocol.loads(task.value, 'task'):
+        classify(Specs(message['group'], message['path']))
@@ -0,0 +1,82 @@
+'''
+Sends events to the websocket clients from the Tornado IOLoop. Events may be published
+from any thread, they are rendered once by the publisher and buffered. At most every
+interval seconds the buffered events are joined into one frame, which is written to all
+the clients. A client that has not yet received max_pending frames is skipped, so a slow
+client loses updates instead of holding up the others or growing its buffer.
+'''
+
+import time
+import threading
+from collections import deque
+
+import tornado.ioloop
+import tornado.websocket
+
+class FanOut(object):
+
+    def __init__(self, io_loop=None, interval=.25, max_events=50, max_pending=4):
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.interval = interval
+        self.max_pending = max_pending
+        # In a burst only the newest events are kept.
+        self.events = deque(maxlen=max_events)
+        self.pending = {}
+        self.scheduled = False
+        self.last_flush = 0
+        self.frames = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def add(self, client):
+        self.pending[client] = 0
+
+    def remove(self, client):
+        self.pending.pop(client, None)
+
+    def publish(self, event):
+        '''Thread safe. event is the rendered message.'''
+        with self._lock:
+            self.events.append(event)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.io_loop.add_callback(self._schedule)
+
+    def _schedule(self):
+        delay = max(0, self.last_flush + self.interval - time.time())
+        self.io_loop.call_later(delay, self.flush)
+
+    def flush(self):
+        with self._lock:
+            events = list(self.events)
+            self.events.clear()
+            self.scheduled = False
+        self.last_flush = time.time()
+        if not events:
+            return
+
+        # The clients prepend each frame, so the newest event goes first.
+        frame = ''.join(reversed(events))
+        self.frames += 1
+        for client in self.pending.keys():
+            self._send(client, frame)
+
+    def _send(self, client, frame):
+        if self.pending[client] >= self.max_pending:
+            self.dropped += 1
+            return
+        try:
+            future = client.write_message(frame)
+        except tornado.websocket.WebSocketClosedError:
+            self.remove(client)
+            return
+
+        # Older Tornado versions do not say when the frame is sent.
+        if future is not None:
+            self.pending[client] += 1
+            future.add_done_callback(lambda _: self._sent(client))
+
+    def _sent(self, client):
+        if client in self.pending:
+            self.pending[client] -= 1
@@ -0,0 +1,57 @@
+'''
+Decoding of the encoded ad titles in the reports, i.e. rows like "12,5,33" of indices
+into the grapheme encoding. A whole column is decoded at once: the indices of all
+the rows are parsed in one go and gathered from a lookup array.
+'''
+
+import json
+
+import numpy as np
+
+# Marks the end of each row in the gathered matrix, never part of a title.
+END = u'\x00'
+
+def _malformed(rows):
+    for row in rows:
+        if row and len(np.fromstring(row, dtype=np.int64, sep=',')) != row.count(',') + 1:
+            return row
+
+class GraphemeDecoder(object):
+    '''encoding maps (string) indices to graphemes. Indices missing from the encoding,
+    such as the 0 the titles are padded with, decode to nothing.'''
+
+    def __init__(self, encoding):
+        size = max([ int(i) for i in encoding ]) + 1 if encoding else 0
+        # The two extra slots are for the indices out of range and the end of row marker.
+        self.table = np.empty(size + 2, dtype=object)
+        self.table[:] = u''
+        for i, grapheme in encoding.iteritems():
+            self.table[int(i)] = grapheme
+        self.pad = size
+        self.end = size + 1
+        self.table[self.end] = END
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as _file:
+            return cls(json.load(_file))
+
+    def decode(self, rows):
+        '''Decodes an iterable of comma separated index strings to a list of titles.'''
+        rows = list(rows)
+        lengths = np.array([ row.count(',') + 1 if row else 0 for row in rows ], dtype=np.int64)
+        if not lengths.sum():
+            return [ u'' ]*len(rows)
+
+        codes = np.fromstring(','.join([ row for row in rows if row ]), dtype=np.int64, sep=',')
+        # Parsing stops at the first index that is not a number, empty ones included.
+        if len(codes) != lengths.sum():
+            raise ValueError('Not a row of comma separated indices: {!r}'.format(_malformed(rows)))
+        codes[(codes < 0) | (codes >= self.pad)] = self.pad
+
+        # The end of row markers make it possible to split the titles after one join.
+        sequence = np.insert(codes, np.cumsum(lengths), self.end)
+        return u''.join(self.table[sequence].tolist()).split(END)[:-1]
+
+    def __getitem__(self, i):
+        return self.table[int(i)]
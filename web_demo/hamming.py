@@ -0,0 +1,229 @@
+'''
+Query engine for the AQBC hash codes that transfer_classifier.py writes to the
+hashing:codes:<bits> buckets. Codes are packed into uint64 words, candidates are
+found by probing all codes within a Hamming radius (or by a popcount scan over all
+buckets, whichever is cheaper), and re-ranked by exact cosine similarity.
+
+Angular quantization-based binary codes:
+https://papers.nips.cc/paper/4831-angular-quantization-based-binary-codes-for-fast-similarity-search.pdf
+'''
+
+from __future__ import division
+import itertools
+import threading
+
+import numpy as np
+import blosc
+
+from similarity import CategoryIndex
+from vectors import decode, decode_many
+
+POPCOUNT = np.array([ bin(i).count('1') for i in range(256) ], dtype=np.uint8)
+
+def binary_codes(R, X):
+    '''Vectorised nearest binary landmarks, as in aqbc_utils.nearest_binary_landmark.
+    R is the (bits, dim) rotation matrix, X is (n, dim). Returns (n, bits) booleans.'''
+    y = np.dot(np.atleast_2d(X), R.T)
+    n, c = y.shape
+    rows = np.arange(n)[:, np.newaxis]
+
+    order = np.argsort(-y, axis=1)
+    sorted_y = y[rows, order]
+    psi = np.cumsum(sorted_y, axis=1)/np.sqrt(np.arange(1, c + 1))
+    # Only positive projections are set, and a code must improve on the all-zero one.
+    psi[sorted_y <= 0] = -np.inf
+    ones = np.argmax(psi, axis=1) + 1
+
+    ranks = np.empty_like(order)
+    ranks[rows, order] = np.arange(c)
+    codes = ranks < ones[:, np.newaxis]
+    codes[psi.max(axis=1) <= 0] = False
+    return codes
+
+def parse_code(text):
+    '''Bits from the string representation used in the redis keys.'''
+    text = text[2:] if text.startswith('0b') else text
+    return np.array([ bit == '1' for bit in text ], dtype=bool)
+
+def pack(codes):
+    '''Packs (n, bits) booleans into (n, words) uint64.'''
+    codes = np.atleast_2d(codes)
+    words = -(-codes.shape[1]//64)
+    padded = np.zeros((codes.shape[0], 64*words), dtype=bool)
+    padded[:, :codes.shape[1]] = codes
+    return np.packbits(padded, axis=1).view(np.uint64)
+
+def hamming_distances(packed, code):
+    '''Popcount of packed XOR code, for all the rows of packed.'''
+    return POPCOUNT[np.bitwise_xor(packed, code).view(np.uint8)].reshape(len(packed), -1).sum(axis=1)
+
+def comb(n, k):
+    return reduce(lambda total, i: total*(n - i)//(i + 1), range(k), 1)
+
+def flip_masks(bits, radius):
+    '''Packed masks for all the bit flips up to radius, the empty flip included.'''
+    masks = []
+    for r in range(radius + 1):
+        for flips in itertools.combinations(range(bits), r):
+            mask = np.zeros(bits, dtype=bool)
+            mask[list(flips)] = True
+            masks.append(mask)
+    return pack(np.array(masks))
+
+class HammingIndex(object):
+
+    def __init__(self, bits, dim=2048):
+        self.bits = bits
+        self.vectors = CategoryIndex(dim)
+        self.buckets = {}
+        self.code_of = {}
+        self._codes = []
+        self._packed = None
+        self._masks = {}
+
+    @property
+    def codes(self):
+        '''All the distinct codes, packed.'''
+        if self._packed is None:
+            self._packed = np.array(self._codes, dtype=np.uint64).reshape(-1, -(-self.bits//64))
+        return self._packed
+
+    def add(self, name, code, vector):
+        '''Adds or replaces an image, a replaced image moves to the bucket of its new code.'''
+        packed = pack(code)
+        key = packed.tostring()
+        old_key = pack(self.code_of[name]).tostring() if name in self.code_of else None
+        if old_key is not None and old_key != key:
+            self._remove(name, old_key)
+        if key not in self.buckets:
+            self.buckets[key] = []
+            self._codes.append(packed[0])
+            self._packed = None
+        if old_key != key:
+            self.buckets[key].append(name)
+        self.code_of[name] = code
+        self.vectors.add(name, vector)
+
+    def _remove(self, name, key):
+        bucket = self.buckets[key]
+        bucket.remove(name)
+        if not bucket:
+            del self.buckets[key]
+            self._codes = [ packed for packed in self._codes if packed.tostring() != key ]
+            self._packed = None
+
+    def candidates(self, code, radius):
+        packed = pack(code)
+        n_probes = sum([ comb(self.bits, r) for r in range(radius + 1) ])
+
+        if n_probes < len(self.buckets):
+            if radius not in self._masks:
+                self._masks[radius] = flip_masks(self.bits, radius)
+            probes = np.bitwise_xor(self._masks[radius], packed)
+            keys = [ probe.tostring() for probe in probes ]
+        else:
+            near = np.where(hamming_distances(self.codes, packed) <= radius)[0]
+            keys = [ self.codes[i].tostring() for i in near ]
+
+        return [ name for key in keys for name in self.buckets.get(key, []) ]
+
+    def query(self, code, vector, radius=2, num=10, exclude=None):
+        '''Returns the num most similar (name, cosine similarity) pairs among the
+        codes within radius.'''
+        names = [ name for name in self.candidates(code, radius) if name != exclude ]
+        if not names:
+            return []
+
+        q = vector/max(np.linalg.norm(vector), 1e-12)
+        scores = self.vectors.vectors[[ self.vectors.rows[name] for name in names ]].dot(q)
+        top = np.argsort(-scores)[:num]
+        return [ (names[i], float(scores[i])) for i in top ]
+
+    def __len__(self):
+        return len(self.vectors)
+
+class HammingService(object):
+    '''Loads all the hashing:codes:* buckets from redis, and is kept up to date with
+    update() from the 'latest' channel. Images published while the buckets are loaded
+    are added after the load.'''
+
+    def __init__(self, r_server):
+        self.red = r_server
+        self.index = None
+        self.R = None
+        self._missed = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        R_c = self.red.get('hashing:R')
+        if R_c is None:
+            raise KeyError('No rotation matrix in redis at key: <hashing:R>')
+        R = np.fromstring(blosc.decompress(R_c), dtype=np.float64)
+        bits = R.shape[0]//2048
+        self.R = R.reshape(2048, bits).T
+
+        index = HammingIndex(bits)
+        keys = list(self.red.scan_iter('hashing:codes:*'))
+        pipe = self.red.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        for key, bucket in zip(keys, pipe.execute()):
+            code = parse_code(key[len('hashing:codes:'):])
+            for name, vector in zip(bucket.keys(), decode_many(bucket.values())):
+                index.add(name, code, vector)
+        return index
+
+    def update(self, group, path):
+        '''Adds a newly classified image, only needed once the buckets are loaded.'''
+        result_key = 'archive:{}:{}'.format(group, path)
+        with self._lock:
+            if self._missed is not None:
+                self._missed.append(result_key)
+                return
+            index = self.index
+        if index is not None:
+            self._add(index, result_key)
+
+    def similar(self, result_key, radius=2, num=10):
+        index = self._load()
+        if result_key not in index.vectors.rows:
+            # It might have been stored before the buckets were loaded.
+            self._add(index, result_key)
+
+        with self._lock:
+            if result_key not in index.vectors.rows:
+                return []
+            vector = index.vectors.vectors[index.vectors.rows[result_key]]
+            return index.query(index.code_of[result_key], vector, radius, num, exclude=result_key)
+
+    def _add(self, index, result_key):
+        code = self.red.hget(result_key, 'hash')
+        if code is None:
+            return
+        data = self.red.hget('hashing:codes:' + code, result_key)
+        if data is None:
+            return
+        with self._lock:
+            index.add(result_key, parse_code(code), decode(data))
+
+    def _load(self):
+        if self.index is not None:
+            return self.index
+        with self._load_lock:
+            if self.index is not None:
+                return self.index
+            with self._lock:
+                self._missed = []
+            try:
+                index = self.load()
+            except Exception:
+                with self._lock:
+                    self._missed = None
+                raise
+            with self._lock:
+                missed, self._missed = self._missed, None
+                self.index = index
+            for result_key in missed:
+                self._add(index, result_key)
+            return index
@@ -0,0 +1,107 @@
+'''
+Single-flight classification: a task for an image that is already queued or being
+classified is not queued again. The first request for a (group, path) pair claims it
+with SET NX on inflight:<queue>:<group>:<path>, whatever its priority class, and later
+requests join it by adding their result queue to the waiters set and their ad id to the
+ads set next to it. The worker releases the entry after writing the result, and answers
+every waiting result queue and ad. Requests for the web page wait on the result key,
+which is shared already. A request that joins a task of a lower class waits for that
+class.
+
+A claim lasts as long as the task may be queued: until its deadline, or a day
+without one. The waiters set always lasts a day from the last join, so it cannot expire
+before the claim, and neither can the ads set. When a worker takes the task, the claim is cut to ttl seconds, so a
+worker that dies holding a task does not block the image for longer than that.
+'''
+
+from __future__ import division
+from collections import namedtuple
+import time
+
+INFLIGHT = 'inflight:{}:{}:{}'
+STATS = 'inflight:stats'
+TTL = 600
+QUEUED_TTL = 86400
+
+# The sets next to a claim, with the field of the task each records.
+WAITING = [ (':waiters', 'res_q'), (':ads', 'ad_id') ]
+
+Waiters = namedtuple('Waiters', 'res_qs ad_ids')
+
+def _get(task, field, default=''):
+    '''Tasks are message dicts on the producer side and specs on the worker side.'''
+    return task.get(field, default) if isinstance(task, dict) else getattr(task, field, default)
+
+def key(queue, task):
+    return INFLIGHT.format(queue, _get(task, 'group', 'web'), _get(task, 'path'))
+
+def _queued_ttl(task, ttl):
+    deadline = _get(task, 'deadline', 0)
+    if deadline:
+        return int(max(1, min(QUEUED_TTL, deadline - time.time() + ttl)))
+    return QUEUED_TTL
+
+def claim(r_server, queue, tasks, ttl=TTL):
+    '''Returns the tasks that must be queued, the rest joined a task in flight.
+    Duplicates within tasks are joined too. All the claims are one transaction, so
+    a release cannot slip in between the join and the claim of a task.'''
+    if not tasks:
+        return []
+    pipe = r_server.pipeline()
+    sets = []
+    for task in tasks:
+        task_key = key(queue, task)
+        for suffix, field in WAITING:
+            if _get(task, field):
+                pipe.sadd(task_key + suffix, _get(task, field))
+                pipe.expire(task_key + suffix, QUEUED_TTL)
+        sets.append(len(pipe))
+        pipe.set(task_key, time.time(), nx=True, ex=_queued_ttl(task, ttl))
+    replies = pipe.execute()
+    claimed = [ task for task, i in zip(tasks, sets) if replies[i] ]
+
+    pipe = r_server.pipeline(transaction=False)
+    pipe.hincrby(STATS, '{}:claimed'.format(queue), len(claimed))
+    pipe.hincrby(STATS, '{}:joined'.format(queue), len(tasks) - len(claimed))
+    pipe.execute()
+    return claimed
+
+def start(pipe, queue, specs, ttl=TTL):
+    '''Queues the cut of the claim of a task that a worker took on a pipeline.'''
+    pipe.expire(key(queue, specs), ttl)
+
+def restore(pipe, queue, specs, ttl=TTL):
+    '''Queues the renewal of the claim of a task that goes back on the queue.'''
+    pipe.expire(key(queue, specs), _queued_ttl(specs, ttl))
+
+def release_all(r_server, queue, batch):
+    '''Ends the flight of the tasks of a batch in one transaction, returns the Waiters
+    of each: the result queues and the ad ids of all the requests waiting for it, its
+    own included.'''
+    pipe = r_server.pipeline()
+    for specs in batch:
+        task_key = key(queue, specs)
+        for suffix, _ in WAITING:
+            pipe.smembers(task_key + suffix)
+        pipe.delete(task_key, *[ task_key + suffix for suffix, _ in WAITING ])
+    replies = iter(pipe.execute())
+    released = []
+    for specs in batch:
+        res_qs, ad_ids, _ = next(replies), next(replies), next(replies)
+        released.append(Waiters(set([ res_q for res_q in res_qs | set([ _get(specs, 'res_q') ]) if res_q ]),
+                                set([ ad_id for ad_id in ad_ids | set([ _get(specs, 'ad_id') ]) if ad_id ])))
+    return released
+
+def release(r_server, queue, specs):
+    '''Ends the flight of a task, returns its Waiters.'''
+    return release_all(r_server, queue, [ specs ])[0]
+
+def stats(r_server):
+    '''Tasks claimed and joined by queue, and the share of the work saved.'''
+    result = {}
+    for field, count in r_server.hgetall(STATS).iteritems():
+        queue, _, kind = field.rpartition(':')
+        result.setdefault(queue, {'claimed': 0, 'joined': 0})[kind] = int(count)
+    for counts in result.values():
+        counts['saved'] = round(counts['joined']/max(counts['claimed'] + counts['joined'], 1), 3)
+    return result
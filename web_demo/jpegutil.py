@@ -0,0 +1,37 @@
+'''
+In-memory normalisation of downloaded images to JPEG, which is what the Inception
+graph expects at DecodeJpeg/contents:0. JPEG bytes are passed through untouched,
+other formats are transcoded without touching the disk.
+'''
+
+import logging
+
+from wand.image import Image
+
+# Magic bytes at the start of the file, checked in order.
+MAGIC = [ ('\xff\xd8\xff', 'JPEG'),
+          ('\x89PNG\r\n\x1a\n', 'PNG'),
+          ('GIF87a', 'GIF'),
+          ('GIF89a', 'GIF'),
+          ('BM', 'BMP'),
+          ('II*\x00', 'TIFF'),
+          ('MM\x00*', 'TIFF') ]
+
+def sniff(data):
+    '''Returns the image format based on the magic bytes, or None if unknown.'''
+    if data[:4] == 'RIFF' and data[8:12] == 'WEBP':
+        return 'WEBP'
+    for magic, name in MAGIC:
+        if data.startswith(magic):
+            return name
+    return None
+
+def to_jpeg(data):
+    '''Returns the image as JPEG bytes.'''
+    if sniff(data) == 'JPEG':
+        return data
+
+    with Image(blob=data) as img:
+        logging.info('Converting {} to JPEG.'.format(img.format))
+        img.format = 'JPEG'
+        return img.make_blob()
@@ -0,0 +1,114 @@
+'''
+Latency histograms of the stages of the serving stack: queue wait, download, decode,
+inference, redis writes and publishing. Each process records into fixed log-scale buckets
+in memory, and adds them to the totals in redis every flush_interval seconds, so the
+cost per measurement is a bisect and two additions.
+'''
+
+from __future__ import division
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from 0.1 ms doubling up to about 3.5 minutes.
+BOUNDS = [ 0.0001*2**i for i in range(22) ]
+
+STAGES = 'metrics:stages'
+
+class Histogram(object):
+
+    def __init__(self):
+        # The last bucket holds everything above the last bound.
+        self.counts = [ 0 ]*(len(BOUNDS) + 1)
+        self.total = 0.
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(BOUNDS, seconds)] += 1
+        self.total += seconds
+
+class Metrics(object):
+    '''The histograms of one component, e.g. tf_worker. r_server may be None to
+    only keep the histograms in memory.'''
+
+    def __init__(self, r_server, component, flush_interval=10):
+        self.red = r_server
+        self.component = component
+        self.flush_interval = flush_interval
+        self.histograms = {}
+        self.next_flush = time.time() + flush_interval
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.record(seconds)
+        if time.time() > self.next_flush:
+            self.flush()
+
+    @contextmanager
+    def time(self, stage):
+        t0 = time.time()
+        yield
+        self.record(stage, time.time() - t0)
+
+    def flush(self):
+        with self._lock:
+            histograms = self.histograms
+            self.histograms = {}
+            self.next_flush = time.time() + self.flush_interval
+        if self.red is None or not histograms:
+            return
+
+        try:
+            pipe = self.red.pipeline(transaction=False)
+            for stage, histogram in histograms.iteritems():
+                key = 'metrics:{}:{}'.format(self.component, stage)
+                for bucket, count in enumerate(histogram.counts):
+                    if count:
+                        pipe.hincrby(key, bucket, count)
+                pipe.hincrby(key, 'count', sum(histogram.counts))
+                pipe.hincrbyfloat(key, 'sum', histogram.total)
+                pipe.hsetnx(key, 'since', time.time())
+                pipe.sadd(STAGES, key)
+            pipe.execute()
+        except Exception as e:
+            logging.error('Could not flush the metrics of {}: {}'.format(self.component, e))
+
+def quantile(counts, q):
+    '''Upper bound of the bucket holding the q quantile, None above the last bound.'''
+    total = sum(counts)
+    seen = 0
+    for bucket, count in enumerate(counts):
+        seen += count
+        if seen >= q*total:
+            return BOUNDS[bucket] if bucket < len(BOUNDS) else None
+
+def summary(r_server):
+    '''Count, rate, mean and quantiles in milliseconds of every stage, by component.'''
+    keys = sorted(r_server.smembers(STAGES))
+    pipe = r_server.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+
+    now = time.time()
+    result = {}
+    for key, values in zip(keys, pipe.execute()):
+        if not values:
+            continue
+        _, component, stage = key.split(':', 2)
+        count = int(values['count'])
+        counts = [ int(values.get(str(bucket), 0)) for bucket in range(len(BOUNDS) + 1) ]
+        ms = lambda seconds: None if seconds is None else round(1000*seconds, 2)
+        result.setdefault(component, {})[stage] = {
+            'count': count,
+            'per_second': round(count/max(now - float(values['since']), 1e-9), 3),
+            'mean_ms': ms(float(values['sum'])/max(count, 1)),
+            'p50_ms': ms(quantile(counts, .5)),
+            'p90_ms': ms(quantile(counts, .9)),
+            'p99_ms': ms(quantile(counts, .99)),
+        }
+    return result
@@ -0,0 +1,55 @@
+'''
+Completion signalling between the workers and the web server. Workers publish the
+result key on a channel when a result is written, and a single listener thread in
+the web server wakes up the requests waiting for that key.
+'''
+
+import logging
+import threading
+from collections import defaultdict
+
+CHANNEL = 'archive:done'
+
+def notify_done(r_server, key):
+    '''Signals that the result at key is written. r_server can be a pipeline.'''
+    r_server.publish(CHANNEL, key)
+
+class ResultListener(object):
+    '''Multiplexes all the waiting requests on one pubsub subscription.'''
+
+    def __init__(self, r_server):
+        self.red = r_server
+        self._waiting = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self._listen)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def wait(self, key, timeout):
+        '''Blocks until the key exists or timeout seconds have passed. Returns
+        whether the key exists.'''
+        event = threading.Event()
+        with self._lock:
+            self._waiting[key].append(event)
+        try:
+            # The result may have been written before we subscribed to it.
+            return self.red.exists(key) or event.wait(timeout)
+        finally:
+            with self._lock:
+                if event in self._waiting.get(key, []):
+                    self._waiting[key].remove(event)
+                    if not self._waiting[key]:
+                        del self._waiting[key]
+
+    def _listen(self):
+        pubsub = self.red.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(CHANNEL)
+        logging.info('Result listener subscribed to {}'.format(CHANNEL))
+        for msg in pubsub.listen():
+            with self._lock:
+                events = self._waiting.pop(msg['data'], [])
+            for event in events:
+                event.set()
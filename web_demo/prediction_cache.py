@@ -0,0 +1,124 @@
+'''
+Cache of Inception predictions in front of the workers. Images are looked up by URL
+before they are downloaded, and by a hash of the downloaded bytes before they are
+classified, so resubmitted images skip the download and/or the GPU. There is a fast
+in-process tier and a redis tier shared by all the workers.
+'''
+
+import hashlib
+import logging
+import threading
+import time
+import cPickle as pickle
+from collections import namedtuple, Counter
+
+import numpy as np
+
+from cache import LRUCache
+
+Cached = namedtuple('Cached', 'predictions hidden')
+
+def digest(content):
+    return hashlib.sha1(content).hexdigest()
+
+def _predictions(predictions):
+    '''Plain (label, probability) pairs, or a dict of them by classifier name for the
+    multi-head classifier.'''
+    if isinstance(predictions, dict):
+        return dict((name, _predictions(head)) for name, head in predictions.iteritems())
+    return [ (label, float(p)) for label, p in predictions ]
+
+class PredictionCache(object):
+    '''namespace separates the models, i.e. different classifiers must not share it.
+    The predictions are the top-k (label, probability) pairs, or a dict of them by
+    classifier name, the hidden layer is the pool_3 vector as float32.'''
+
+    def __init__(self, r_server, namespace, maxsize=10000, ttl=3600, redis_ttl=86400,
+                 report_interval=60):
+        self.red = r_server
+        self.prefix = 'cache:{}'.format(namespace)
+        self.local = LRUCache(maxsize, ttl)
+        self.redis_ttl = redis_ttl
+        self.report_interval = report_interval
+        # The downloader threads count concurrently.
+        self.counts = Counter()
+        self._counts_lock = threading.Lock()
+        self.t0 = time.time()
+
+    def lookup_url(self, url):
+        '''Returns (digest, Cached), or (None, None) when the URL has not been seen.'''
+        key = digest(url)
+        content_digest = self._get('url:' + key)
+        if content_digest is None:
+            self._count('url', False)
+            return None, None
+
+        cached = self._get('sha1:' + content_digest)
+        self._count('url', cached is not None)
+        return (content_digest, cached) if cached is not None else (None, None)
+
+    def lookup_content(self, url, content):
+        '''Returns (digest, Cached), where Cached is None when the bytes have not been seen.'''
+        content_digest = digest(content)
+        cached = self._get('sha1:' + content_digest)
+        self._count('content', cached is not None)
+        if cached is not None:
+            self._set('url:' + digest(url), content_digest)
+        return content_digest, cached
+
+    def store(self, url, content_digest, predictions, hidden):
+        cached = Cached(_predictions(predictions),
+                        None if hidden is None else np.asarray(hidden, dtype=np.float32).ravel())
+        self._set('sha1:' + content_digest, cached)
+        self._set('url:' + digest(url), content_digest)
+
+    def report(self):
+        with self._counts_lock:
+            counts, self.counts = self.counts, Counter()
+            self.t0 = time.time()
+        logging.info('Prediction cache hits/misses: {}'.format(
+            ' '.join([ '{}={}'.format(k, v) for k, v in sorted(counts.items()) ])))
+        if self.red is not None and counts:
+            pipe = self.red.pipeline(transaction=False)
+            for field, count in counts.items():
+                pipe.hincrby('{}:stats'.format(self.prefix), field, count)
+            pipe.execute()
+
+    def _count(self, kind, hit):
+        with self._counts_lock:
+            self.counts['{}_{}'.format(kind, 'hit' if hit else 'miss')] += 1
+            due = time.time() - self.t0 > self.report_interval
+            if due:
+                # Only one thread reports.
+                self.t0 = time.time()
+        if due:
+            self.report()
+
+    def _get(self, key):
+        value = self.local.get(key)
+        if value is not None or self.red is None or not self.redis_ttl:
+            return value
+
+        data = self.red.get('{}:{}'.format(self.prefix, key))
+        if data is None:
+            return None
+
+        if key.startswith('sha1:'):
+            predictions, hidden = pickle.loads(data)
+            value = Cached(_predictions(predictions), None if hidden is None else np.fromstring(hidden, dtype=np.float32))
+        else:
+            value = data
+        self.local.set(key, value)
+        return value
+
+    def _set(self, key, value):
+        self.local.set(key, value)
+        if self.red is None or not self.redis_ttl:
+            return
+
+        if isinstance(value, Cached):
+            data = pickle.dumps((value.predictions, None if value.hidden is None else value.hidden.tostring()),
+                                pickle.HIGHEST_PROTOCOL)
+        else:
+            data = value
+        self.red.setex('{}:{}'.format(self.prefix, key), self.redis_ttl, data)
@@ -0,0 +1,275 @@
+'''
+Downloads the images of queued classification tasks ahead of the inference loop, so
+one slow image host does not stall a worker. A reader thread pops tasks from redis,
+a pool of downloader threads with a shared keep-alive session fetches the images,
+and the inference loop consumes them from a bounded in-memory queue.
+
+To stop a worker without losing tasks, call stop() (e.g. from a signal handler), let
+the inference loop finish the batch it holds (get_batch returns an empty batch from
+then on), and call drain() to push the tasks the prefetcher holds back on redis.
+The tasks are only in memory once they are popped, so a worker that crashes or is
+killed loses the tasks being downloaded and waiting for inference, up to
+concurrency + max_queued of them. Their in-flight claims expire after inflight.TTL.
+'''
+
+from __future__ import division
+import time
+import logging
+import threading
+import Queue
+import urlparse
+from collections import namedtuple, defaultdict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from batching import collect_batch
+from scheduling import check_deadline, Expired
+import inflight
+
+# digest and cached are set when a prediction cache is used, cached holds the cached
+# prediction if the image has been classified before.
+Fetched = namedtuple('Fetched', 'task specs content error fetch_time queued_at digest cached')
+
+class Prefetcher(object):
+    '''Fetches images for the tasks on a redis list. parse turns the raw redis value
+    into a list of specs objects (a value can hold a batch of tasks), each with a path
+    attribute (the image URL). With a PredictionCache,
+    images that have been classified before are not downloaded again. With a
+    FairScheduler, the tasks are taken from the priority class lists of the queue.
+    Tasks past their deadline are not downloaded, they come out with an Expired error.'''
+
+    def __init__(self, r_server, queue, parse, concurrency=16, per_host=4, timeout=10,
+                 max_queued=64, report_interval=60, cache=None, scheduler=None):
+        self.r_server = r_server
+        self.queue = queue
+        self.parse = parse
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.report_interval = report_interval
+        self.cache = cache
+        self.scheduler = scheduler
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.pending = Queue.Queue(maxsize=concurrency)
+        self.ready = Queue.Queue(maxsize=max_queued)
+
+        self._hosts = defaultdict(lambda: threading.BoundedSemaphore(per_host))
+        self._hosts_lock = threading.Lock()
+        # The downloaders count errors and fetch times concurrently.
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+
+        # Set from a signal handler, so a plain flag.
+        self.draining = False
+        self._returned = []
+        self._returned_lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        threads = [ threading.Thread(target=self._read) ]
+        threads.extend([ threading.Thread(target=self._download) for _ in range(self.concurrency) ])
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self._threads = threads
+        logging.info('Prefetching images with {} downloaders, max {} per host.'.format(self.concurrency, self.per_host))
+        return self
+
+    def get_batch(self, max_size=1, timeout_ms=0):
+        '''Blocks until a downloaded image is available, then collects up to max_size
+        of them within timeout_ms milliseconds.'''
+        t0 = time.time()
+        batch = []
+        # Polls, so an idle worker notices stop().
+        while not batch and not self.draining:
+            try:
+                batch.append(self.ready.get(timeout=1))
+            except Queue.Empty:
+                pass
+        with self._stats_lock:
+            self.fetch_wait += time.time() - t0
+        if not batch:
+            return batch
+
+        deadline = time.time() + timeout_ms/1000
+        while len(batch) < max_size:
+            try:
+                batch.append(self.ready.get(timeout=max(deadline - time.time(), 0)) if timeout_ms else self.ready.get_nowait())
+            except Queue.Empty:
+                break
+
+        now = time.time()
+        with self._stats_lock:
+            self.inference_wait += sum([ now - fetched.queued_at for fetched in batch ])
+            self.consumed += len(batch)
+
+        if now - self.t0 > self.report_interval:
+            self.report()
+
+        return batch
+
+    def stop(self):
+        '''Stops taking tasks from redis. Safe to call from a signal handler.'''
+        self.draining = True
+
+    def drain(self, dump, timeout=30):
+        '''Waits up to timeout seconds for the downloads under way, then pushes the
+        tasks that were not handed out to the front of their lists. dump turns a list
+        of specs into a redis value. Returns the number of tasks pushed back.'''
+        self.stop()
+        deadline = time.time() + timeout
+        for thread in self._threads:
+            while thread.is_alive() and time.time() < deadline:
+                self._sweep(self.ready)
+                thread.join(.1)
+        if any([ thread.is_alive() for thread in self._threads ]):
+            logging.warning('Gave up waiting for the downloads, their tasks are lost.')
+        self._sweep(self.pending)
+        self._sweep(self.ready)
+
+        with self._returned_lock:
+            returned, self._returned = self._returned, []
+        by_queue = defaultdict(list)
+        for queue, specs in returned:
+            by_queue[queue].append(specs)
+        pipe = self.r_server.pipeline()
+        for queue, batch in by_queue.iteritems():
+            # The workers pop from the right, so the tasks are next in line.
+            pipe.rpush(queue, dump(batch))
+            for specs in batch:
+                inflight.restore(pipe, self.queue, specs)
+        pipe.execute()
+        logging.info('Drained the prefetcher, pushed {} tasks back.'.format(len(returned)))
+        return len(returned)
+
+    def _sweep(self, queue):
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            task, specs = item[:2]
+            if specs is not None:
+                self._return(task, specs)
+
+    def _return(self, task, specs):
+        with self._returned_lock:
+            self._returned.append((task.queue, specs))
+
+    def _hand_out(self, task, specs):
+        while not self.draining:
+            try:
+                self.pending.put((task, specs), timeout=.2)
+                return
+            except Queue.Full:
+                pass
+        self._return(task, specs)
+
+    def report(self):
+        with self._stats_lock:
+            consumed, fetch_time, fetch_wait, inference_wait, errors, expired = (
+                self.consumed, self.fetch_time, self.fetch_wait, self.inference_wait, self.errors, self.expired)
+            self._reset_stats()
+        logging.info('Prefetch: {} images, mean fetch time {:.3f}s, waited {:.2f}s for fetches, '
+                     'mean wait for inference {:.3f}s, {} failed downloads, {} expired.'.format(
+                         consumed, fetch_time/max(consumed, 1), fetch_wait,
+                         inference_wait/max(consumed, 1), errors, expired))
+
+    def _count(self, errors=0, expired=0, fetch_time=0.):
+        with self._stats_lock:
+            self.errors += errors
+            self.expired += expired
+            self.fetch_time += fetch_time
+
+    def _reset_stats(self):
+        self.t0 = time.time()
+        self.consumed = 0
+        self.errors = 0
+        self.expired = 0
+        self.fetch_time = 0.
+        self.fetch_wait = 0.
+        self.inference_wait = 0.
+
+    def _host(self, url):
+        with self._hosts_lock:
+            return self._hosts[urlparse.urlparse(url).netloc]
+
+    def _read(self):
+        while not self.draining:
+            # Blocks when all the downloaders are busy, the rest stays in redis.
+            if self.scheduler is not None:
+                tasks = self.scheduler.collect(self.concurrency, timeout=1)
+            else:
+                tasks = collect_batch(self.r_server, self.queue, self.concurrency, 0, block_timeout=1)
+            parsed = []
+            for task in tasks:
+                try:
+                    parsed.append((task, self.parse(task.value)))
+                except Exception as e:
+                    self._count(errors=1)
+                    self.ready.put(Fetched(task, None, None, e, 0., time.time(), None, None))
+            self._started(parsed)
+            for task, batch in parsed:
+                for specs in batch:
+                    self._hand_out(task, specs)
+
+    def _started(self, parsed):
+        '''Only the workers hold the claims of the tasks from now on.'''
+        try:
+            pipe = self.r_server.pipeline(transaction=False)
+            for _, batch in parsed:
+                for specs in batch:
+                    inflight.start(pipe, self.queue, specs)
+            pipe.execute()
+        except Exception as e:
+            logging.error('Could not update the in-flight claims: {}'.format(e))
+
+    def _download(self):
+        while True:
+            try:
+                task, specs = self.pending.get(timeout=.2)
+            except Queue.Empty:
+                if self.draining:
+                    return
+                continue
+            if self.draining:
+                self._return(task, specs)
+                continue
+
+            content, error, content_digest, cached = None, None, None, None
+            t0 = time.time()
+            try:
+                check_deadline(specs)
+                if self.cache is not None:
+                    content_digest, cached = self.cache.lookup_url(specs.path)
+                if cached is None:
+                    with self._host(specs.path):
+                        t0 = time.time()
+                        content = self.session.get(specs.path, timeout=self.timeout).content
+                    if self.cache is not None:
+                        content_digest, cached = self.cache.lookup_content(specs.path, content)
+            except Exception as e:
+                error = e
+            fetch_time = time.time() - t0
+            expired = isinstance(error, Expired)
+            self._count(errors=int(error is not None and not expired), expired=int(expired), fetch_time=fetch_time)
+            if self.draining:
+                self._return(task, specs)
+            else:
+                self.ready.put(Fetched(task, specs, content, error, fetch_time, time.time(), content_digest, cached))
+
+def record_timings(timings, fetched, now):
+    '''Records the time a task spent on the redis queue (if its specs have a queued_at
+    time), downloading, and waiting for inference after the download, on a Metrics.'''
+    download_started = fetched.queued_at - fetched.fetch_time
+    queued_at = getattr(fetched.specs, 'queued_at', 0)
+    if queued_at:
+        timings.record('queue_wait', max(download_started - queued_at, 0))
+    timings.record('download', fetched.fetch_time)
+    timings.record('inference_wait', max(now - fetched.queued_at, 0))
@@ -0,0 +1,106 @@
+'''
+Binary format of the messages on the redis work queues and channels. A message is a
+marker byte, a version byte and a kind byte, followed by the fields of that kind as a
+msgpack array in a fixed order. A batch is an array of such field arrays.
+
+Messages that do not start with the marker are read as the pickled dicts used before.
+
+The 'classify' channel is read outside this repository, by subscribers that unpickle
+its messages. Until they all read this format, publish_classify keeps publishing the
+pickled dicts on 'classify' and publishes the new messages on 'classify:v1'. Turn
+LEGACY_CLASSIFY off once the subscribers have moved, then 'classify:v1' is the only
+classify channel.
+'''
+
+import cPickle as pickle
+import struct
+
+import msgpack
+
+# 0xc1 is never used by msgpack, and no pickle starts with it.
+MARKER = '\xc1'
+VERSION = 1
+
+BATCH = 0x80
+
+LEGACY_CLASSIFY = True
+CLASSIFY_CHANNEL = 'classify:v{}'.format(VERSION)
+
+# Fields of each kind, with their defaults. Fields may only be appended.
+SCHEMAS = {
+    'task': (0x01, [ ('group', 'web'), ('path', ''), ('ad_id', ''), ('res_q', ''), ('queued_at', 0.),
+                       ('deadline', 0.), ('priority', 'default') ]),
+    'latest': (0x02, [ ('path', ''), ('group', 'web'), ('category', ''), ('value', 0.) ]),
+    'classify': (0x03, [ ('path', ''), ('group', 'web'), ('predictions', None), ('ad_id', '') ]),
+}
+# Fields of the pickled dicts that were renamed, the caffe tasks had the group as 'user'.
+LEGACY_FIELDS = {
+    'task': { 'user': 'group' },
+}
+KINDS = dict((kind, name) for name, (kind, _) in SCHEMAS.iteritems())
+NAMES = dict((name, [ field for field, _ in fields ]) for name, (_, fields) in SCHEMAS.iteritems())
+
+def _fields(name, message):
+    return [ message.get(field, default) for field, default in SCHEMAS[name][1] ]
+
+def dumps(name, message):
+    kind, _ = SCHEMAS[name]
+    return MARKER + chr(VERSION) + chr(kind) + msgpack.packb(_fields(name, message), use_bin_type=True)
+
+def dumps_batch(name, messages):
+    kind, _ = SCHEMAS[name]
+    return MARKER + chr(VERSION) + chr(kind | BATCH) + \
+        msgpack.packb([ _fields(name, message) for message in messages ], use_bin_type=True)
+
+def publish_classify(r_server, message):
+    '''Publishes the predictions of an image, r_server may be a pipeline.'''
+    r_server.publish(CLASSIFY_CHANNEL, dumps('classify', message))
+    if LEGACY_CLASSIFY:
+        r_server.publish('classify', pickle.dumps(message))
+
+def count(data):
+    '''The number of messages in data, read from the msgpack array header of a batch
+    without unpacking it.'''
+    if not data.startswith(MARKER) or not ord(data[2]) & BATCH:
+        return 1
+    header = ord(data[3])
+    if 0x90 <= header <= 0x9f:
+        return header & 0x0f
+    if header == 0xdc:
+        return struct.unpack('>H', data[4:6])[0]
+    if header == 0xdd:
+        return struct.unpack('>I', data[4:8])[0]
+    raise ValueError('Not a batch of messages')
+
+def loads(data, name=None):
+    '''Returns a list of message dicts, with one element unless data is a batch. If
+    name is given, the message must be of that kind, and old pickled messages get their
+    renamed fields back and defaults for the missing ones.'''
+    if not data.startswith(MARKER):
+        message = pickle.loads(data)
+        if name is not None:
+            for old, new in LEGACY_FIELDS.get(name, {}).iteritems():
+                if old in message and new not in message:
+                    message[new] = message[old]
+            message = dict(zip(NAMES[name], _fields(name, message)))
+        return [ message ]
+
+    version, kind = ord(data[1]), ord(data[2])
+    if version > VERSION:
+        raise ValueError('Message version {} is newer than {}'.format(version, VERSION))
+
+    kind_name = KINDS[kind & ~BATCH]
+    if name is not None and kind_name != name:
+        raise ValueError('Expected a {} message, got {}'.format(name, kind_name))
+
+    names = NAMES[kind_name]
+    payload = msgpack.unpackb(data[3:], raw=False)
+    rows = payload if kind & BATCH else [ payload ]
+
+    messages = [ dict(zip(names, row)) for row in rows ]
+    # Older versions may have fewer fields, newer ones are rejected above.
+    for message in messages:
+        if len(message) < len(names):
+            for field, default in SCHEMAS[kind_name][1]:
+                message.setdefault(field, default)
+    return messages
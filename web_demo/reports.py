@@ -0,0 +1,174 @@
+'''
+In-memory copies of the classifier reports, the ad image mappings and the grapheme
+encodings used by the /report routes. Each file is loaded once, and reloaded only
+when its modification time changes.
+'''
+
+import os
+import random
+import threading
+
+import numpy as np
+import pandas as pd
+
+from graphemes import GraphemeDecoder
+
+class FileCache(object):
+    '''Keeps load(path) for each path until the file is modified. A replaced value is
+    only dropped, other threads may still be using it. Values that hold a file open
+    close it when they are garbage collected. Each path is loaded under its own lock,
+    so a slow load only holds up the requests for that path.'''
+
+    def __init__(self, load):
+        self.load = load
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        mtime = os.path.getmtime(path)
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+
+        with self._lock:
+            path_lock = self._locks.setdefault(path, threading.Lock())
+        with path_lock:
+            # Another thread may have loaded it while this one waited.
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != mtime:
+                entry = (mtime, self.load(path))
+                self._entries[path] = entry
+            return entry[1]
+
+class Report(object):
+    '''All the tables of a report, keyed by (category number, table name).'''
+
+    def __init__(self, path):
+        self.tables = {}
+        with pd.HDFStore(path, 'r') as store:
+            for key in store.keys():
+                number, name = key.lstrip('/').split('/', 1)
+                self.tables[(number, name)] = store[key]
+
+        self.categories = sorted(set([ number for number, _ in self.tables ]))
+        self.summary = pd.concat([ self.tables[(number, 'stats')] for number in self.categories ], axis=1)
+
+    def table(self, number, name):
+        return self.tables[(str(number), name)]
+
+    def name(self, number):
+        return self.table(number, 'stats').columns[0]
+
+class Mapping(object):
+    '''The image filenames of each ad, loaded per category on first use.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.frames = {}
+
+    def frame(self, number):
+        number = str(number)
+        if number not in self.frames:
+            self.frames[number] = pd.read_hdf(self.path, number)
+        return self.frames[number]
+
+    def filenames(self, ad_ids, numbers):
+        '''The filename row of each ad, ad_ids[i] being in category numbers[i].'''
+        ad_ids = np.asarray(ad_ids)
+        numbers = np.asarray([ str(n) for n in numbers ])
+        rows = [ None ]*len(ad_ids)
+
+        for number in set(numbers):
+            positions = np.where(numbers == number)[0]
+            frame = self.frame(number)
+            indexer = frame.index.get_indexer(ad_ids[positions])
+            if (indexer < 0).any():
+                raise KeyError('Ads missing from the mapping of category {}'.format(number))
+            values = frame.values[indexer]
+            for position, value in zip(positions, values):
+                rows[position] = value
+
+        return rows
+
+def nrows(store, key):
+    '''Number of rows in a table, without reading it.'''
+    storer = store.get_storer(key)
+    if storer.is_table:
+        return storer.nrows
+    # The index of a fixed format frame.
+    return storer.group.axis1.shape[0]
+
+class RandomSampler(object):
+    '''Picks random ads from a report. The row counts of the tables are indexed once,
+    and each sample reads a single row from the open store.'''
+
+    def __init__(self, path):
+        self.store = pd.HDFStore(path, 'r')
+        self._lock = threading.Lock()
+        self.categories = []
+        # (number, category name, correct, rows) of every table that can be sampled.
+        self.tables = []
+        weights = []
+
+        for key in self.store.keys():
+            number, name = key.lstrip('/').split('/', 1)
+            if name != 'stats':
+                continue
+            stats = self.store[key]
+            self.categories.append((number, stats.columns[0], stats.values[2][0],
+                                    nrows(self.store, '{}/correct'.format(number)),
+                                    nrows(self.store, '{}/wrong/out'.format(number))))
+
+        # A uniform category, then a correct ad with the probability of its accuracy,
+        # among the tables that have rows.
+        for number, category, accuracy, n_correct, n_wrong in self.categories:
+            for correct, n, weight in [ (True, n_correct, accuracy), (False, n_wrong, 1 - accuracy) ]:
+                if n:
+                    self.tables.append((number, category, correct, n))
+                    weights.append(weight)
+        weights = np.asarray(weights, dtype=float)
+        self.weights = weights/weights.sum() if weights.sum() > 0 else None
+
+    def sample(self):
+        '''Returns (ad, correct, category name), where ad is a one row DataFrame.'''
+        if not self.tables:
+            raise ValueError('The report {} has no ads to sample'.format(self.store.filename))
+
+        number, category, correct, n = self.tables[np.random.choice(len(self.tables), p=self.weights)]
+        key = '{}/{}'.format(number, 'correct' if correct else 'wrong/out')
+        row = random.randrange(n)
+        with self._lock:
+            ad = self.store.select(key, start=row, stop=row + 1)
+        return ad, correct, category
+
+    def close(self):
+        with self._lock:
+            self.store.close()
+
+    def __del__(self):
+        # When the FileCache has replaced it and the last sample is done.
+        if hasattr(self, 'store'):
+            self.close()
+
+class ReportService(object):
+    '''Looks up the files of each site in sites, i.e. global_data in app.py.'''
+
+    def __init__(self, sites):
+        self.sites = sites
+        self.reports = FileCache(Report)
+        self.mappings = FileCache(Mapping)
+        self.encodings = FileCache(GraphemeDecoder.from_file)
+        self.samplers = FileCache(RandomSampler)
+
+    def report(self, site):
+        return self.reports.get(self.sites[site]['report'])
+
+    def mapping(self, site):
+        return self.mappings.get(self.sites[site]['mapping'])
+
+    def encoding(self, site):
+        return self.encodings.get(self.sites[site]['encoding'])
+
+    def sampler(self, site):
+        return self.samplers.get(self.sites[site]['report'])
@@ -0,0 +1,147 @@
+'''
+Priority classes for the classification tasks. Each class has its own redis list next to
+the work queue, and the workers dequeue from them by weighted fair (stride) scheduling:
+a class gets a share of the tasks proportional to its weight while it has tasks, so
+interactive requests do not wait behind a bulk backfill, and the bulk work is never
+starved. The default class uses the work queue itself, so older producers keep working.
+
+Tasks may carry a deadline, tasks that have expired are dropped without downloading or
+classifying the image.
+'''
+
+from __future__ import division
+import math
+import time
+
+from batching import Task
+import protocol
+
+# Classes and their weights, highest priority first.
+WEIGHTS = [ ('interactive', 8), ('default', 4), ('bulk', 1) ]
+DEFAULT = 'default'
+
+class Expired(Exception):
+    pass
+
+def queue_for(queue, priority):
+    '''The redis list of a class of the work queue.'''
+    if priority == DEFAULT:
+        return queue
+    if priority not in dict(WEIGHTS):
+        raise ValueError('Unknown priority class {}'.format(priority))
+    return '{}:{}'.format(queue, priority)
+
+def queues(queue):
+    return [ queue_for(queue, priority) for priority, _ in WEIGHTS ]
+
+def backlog(r_server, queue, sample=10):
+    '''Tasks waiting in all the classes of the work queue. A list element may hold a
+    batch of tasks, so the tasks of up to sample elements at each end of a longer list
+    are counted, and the rest is estimated from their mean.'''
+    pipe = r_server.pipeline()
+    for key in queues(queue):
+        pipe.llen(key)
+        pipe.lrange(key, 0, sample - 1)
+        pipe.lrange(key, -sample, -1)
+    replies = pipe.execute()
+
+    total = 0
+    for length, head, tail in zip(replies[::3], replies[1::3], replies[2::3]):
+        if length <= 2*sample:
+            # The two ranges overlap, head holds the whole list.
+            elements = head if length <= sample else head + tail[2*sample - length:]
+            total += sum([ protocol.count(value) for value in elements ])
+        elif length:
+            counts = [ protocol.count(value) for value in head + tail ]
+            total += int(round(length*sum(counts)/len(counts)))
+    return total
+
+def check_deadline(specs, now=None):
+    '''Raises Expired if the deadline of the task has passed, 0 means no deadline.'''
+    deadline = getattr(specs, 'deadline', 0)
+    if deadline and (now or time.time()) > deadline:
+        raise Expired('The deadline of {} passed {:.1f}s ago'.format(specs.path, (now or time.time()) - deadline))
+
+class FairScheduler(object):
+    '''Pops tasks from the class lists of a work queue. Each class has a virtual time
+    that advances by 1/weight per task it is served, and the next list element comes
+    from the non-empty class with the earliest virtual time. A class that was idle
+    starts at the earliest virtual time of the busy ones, so it cannot save up credit
+    while it has no tasks.
+
+    An element may hold a batch of tasks. It is charged by the number of tasks, and
+    when it holds more tasks than the class is due, the rest is pushed back to the
+    front of its list, so a bulk batch cannot crowd out the other classes.'''
+
+    def __init__(self, r_server, queue, weights=WEIGHTS):
+        self.red = r_server
+        self.classes = [ (queue_for(queue, priority), weight) for priority, weight in weights ]
+        self.keys = [ key for key, _ in self.classes ]
+        self.weights = dict(self.classes)
+        self.passes = dict((key, 0.) for key in self.keys)
+        self.active = set()
+        self.served = dict((key, 0) for key in self.keys)
+
+    def collect(self, max_size, timeout=0):
+        '''Blocks until a task is available, then returns Tasks holding up to
+        max_size tasks in all. Returns an empty list if no task came within
+        timeout seconds (0 waits forever).'''
+        batch = []
+        size = 0
+        empty = set()
+        while size < max_size:
+            candidates = [ key for key in self.keys if key not in empty ]
+            if not candidates:
+                if batch:
+                    break
+                # brpop checks the lists in order, i.e. the highest priority first.
+                popped = self.red.brpop(self.keys, timeout=timeout)
+                if popped is None:
+                    break
+                key, value = popped
+                empty.clear()
+            else:
+                # Ties go to the higher priority, which comes first in keys.
+                key = min(candidates, key=lambda k: self.passes[k])
+                value = self.red.rpop(key)
+                if value is None:
+                    empty.add(key)
+                    self.active.discard(key)
+                    continue
+
+            self._activate(key)
+            value, n = self._take(key, value, min(max_size - size, self._allowance(key, candidates)))
+            self._charge(key, n)
+            batch.append(Task(key, value))
+            size += n
+        return batch
+
+    def _allowance(self, key, candidates):
+        '''Tasks the class may have before its virtual time passes the next busy class.'''
+        others = [ self.passes[k] for k in candidates if k != key and k in self.active ]
+        if not others:
+            return float('inf')
+        return max(1, int(math.ceil((min(others) - self.passes[key])*self.weights[key])))
+
+    def _take(self, key, value, wanted):
+        '''Keeps up to wanted tasks of an element, and pushes the rest back.'''
+        try:
+            tasks = protocol.loads(value, 'task')
+        except Exception:
+            # The worker reports what cannot be parsed.
+            return value, 1
+        if len(tasks) <= wanted:
+            return value, len(tasks)
+        self.red.rpush(key, protocol.dumps_batch('task', tasks[wanted:]))
+        return protocol.dumps_batch('task', tasks[:wanted]), wanted
+
+    def _activate(self, key):
+        if key not in self.active:
+            start = min([ self.passes[k] for k in self.active ]) if self.active else \
+                max(self.passes.values())
+            self.passes[key] = max(self.passes[key], start)
+            self.active.add(key)
+
+    def _charge(self, key, n):
+        self.passes[key] += n/self.weights[key]
+        self.served[key] += n
@@ -0,0 +1,131 @@
+'''
+In-memory index of the pool_3 vectors of the classified images, one per category.
+The vectors are normalised and kept in one contiguous float32 matrix, so a query is
+a single matrix-vector product. Each category is loaded from redis the first time
+it is queried, and then kept up to date from the 'latest' channel.
+'''
+
+from __future__ import division
+import logging
+import threading
+
+import numpy as np
+
+from vectors import decode, decode_many
+
+class CategoryIndex(object):
+
+    def __init__(self, dim=2048, capacity=1024):
+        self.vectors = np.empty((capacity, dim), dtype=np.float32)
+        self.names = []
+        self.rows = {}
+        self.skipped = False
+
+    def add(self, name, vector):
+        norm = np.linalg.norm(vector)
+        vector = vector/norm if norm > 0 else vector
+
+        if name in self.rows:
+            self.vectors[self.rows[name]] = vector
+            return
+
+        if len(self.names) == self.vectors.shape[0]:
+            grown = np.empty((2*self.vectors.shape[0], self.vectors.shape[1]), dtype=np.float32)
+            grown[:len(self.names)] = self.vectors
+            self.vectors = grown
+
+        self.rows[name] = len(self.names)
+        self.vectors[len(self.names)] = vector
+        self.names.append(name)
+
+    def query(self, name, num=10):
+        '''Returns the num most similar (name, cosine similarity) pairs, excluding name itself.'''
+        n = len(self.names)
+        num = min(num, n - 1)
+        if name not in self.rows or num < 1:
+            return []
+
+        scores = self.vectors[:n].dot(self.vectors[self.rows[name]])
+        scores[self.rows[name]] = -np.inf
+
+        top = np.argpartition(-scores, num - 1)[:num]
+        top = top[np.argsort(-scores[top])]
+        return [ (self.names[i], float(scores[i])) for i in top ]
+
+    def __len__(self):
+        return len(self.names)
+
+class SimilarityIndex(object):
+
+    def __init__(self, r_server, dim=2048):
+        self.red = r_server
+        self.dim = dim
+        self.categories = {}
+        # Images published while their category is being loaded, added after the load.
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def similar(self, image, category, num=10, group='web'):
+        key = 'archive:{}:category:{}'.format(group, category)
+        index = self._category(key)
+
+        with self._lock:
+            known = image in index.rows
+        if not known:
+            # It might have been stored before we subscribed to the updates.
+            self.update(group, category, image)
+
+        with self._lock:
+            return index.query(image, num)
+
+    def update(self, group, category, path):
+        '''Adds a newly classified image, only needed if the category is loaded.'''
+        key = 'archive:{}:category:{}'.format(group, category)
+        with self._lock:
+            if key in self._loading:
+                self._loading[key].append(path)
+                return
+            index = self.categories.get(key)
+        # Only hashes hold vectors, tf_worker writes its categories as sorted sets.
+        if index is None or index.skipped:
+            return
+        self._add(key, index, [ path ])
+
+    def _add(self, key, index, paths):
+        for path, data in zip(paths, self.red.hmget(key, paths)):
+            if data is not None:
+                vector = decode(data)
+                with self._lock:
+                    index.add(path, vector)
+
+    def _category(self, key):
+        with self._lock:
+            if key in self.categories:
+                return self.categories[key]
+            self._loading.setdefault(key, [])
+
+        try:
+            index = self._load(key)
+        except Exception:
+            with self._lock:
+                self._loading.pop(key, None)
+            raise
+        with self._lock:
+            index = self.categories.setdefault(key, index)
+            missed = self._loading.pop(key, [])
+        if missed and not index.skipped:
+            self._add(key, index, missed)
+        return index
+
+    def _load(self, key):
+        if self.red.type(key) not in ('hash', 'none'):
+            logging.warning('{} is not a hash of vectors, it has no similar images.'.format(key))
+            index = CategoryIndex(self.dim, 1)
+            index.skipped = True
+            return index
+
+        result = self.red.hgetall(key)
+        index = CategoryIndex(self.dim, max(len(result), 1024))
+        for path, vector in zip(result.keys(), decode_many(result.values())):
+            index.add(path, vector)
+        return index
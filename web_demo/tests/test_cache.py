@@ -0,0 +1,39 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cache import LRUCache
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_expiry(self):
+        cache = LRUCache(ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=-1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 'gone'), 'gone')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_delete_and_clear(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import unittest
+from collections import namedtuple
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import inflight
+
+Specs = namedtuple('Specs', 'group path res_q priority deadline')
+
+def task(path, res_q='', deadline=0., priority='default', ad_id=''):
+    return {'group': 'web', 'path': path, 'res_q': res_q, 'priority': priority, 'deadline': deadline,
+            'ad_id': ad_id}
+
+@unittest.skipIf(fakeredis is None, 'needs fakeredis')
+class InflightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.red = fakeredis.FakeStrictRedis()
+        self.red.flushall()
+
+    def test_duplicates_join_the_first(self):
+        claimed = inflight.claim(self.red, 'q', [ task('a', 'r1'), task('b', 'r2'), task('a', 'r3') ])
+        self.assertEqual([ t['path'] for t in claimed ], [ 'a', 'b' ])
+        self.assertEqual(inflight.claim(self.red, 'q', [ task('a', 'r4') ]), [])
+        self.assertEqual(inflight.stats(self.red)['q'], {'claimed': 2, 'joined': 2, 'saved': .5})
+
+    def test_classes_share_the_claim(self):
+        claimed = inflight.claim(self.red, 'q', [ task('a', 'r1'), task('a', 'r2', priority='interactive') ])
+        self.assertEqual(claimed, [ task('a', 'r1') ])
+
+    def test_release_answers_every_waiter(self):
+        inflight.claim(self.red, 'q', [ task('a', 'r1', ad_id='1'), task('a', 'r2', ad_id='2'), task('a', ad_id='3') ])
+        waiters = inflight.release(self.red, 'q', Specs('web', 'a', 'r1', 'default', 0.))
+        self.assertEqual(waiters.res_qs, set([ 'r1', 'r2' ]))
+        self.assertEqual(waiters.ad_ids, set([ '1', '2', '3' ]))
+        self.assertEqual(inflight.claim(self.red, 'q', [ task('a') ]), [ task('a') ])
+
+    def test_release_all(self):
+        inflight.claim(self.red, 'q', [ task('a', 'r1'), task('b', 'r2'), task('b', 'r3') ])
+        released = inflight.release_all(self.red, 'q', [ Specs('web', 'a', 'r1', 'default', 0.),
+                                                         Specs('web', 'b', 'r2', 'default', 0.) ])
+        self.assertEqual([ waiters.res_qs for waiters in released ], [ set([ 'r1' ]), set([ 'r2', 'r3' ]) ])
+        self.assertEqual(self.red.keys('inflight:q:*'), [])
+
+    def test_claim_lasts_until_the_deadline(self):
+        inflight.claim(self.red, 'q', [ task('a', deadline=time.time() + 100), task('b') ])
+        ttl = self.red.ttl(inflight.key('q', task('a')))
+        self.assertTrue(inflight.TTL < ttl <= inflight.TTL + 100)
+        self.assertEqual(self.red.ttl(inflight.key('q', task('b'))), inflight.QUEUED_TTL)
+
+    def test_start_cuts_the_claim(self):
+        inflight.claim(self.red, 'q', [ task('a') ])
+        pipe = self.red.pipeline()
+        inflight.start(pipe, 'q', Specs('web', 'a', '', 'default', 0.), ttl=30)
+        pipe.execute()
+        self.assertEqual(self.red.ttl(inflight.key('q', task('a'))), 30)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import metrics
+from metrics import BOUNDS, Histogram, Metrics, quantile
+
+class HistogramTest(unittest.TestCase):
+
+    def test_buckets(self):
+        histogram = Histogram()
+        for seconds in [ 0, BOUNDS[0], BOUNDS[0]*1.5, BOUNDS[-1]*2 ]:
+            histogram.record(seconds)
+        self.assertEqual(histogram.counts[0], 2)
+        self.assertEqual(histogram.counts[1], 1)
+        self.assertEqual(histogram.counts[-1], 1)
+
+    def test_quantile(self):
+        counts = [ 0 ]*(len(BOUNDS) + 1)
+        counts[3] = 90
+        counts[5] = 10
+        self.assertEqual(quantile(counts, .5), BOUNDS[3])
+        self.assertEqual(quantile(counts, .99), BOUNDS[5])
+        counts[-1] = 1000
+        self.assertIsNone(quantile(counts, .99))
+
+@unittest.skipIf(fakeredis is None, 'needs fakeredis')
+class SummaryTest(unittest.TestCase):
+
+    def test_flush_and_summary(self):
+        red = fakeredis.FakeStrictRedis()
+        red.flushall()
+        timings = Metrics(red, 'worker', flush_interval=3600)
+        for _ in range(10):
+            timings.record('inference', .01)
+        timings.flush()
+        timings.flush()
+
+        stage = metrics.summary(red)['worker']['inference']
+        self.assertEqual(stage['count'], 10)
+        self.assertAlmostEqual(stage['mean_ms'], 10, places=3)
+        self.assertEqual(stage['p50_ms'], round(1000*BOUNDS[7], 2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import cPickle as pickle
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import protocol
+
+class Channel(object):
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+
+class ProtocolTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        task = {'group': 'web', 'path': 'http://example.com/a.jpg', 'ad_id': '7', 'res_q': 'q',
+                'queued_at': 1.5, 'deadline': 2.5, 'priority': 'interactive'}
+        self.assertEqual(protocol.loads(protocol.dumps('task', task), 'task'), [ task ])
+
+    def test_batch(self):
+        tasks = [ {'path': str(i)} for i in range(3) ]
+        messages = protocol.loads(protocol.dumps_batch('task', tasks), 'task')
+        self.assertEqual([ message['path'] for message in messages ], [ '0', '1', '2' ])
+        self.assertEqual(messages[0]['priority'], 'default')
+
+    def test_pickled_messages_get_defaults(self):
+        messages = protocol.loads(pickle.dumps({'path': 'a'}), 'task')
+        self.assertEqual(messages[0]['path'], 'a')
+        self.assertEqual(messages[0]['group'], 'web')
+        self.assertEqual(len(messages[0]), len(protocol.NAMES['task']))
+
+    def test_legacy_caffe_task_keeps_its_user(self):
+        messages = protocol.loads(pickle.dumps({'user': 'alice', 'path': 'a.jpg'}), 'task')
+        self.assertEqual(messages[0]['group'], 'alice')
+        self.assertEqual(messages[0]['path'], 'a.jpg')
+
+    def test_wrong_kind(self):
+        with self.assertRaises(ValueError):
+            protocol.loads(protocol.dumps('latest', {}), 'task')
+
+    def test_newer_version(self):
+        data = protocol.dumps('task', {})
+        with self.assertRaises(ValueError):
+            protocol.loads(data[0] + chr(protocol.VERSION + 1) + data[2:], 'task')
+
+    def test_count(self):
+        for n in [ 1, 15, 16, 100, 65535, 65536 ]:
+            self.assertEqual(protocol.count(protocol.dumps_batch('task', [ {} ]*n)), n)
+        self.assertEqual(protocol.count(protocol.dumps('task', {})), 1)
+        self.assertEqual(protocol.count(pickle.dumps({'path': 'a'})), 1)
+
+    def test_publish_classify(self):
+        channel = Channel()
+        message = {'path': 'a', 'group': 'web', 'predictions': {'cat': .5}}
+        protocol.publish_classify(channel, message)
+        published = dict(channel.published)
+        self.assertEqual(protocol.loads(published[protocol.CLASSIFY_CHANNEL], 'classify')[0]['predictions'], {'cat': .5})
+        if protocol.LEGACY_CLASSIFY:
+            self.assertEqual(pickle.loads(published['classify']), message)
+
+if __name__ == '__main__':
+    unittest.main()
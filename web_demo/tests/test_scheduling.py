@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import unittest
+from collections import namedtuple
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import protocol
+from scheduling import FairScheduler, Expired, backlog, check_deadline, queue_for
+
+Specs = namedtuple('Specs', 'path deadline')
+
+class QueueTest(unittest.TestCase):
+
+    def test_queue_for(self):
+        self.assertEqual(queue_for('classify', 'default'), 'classify')
+        self.assertEqual(queue_for('classify', 'bulk'), 'classify:bulk')
+        with self.assertRaises(ValueError):
+            queue_for('classify', 'urgent')
+
+    def test_check_deadline(self):
+        check_deadline(Specs('a', 0))
+        check_deadline(Specs('a', time.time() + 60))
+        with self.assertRaises(Expired):
+            check_deadline(Specs('a', 10.), now=11.)
+
+@unittest.skipIf(fakeredis is None, 'needs fakeredis')
+class FairSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.red = fakeredis.FakeStrictRedis()
+        self.red.flushall()
+
+    def push(self, priority, n, batch=1):
+        for i in range(0, n, batch):
+            tasks = [ {'path': '{}:{}'.format(priority, j), 'priority': priority} for j in range(i, min(i + batch, n)) ]
+            self.red.lpush(queue_for('q', priority), protocol.dumps_batch('task', tasks))
+
+    def collect_all(self, scheduler, max_size):
+        paths = []
+        while backlog(self.red, 'q'):
+            for task in scheduler.collect(max_size, timeout=1):
+                paths.extend([ message['path'] for message in protocol.loads(task.value, 'task') ])
+        return paths
+
+    def test_batches_do_not_crowd_out_interactive(self):
+        self.push('bulk', 400, batch=100)
+        self.push('interactive', 40)
+        paths = self.collect_all(FairScheduler(self.red, 'q'), 16)
+
+        self.assertEqual(len(paths), 440)
+        self.assertEqual(len(set(paths)), 440)
+        first = [ path.split(':')[0] for path in paths[:48] ]
+        self.assertGreater(first.count('interactive'), 30)
+
+    def test_empty_queue_times_out(self):
+        self.assertEqual(FairScheduler(self.red, 'q').collect(16, timeout=1), [])
+
+    def test_backlog_counts_tasks(self):
+        self.push('bulk', 1500, batch=100)
+        self.push('default', 1)
+        self.assertEqual(backlog(self.red, 'q'), 1501)
+
+if __name__ == '__main__':
+    unittest.main()
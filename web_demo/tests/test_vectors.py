@@ -0,0 +1,39 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import vectors
+
+class VectorsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vector = np.random.RandomState(0).gamma(.3, 1., 2048).astype(np.float32)
+
+    def test_round_trip(self):
+        for format, tolerance in [ ('blosc', 0), ('float32', 0), ('float16', 1e-3), ('int8', 1e-2) ]:
+            decoded = vectors.decode(vectors.encode(self.vector, format))
+            self.assertEqual(decoded.dtype, np.float32)
+            self.assertEqual(decoded.shape, self.vector.shape)
+            error = np.abs(decoded - self.vector).max()/np.abs(self.vector).max()
+            self.assertLessEqual(error, tolerance, format)
+
+    def test_sizes(self):
+        self.assertEqual(len(vectors.encode(self.vector, 'float16')), vectors.HEADER.size + 2*2048)
+        self.assertEqual(len(vectors.encode(self.vector, 'int8')), vectors.HEADER.size + vectors.SCALE.size + 2048)
+
+    def test_decode_many(self):
+        datas = [ vectors.encode(self.vector*i, format) for i, format in enumerate(vectors.FORMATS, 1) ]
+        matrix = vectors.decode_many(datas)
+        self.assertEqual(matrix.shape, (len(datas), 2048))
+        self.assertEqual(vectors.decode_many([]).shape, (0, 0))
+
+    def test_unknown_encoding(self):
+        data = vectors.encode(self.vector)
+        with self.assertRaises(ValueError):
+            vectors.decode(data[:2] + chr(vectors.VERSION + 1) + data[3:])
+
+if __name__ == '__main__':
+    unittest.main()
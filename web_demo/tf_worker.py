@@ -39,11 +39,9 @@ import tarfile
 from collections import namedtuple
 import cStringIO as StringIO
 import logging
-import cPickle as pickle
 import os
-import tempfile
-from contextlib import contextmanager
 import time
+import signal
 
 # pylint: disable=unused-import,g-bad-import-order
 import tensorflow.python.platform
@@ -51,8 +49,6 @@ from six.moves import urllib
 import numpy as np
 import tensorflow as tf
 import redis
-import requests
-from wand.image import Image
 # pylint: enable=unused-import,g-bad-import-order
 
 from ast import literal_eval as make_tuple
@@ -60,6 +56,16 @@ from ast import literal_eval as make_tuple
 
 from tensorflow.python.platform import gfile
 
+from batching import BatchStats, count_processed
+from metrics import Metrics
+from prefetch import Prefetcher, record_timings
+from scheduling import FairScheduler, check_deadline
+from jpegutil import to_jpeg
+from notify import notify_done
+import inflight
+from prediction_cache import PredictionCache
+import protocol
+
 FLAGS = tf.app.flags.FLAGS
 
 # classify_image_graph_def.pb:
@@ -86,9 +92,28 @@ tf.app.flags.DEFINE_integer('redis_port', 6379,
                             """Redis server port""")
 tf.app.flags.DEFINE_string('redis_queue', 'classify',
                            """Redis queue to read images from""")
-
-Task = namedtuple('Task', 'queue value')
-Specs = namedtuple('Specs', 'group path ad_id')
+tf.app.flags.DEFINE_integer('batch_size', 1,
+                            """Maximum number of images to classify in one batch""")
+tf.app.flags.DEFINE_integer('batch_timeout_ms', 50,
+                            """How long to wait for a batch to fill up, in milliseconds""")
+tf.app.flags.DEFINE_integer('fetch_concurrency', 16,
+                            """Number of images to download in parallel""")
+tf.app.flags.DEFINE_integer('fetch_per_host', 4,
+                            """Maximum number of parallel downloads from the same host""")
+tf.app.flags.DEFINE_float('fetch_timeout', 10,
+                            """Timeout in seconds for downloading an image""")
+tf.app.flags.DEFINE_integer('prefetch_queue_size', 64,
+                            """Maximum number of downloaded images waiting for inference""")
+tf.app.flags.DEFINE_integer('cache_size', 10000,
+                            """Number of predictions to cache in process, 0 disables the cache""")
+tf.app.flags.DEFINE_integer('cache_ttl', 3600,
+                            """Seconds to keep predictions in the in-process cache""")
+tf.app.flags.DEFINE_integer('cache_redis_ttl', 86400,
+                            """Seconds to keep predictions in the shared redis cache, 0 disables it""")
+tf.app.flags.DEFINE_float('gpu_memory_fraction', 1./4,
+                          """Share of the GPU memory to reserve, set it from the number of workers per GPU""")
+
+Specs = namedtuple('Specs', 'group path ad_id res_q queued_at deadline priority')
 Result = namedtuple('Result', 'OK predictions computation_time ad_id path')
 
 # pylint: disable=line-too-long
@@ -172,78 +197,126 @@ def create_graph():
     graph_def.ParseFromString(f.read())
     _ = tf.import_graph_def(graph_def, name='')
 
-@contextmanager
-def convert_to_jpg(data):
-  tmp = tempfile.NamedTemporaryFile(delete=False)
+def classify(sess, softmax_tensor, pool_tensor, node_lookup, specs, content, timings):
+  """Classifies the downloaded image in specs, returns a Result and the pool_3 vector."""
+  with timings.time('decode'):
+    image_data = to_jpeg(content)
+
+  starttime = time.time()
+  predictions, hidden_layer = sess.run([softmax_tensor, pool_tensor], {'DecodeJpeg/contents:0': image_data})
+  endtime = time.time()
+  timings.record('inference', endtime - starttime)
+
+  predictions = np.squeeze(predictions)
+
+  top_k = predictions.argsort()[-FLAGS.num_top_predictions:][::-1]
+  return Result(True,
+                [ (node_lookup.id_to_string(node_id), predictions[node_id]) for node_id in top_k ],
+                endtime - starttime,
+                specs.ad_id, specs.path), hidden_layer
 
-  with Image(file=StringIO.StringIO(data)) as img:
-    if img.format != 'JPEG':
-      logging.info('Converting {} to JPEG.'.format(img.format))
-      img.format = 'JPEG'
-    img.save(tmp)
+def store_result(pipe, specs, result):
+  """Queues the writes and publications of a result on the redis pipeline."""
+  result_key = 'archive:{}:{}'.format(specs.group, specs.path)
 
-  tmp.close()
-  yield tmp.name
-  os.remove(tmp.name)
+  full_url = specs.path.split('//')
+  url_path = len(full_url)>1 and full_url[1] or full_url[0]
+  kaidee_result_key = url_path.split('/', 1)[1]
+
+  pipe.hmset(result_key, result._asdict())
+  pipe.hmset(kaidee_result_key, result._asdict())
+  notify_done(pipe, result_key)
+
+  pipe.zadd('archive:{}:category:{}'.format(specs.group, result.predictions[0][0]),
+            result.predictions[0][1], specs.path)
+  # The publishing was only added since AWS ElastiCache does not support subscribing to keyspace notifications.
+  pipe.publish('latest', protocol.dumps('latest', {'path': specs.path, 'group': specs.group,
+                                                   'category': result.predictions[0][0], 'value': float(result.predictions[0][1])}))
+
+  publish_result(pipe, specs, result, specs.ad_id)
+
+def publish_result(pipe, specs, result, ad_id):
+  """Queues the publication of a result for an ad on the Kaidee channel."""
+  predictions_dict = dict((x, float(y)) for x, y in result.predictions)
+  protocol.publish_classify(pipe, {'path': specs.path, 'group': specs.group,
+                                   'predictions': predictions_dict, 'ad_id': ad_id})
 
 def classify_images():
   create_graph()
   node_lookup = NodeLookup()
   # 4 instances running in parallel on g2.2xlarge seems to be the magic number.
   # If running more instances, memcpy errors will be thrown after some time.
-  gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=1./4)
+  gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=FLAGS.gpu_memory_fraction)
 
   with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
     r_server = redis.StrictRedis(FLAGS.redis_server, FLAGS.redis_port)
     softmax_tensor = sess.graph.get_tensor_by_name('softmax:0')
-
-    while True:
-      task = Task(*r_server.brpop(FLAGS.redis_queue))
-      specs = Specs(**pickle.loads(task.value))
-      logging.info(specs)
-
-      try:
-        result_key = 'archive:{}:{}'.format(specs.group, specs.path)
-        kaidee_result_key = ''
-
-        full_url = specs.path.split('//')
-        url_path = len(full_url)>1 and full_url[1] or full_url[0]
-        kaidee_result_key = url_path.split('/', 1)[1]
-
-        response = requests.get(specs.path, timeout=10)
-        with convert_to_jpg(response.content) as jpg:
-          image_data = gfile.FastGFile(jpg).read()
-
-        starttime = time.time()
-        predictions = sess.run(softmax_tensor,{'DecodeJpeg/contents:0': image_data})
-        endtime = time.time()
-
-        predictions = np.squeeze(predictions)
-
-        top_k = predictions.argsort()[-FLAGS.num_top_predictions:][::-1]
-        result = Result(True,
-                        [ (node_lookup.id_to_string(node_id), predictions[node_id]) for node_id in top_k ],
-                        endtime - starttime,
-                        specs.ad_id, specs.path)
-
-        r_server.hmset(result_key, result._asdict())
-        r_server.hmset(kaidee_result_key, result._asdict())
-
-        r_server.zadd('archive:{}:category:{}'.format(specs.group, result.predictions[0][0]),
-                      result.predictions[0][1], specs.path)
-        # The publishing was only added since AWS ElastiCache does not support subscribing to keyspace notifications.
-        r_server.publish('latest', pickle.dumps({'path': specs.path, 'group': specs.group,
-                                                 'category': result.predictions[0][0], 'value': float(result.predictions[0][1])}))
-
-        # Kaidee channel
-        predictions_dict = dict((x, y) for x, y in result.predictions)
-        r_server.publish('classify', pickle.dumps({'path': specs.path, 'group': specs.group,
-                                                 'predictions': predictions_dict, 'ad_id': specs.ad_id}))
-
-        logging.info(result)
-      except Exception as e:
-        logging.error('Something went wrong when classifying the image: {}'.format(e))
-        r_server.hmset(result_key, {'OK': False})
+    pool_tensor = sess.graph.get_tensor_by_name('pool_3:0')
+    stats = BatchStats()
+    timings = Metrics(r_server, 'tf_worker')
+    cache = PredictionCache(r_server, 'inception', FLAGS.cache_size, FLAGS.cache_ttl,
+                            FLAGS.cache_redis_ttl) if FLAGS.cache_size else None
+    prefetcher = Prefetcher(r_server, FLAGS.redis_queue,
+                            lambda value: [ Specs(**task) for task in protocol.loads(value, 'task') ],
+                            concurrency=FLAGS.fetch_concurrency, per_host=FLAGS.fetch_per_host,
+                            timeout=FLAGS.fetch_timeout, max_queued=FLAGS.prefetch_queue_size,
+                            cache=cache, scheduler=FairScheduler(r_server, FLAGS.redis_queue)).start()
+
+    # The supervisor asks for a drain with SIGUSR1, the prefetched tasks go back to redis.
+    signal.signal(signal.SIGUSR1, lambda *_: prefetcher.stop())
+
+    while not prefetcher.draining:
+      batch = prefetcher.get_batch(FLAGS.batch_size, FLAGS.batch_timeout_ms)
+      if not batch:
+        continue
+      starttime = time.time()
+      # All the results of a batch are written back in one round-trip.
+      pipe = r_server.pipeline(transaction=False)
+      results = []
+
+      for fetched in batch:
+        specs = fetched.specs
+        if specs is None:
+          logging.error('Could not parse task {}: {}'.format(fetched.task, fetched.error))
+          continue
+        logging.info(specs)
+        record_timings(timings, fetched, starttime)
+
+        try:
+          if fetched.error is not None:
+            raise fetched.error
+          # The image may have waited for inference past the deadline.
+          check_deadline(specs)
+          if fetched.cached is not None:
+            result = Result(True, fetched.cached.predictions, 0., specs.ad_id, specs.path)
+          else:
+            result, hidden_layer = classify(sess, softmax_tensor, pool_tensor, node_lookup, specs, fetched.content, timings)
+            if cache is not None:
+              cache.store(specs.path, fetched.digest, result.predictions, hidden_layer)
+          store_result(pipe, specs, result)
+          results.append((specs, result))
+          logging.info(result)
+        except Exception as e:
+          logging.error('Something went wrong when classifying the image: {}'.format(e))
+          result_key = 'archive:{}:{}'.format(specs.group, specs.path)
+          pipe.hmset(result_key, {'OK': False})
+          notify_done(pipe, result_key)
+          results.append((specs, None))
+
+      count_processed(pipe, FLAGS.redis_queue, len(batch))
+      with timings.time('write'):
+        pipe.execute()
+        # After the results, so requests that joined a task find it, and the ads that
+        # joined it get the result published too.
+        released = inflight.release_all(r_server, FLAGS.redis_queue, [ specs for specs, _ in results ])
+        for (specs, result), waiters in zip(results, released):
+          if result is not None:
+            for ad_id in waiters.ad_ids - set([ specs.ad_id ]):
+              publish_result(pipe, specs, result, ad_id)
+        pipe.execute()
+      stats.update(len(batch), time.time() - starttime)
+
+    prefetcher.drain(lambda batch: protocol.dumps_batch('task', [ specs._asdict() for specs in batch ]))
 
 def maybe_download_and_extract():
   """Download and extract model tar file."""